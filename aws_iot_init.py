@@ -1,73 +1,268 @@
-import boto3
 import os
 import argparse
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from boto3 import session
+from botocore.exceptions import ClientError
 
 parser = argparse.ArgumentParser(
-    description="Initialise new AWS Iot Core Thing")
+    description="Initialise new AWS Iot Core Thing, or many things from a manifest")
 parser.add_argument('--thing-name', '-n', nargs=1,
                     type=str, help='name of thing')
 parser.add_argument('--thing-group-name', '-g', nargs=1,
                     type=str, help='name of thing group')
 parser.add_argument('--output-dir', '-o', nargs=1, type=str,
                     default=".", help='location to save keys/certificates')
+parser.add_argument('--manifest', '-m', type=str,
+                    help='file with one "thing_name[,thing_group_name]" per line. Credentials are saved to OUTPUT_DIR/THING_NAME/')
+parser.add_argument('--workers', '-w', type=int, default=8,
+                    help='things provisioned concurrently in manifest mode (default 8)')
+parser.add_argument('--retries', type=int, default=8,
+                    help='max retries of throttled AWS calls (default 8)')
+parser.add_argument('--profile', type=str, default=None, help='AWS profile name')
+parser.add_argument('--endpoint-url', type=str, default=None,
+                    help='IoT API endpoint, e.g. a local mock of the IoT API for offline testing')
 
+# Error codes of AWS calls worth retrying with backoff
+RETRY_CODES = {
+    "ThrottlingException", "TooManyRequestsException", "Throttling", "RequestLimitExceeded",
+    "ServiceUnavailableException", "InternalFailureException"
+}
 
-def main():
-    args = parser.parse_args()
+# TODO - Currently this just gives permission to all resources. update this for more restricted access
+POLICY = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "iot:Connect",
+                "iot:Receive",
+                "iot:Publish",
+                "iot:Subscribe"
+            ],
+            "Resource": "*"
+        }
+    ]
+}
 
-    thing_name = args.thing_name[0]
-    thing_group_name = args.thing_group_name[0]
-    output_dir = args.output_dir[0]
 
-    session = boto3.Session(profile_name='default')
-    iot_client = boto3.client('iot')
+def error_code(e):
+    return e.response.get("Error", {}).get("Code") if isinstance(e, ClientError) else None
+
+
+def call(fn, retries=8, base_delay=0.2, max_delay=10.0, **kwargs):
+    """Calls AWS API function, retrying throttling and transient errors with exponential
+    backoff and full jitter
+
+    Args:
+        fn (callable): boto3 client method
+        retries (int, optional): Max retries. Defaults to 8.
+        base_delay (float, optional): Delay before first retry in seconds. Defaults to 0.2.
+        max_delay (float, optional): Max delay between retries. Defaults to 10.0.
+
+    Returns:
+        dict: API response
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn(**kwargs)
+        except ClientError as e:
+            if error_code(e) not in RETRY_CODES or attempt == retries:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
+def read_manifest(path):
+    """Reads manifest of things to provision. Blank lines and lines starting with # are ignored
+
+    Args:
+        path (str): manifest file, one "thing_name[,thing_group_name]" per line
+
+    Returns:
+        list: (thing_name, thing_group_name or None) tuples in file order, without duplicates
+    """
+    things = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            name, _, group = (p.strip() for p in line.partition(","))
+            things.setdefault(name, group or None)
+    return list(things.items())
+
+
+def write_file(path, content, mode=0o644):
+    """Writes file atomically so an interrupted run never leaves half written credentials
+    """
+    tmp = Path(f"{path}.tmp")
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'w') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def load_certificate(iot_client, output_dir, retries):
+    """Finds certificate created by a previous run from its saved details
+
+    Returns:
+        dict: certificateId and certificateArn, or None if there is no usable certificate
+    """
+    try:
+        with open(Path(output_dir, "certificate.json")) as f:
+            cert = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if not all(Path(output_dir, n).exists() for n in ("device.pem.crt", "private.pem.crt")):
+        return None
+    try:
+        call(iot_client.describe_certificate, retries, certificateId=cert["certificateId"])
+    except ClientError as e:
+        if error_code(e) == "ResourceNotFoundException":
+            return None
+        raise
+    return cert
+
+
+def provision_thing(iot_client, thing_name, thing_group_name=None, output_dir=".", retries=8):
+    """Creates thing, certificate and policy and attaches them. Safe to re-run: existing
+    resources are reused, and a certificate saved in output_dir by a previous run is kept
+    rather than creating another one
+
+    Args:
+        iot_client (botocore.client.IoT): IoT client, or any object with the same methods
+        thing_name (str): name of thing
+        thing_group_name (str, optional): Thing group to add thing to. Defaults to None.
+        output_dir (str, optional): Where keys and certificates are saved. Defaults to ".".
+        retries (int, optional): Max retries of throttled calls. Defaults to 8.
+
+    Returns:
+        dict: action taken for each resource (created/existing/attached)
+    """
+    result = {"thing": thing_name}
+    os.makedirs(output_dir, exist_ok=True)
 
     # Create thing
-    # iot_client.create_thing(thingName=thing_name)
-    # iot_client.add_thing_to_thing_group(
-    #     thingName=thing_name, thingGroupName=thing_group_name)
+    try:
+        call(iot_client.describe_thing, retries, thingName=thing_name)
+        result["thing_status"] = "existing"
+    except ClientError as e:
+        if error_code(e) != "ResourceNotFoundException":
+            raise
+        try:
+            call(iot_client.create_thing, retries, thingName=thing_name)
+            result["thing_status"] = "created"
+        except ClientError as e:
+            if error_code(e) != "ResourceAlreadyExistsException":
+                raise
+            result["thing_status"] = "existing"
+    if thing_group_name:
+        call(iot_client.add_thing_to_thing_group, retries,
+             thingName=thing_name, thingGroupName=thing_group_name)
+        result["thing_group"] = thing_group_name
 
-    policy_name = thing_name + "_IoTPolicy"
-    # TODO - Currently this just gives permission to all resources. update this for more restricted access
-    policy = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Action": [
-                    "iot:Connect",
-                    "iot:Receive",
-                    "iot:Publish",
-                    "iot:Subscribe"
-                ],
-                "Resource": "*"
-            }
-        ]
-    }
-
-    # Generate keys and certificates
-    keys = iot_client.create_keys_and_certificate(setAsActive=True)
-    cert_id = keys['certificateId']
-    cert_arn = keys['certificateArn']
+    # Generate keys and certificates, unless a previous run already did
+    cert = load_certificate(iot_client, output_dir, retries)
+    if cert is None:
+        keys = call(iot_client.create_keys_and_certificate, retries, setAsActive=True)
+        cert = {"certificateId": keys['certificateId'], "certificateArn": keys['certificateArn']}
+
+        # Save keys and certificates straight away so they aren't lost if a later step fails
+        write_file(Path(output_dir, "device.pem.crt"), keys['certificatePem'])
+        write_file(Path(output_dir, "private.pem.crt"), keys['keyPair']['PrivateKey'], mode=0o600)
+        write_file(Path(output_dir, "public.pem.crt"), keys['keyPair']['PublicKey'])
+        write_file(Path(output_dir, "certificate.json"), json.dumps(cert, indent=2))
+        result["certificate_status"] = "created"
+    else:
+        result["certificate_status"] = "existing"
+    result["certificate_id"] = cert["certificateId"]
 
     # Create and attach policy that allows publish/subscribe to shadows
-    response = iot_client.create_policy(policyName=policy_name, policyDocument=json.dumps(policy))
-    response = iot_client.attach_policy(policyName=policy_name, target=cert_arn)
-    response = iot_client.attach_thing_principal(thingName=thing_name, principal=cert_arn)
+    policy_name = thing_name + "_IoTPolicy"
+    try:
+        call(iot_client.create_policy, retries,
+             policyName=policy_name, policyDocument=json.dumps(POLICY))
+        result["policy_status"] = "created"
+    except ClientError as e:
+        if error_code(e) != "ResourceAlreadyExistsException":
+            raise
+        result["policy_status"] = "existing"
 
-    # Save keys and certifactes to files. Defaults to current directory
-    with open(Path(output_dir, "device.pem.crt"), 'w') as f:
-        f.write(keys['certificatePem'])
+    # Attaching is idempotent
+    call(iot_client.attach_policy, retries, policyName=policy_name, target=cert["certificateArn"])
+    call(iot_client.attach_thing_principal, retries,
+         thingName=thing_name, principal=cert["certificateArn"])
+    result["status"] = "ok"
+    return result
+
+
+def provision_fleet(iot_client, things, output_dir=".", workers=8, retries=8):
+    """Provisions many things concurrently. Credentials of each thing are saved to
+    output_dir/THING_NAME/. A summary is written to output_dir/provisioning.json
+
+    Args:
+        iot_client (botocore.client.IoT): IoT client. boto3 clients are thread safe
+        things (list): (thing_name, thing_group_name) tuples
+        output_dir (str, optional): Root of output tree. Defaults to ".".
+        workers (int, optional): Things provisioned concurrently. Defaults to 8.
+        retries (int, optional): Max retries of throttled calls. Defaults to 8.
+
+    Returns:
+        list: result of each thing, in manifest order
+    """
+    lock = threading.Lock()
+    done = [0]
+
+    def provision(thing):
+        name, group = thing
+        try:
+            result = provision_thing(iot_client, name, group, Path(output_dir, name), retries)
+        except Exception as e:
+            result = {"thing": name, "status": "failed", "error": str(e)}
+        with lock:
+            done[0] += 1
+            print(f"[{done[0]}/{len(things)}] {name}: {result['status']}"
+                  + (f" ({result['error']})" if result.get("error") else ""))
+        return result
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(provision, things))
+
+    failed = sum(r["status"] != "ok" for r in results)
+    print(f"Provisioned {len(results) - failed}/{len(results)} things in {time.monotonic() - start:.1f}s")
+    write_file(Path(output_dir, "provisioning.json"), json.dumps(results, indent=2))
+    return results
 
-    with open(Path(output_dir, "private.pem.crt"), 'w') as f:
-        f.write(keys['keyPair']['PrivateKey'])
 
-    with open(Path(output_dir, "public.pem.crt"), 'w') as f:
-        f.write(keys['keyPair']['PublicKey'])
+def main():
+    import boto3
+
+    args = parser.parse_args()
+    output_dir = args.output_dir[0]
+
+    session = boto3.Session(profile_name=args.profile)
+    iot_client = session.client('iot', endpoint_url=args.endpoint_url)
+
+    if args.manifest:
+        results = provision_fleet(
+            iot_client, read_manifest(args.manifest), output_dir, args.workers, args.retries)
+        if any(r["status"] != "ok" for r in results):
+            exit(1)
+        return
+
+    if not args.thing_name:
+        parser.error("--thing-name or --manifest is required")
+    thing_name = args.thing_name[0]
+    thing_group_name = args.thing_group_name[0] if args.thing_group_name else None
+
+    # Save keys and certifactes to files. Defaults to current directory
+    result = provision_thing(iot_client, thing_name, thing_group_name, output_dir, args.retries)
+    print(json.dumps(result, indent=2))
 
     # Get CA certificates
 
@@ -0,0 +1,68 @@
+"""Runs one iot agent against a local broker and fake snsrpi API. Started as a subprocess by
+fleet.py. Uses the same startup and shutdown path as iot/main.py over a plain TCP connection.
+Prints JSON lines to stdout: ready (with startup time) and stopped. Stops when stdin closes
+"""
+import argparse
+import tempfile
+import json
+import sys
+import os
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--name", required=True, help="thing name")
+    parser.add_argument("--broker", required=True, help="broker host:port")
+    parser.add_argument("--api", required=True, help="snsrpi API host:port")
+    parser.add_argument("--data-dir", default=None, help="output data directory")
+    return parser.parse_args()
+
+
+def emit(event, **values):
+    print(json.dumps({"event": event, **values}), flush=True)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix=f"{args.name}-")
+
+    # Module level configuration of the agent is read from the environment on import
+    os.environ.update({
+        "DEVICE_NAME": args.name,
+        "DEVICE_ENDPOINT": args.api,
+        "AWS_IOT_ENDPOINT": args.broker,
+        "OUTPUT_DATA_DIR": data_dir,
+        "PRIVATE_KEY": "", "ROOT_CA": "", "DEVICE_CERT": ""
+    })
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "iot"))
+
+    from awscrt import io, mqtt
+    from awsiot import iotshadow
+    from Device import Device
+    import main
+
+    host, port = args.broker.rsplit(":", 1)
+    event_loop_group = io.EventLoopGroup(1)
+    host_resolver = io.DefaultHostResolver(event_loop_group)
+    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+
+    device = Device(args.name, args.api)
+    mqtt_connection = mqtt.Connection(
+        client=mqtt.Client(client_bootstrap),
+        host_name=host,
+        port=int(port),
+        client_id=args.name,
+        clean_session=False,
+        keep_alive_secs=30,
+        on_connection_interrupted=lambda connection, error, **kwargs: device.set_online(False),
+        on_connection_resumed=lambda connection, return_code, session_present, **kwargs: device.set_online(True))
+    device.set_mqtt(mqtt_connection)
+    shadow_client = iotshadow.IotShadowClient(mqtt_connection)
+
+    startup = main.start_device(device, mqtt_connection, shadow_client)
+    emit("ready", startup_s=startup, sensors=len(device.sensor_shadows))
+
+    sys.stdin.read()
+
+    main.stop_device(device, mqtt_connection)
+    emit("stopped", dispatcher=device.dispatcher.stats())
@@ -0,0 +1,313 @@
+"""Minimal MQTT 3.1.1 broker with an AWS IoT named shadow service, for local benchmarks.
+Supports what the agent uses: CONNECT, SUBSCRIBE/UNSUBSCRIBE, PUBLISH at QoS 0/1, PINGREQ and
+DISCONNECT. Messages are delivered to subscribers at QoS 0. Publishes to the named shadow
+update/get/delete topics are answered like the AWS IoT shadow service
+"""
+import threading
+import asyncio
+import logging
+import struct
+import json
+import time
+import re
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+SHADOW_TOPIC = re.compile(r"^\$aws/things/([^/]+)/shadow/name/([^/]+)/(update|get|delete)$")
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def packet(packet_type, body=b"", flags=0):
+    return bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + body
+
+
+def utf8(s):
+    data = s.encode()
+    return struct.pack(">H", len(data)) + data
+
+
+def read_utf8(body, offset):
+    length, = struct.unpack_from(">H", body, offset)
+    offset += 2
+    return body[offset:offset + length].decode(), offset + length
+
+
+def topic_matches(topic_filter, topic):
+    parts = topic_filter.split("/")
+    levels = topic.split("/")
+    for i, part in enumerate(parts):
+        if part == "#":
+            return True
+        if i >= len(levels) or (part != "+" and part != levels[i]):
+            return False
+    return len(parts) == len(levels)
+
+
+def merge_document(old, new):
+    """Merges shadow state following shadow semantics, None deletes a key
+    """
+    merged = dict(old)
+    for key, value in new.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_document(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def stamp(value, timestamp):
+    """Metadata of a state document: the same layout with {"timestamp": ...} leaves
+    """
+    if isinstance(value, dict):
+        return {key: stamp(v, timestamp) for key, v in value.items()}
+    if isinstance(value, list):
+        return [stamp(v, timestamp) for v in value]
+    return {"timestamp": timestamp}
+
+
+def delta(desired, reported):
+    """Desired keys that differ from reported
+    """
+    result = {}
+    for key, value in desired.items():
+        if isinstance(value, dict) and isinstance(reported.get(key), dict):
+            d = delta(value, reported[key])
+            if d:
+                result[key] = d
+        elif reported.get(key) != value:
+            result[key] = value
+    return result
+
+
+class Session:
+    def __init__(self, client_id, writer) -> None:
+        self.client_id = client_id
+        self.writer = writer
+        self.subscriptions = {}
+
+
+class FakeBroker:
+    """Broker running on its own asyncio thread. Hooks registered with add_listener are called
+    on the broker thread for every message published by a client or the shadow service
+    """
+
+    def __init__(self, host="127.0.0.1", port=0) -> None:
+        self.host = host
+        self.port = port
+        self.sessions = {}
+        self.shadows = {}  # (thing, shadow) -> document
+        self.listeners = []
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.ready = threading.Event()
+
+        # Stats
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.shadow_updates = {}  # thing -> count
+
+    def add_listener(self, listener):
+        """Registers listener(client_id, topic, payload, timestamp)
+        """
+        self.listeners.append(listener)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="fake-broker", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.serve())
+        self.loop.run_forever()
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+
+    def stop(self):
+        if self.loop is None:
+            return
+
+        async def shutdown():
+            self.server.close()
+            for s in list(self.sessions.values()):
+                s.writer.close()
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop)
+        self.thread.join(5)
+
+    def publish(self, topic, payload):
+        """Publishes message as if from a client, e.g. a cloud side desired update. Thread safe
+        """
+        if isinstance(payload, dict):
+            payload = json.dumps(payload)
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.loop.call_soon_threadsafe(self.route, "bench", topic, payload)
+
+    async def read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        body = await reader.readexactly(length) if length else b""
+        return header >> 4, header & 0x0F, body
+
+    async def handle(self, reader, writer):
+        session = None
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet(reader)
+                if packet_type == CONNECT:
+                    _, offset = read_utf8(body, 0)
+                    offset += 4  # level, flags, keep alive
+                    client_id, _ = read_utf8(body, offset)
+                    old = self.sessions.get(client_id)
+                    if old is not None:
+                        old.writer.close()
+                    session = self.sessions[client_id] = Session(client_id, writer)
+                    writer.write(packet(CONNACK, b"\x00\x00"))
+                elif packet_type == SUBSCRIBE:
+                    packet_id = body[:2]
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        topic_filter, offset = read_utf8(body, offset)
+                        qos = body[offset]
+                        offset += 1
+                        session.subscriptions[topic_filter] = qos
+                        granted.append(min(qos, 1))
+                    writer.write(packet(SUBACK, packet_id + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id = body[:2]
+                    offset = 2
+                    while offset < len(body):
+                        topic_filter, offset = read_utf8(body, offset)
+                        session.subscriptions.pop(topic_filter, None)
+                    writer.write(packet(UNSUBACK, packet_id))
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic, offset = read_utf8(body, 0)
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        writer.write(packet(PUBACK, packet_id))
+                    self.route(session.client_id, topic, body[offset:])
+                elif packet_type == PINGREQ:
+                    writer.write(packet(PINGRESP))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if session is not None and self.sessions.get(session.client_id) is session:
+                del self.sessions[session.client_id]
+            writer.close()
+
+    def route(self, client_id, topic, payload):
+        """Delivers message to subscribers and answers shadow requests. Runs on broker thread
+        """
+        now = time.monotonic()
+        self.messages_in += 1
+        self.bytes_in += len(payload)
+        for listener in self.listeners:
+            try:
+                listener(client_id, topic, payload, now)
+            except Exception as e:
+                logging.error(e)
+
+        data = packet(PUBLISH, utf8(topic) + payload)
+        for session in list(self.sessions.values()):
+            if any(topic_matches(f, topic) for f in session.subscriptions):
+                session.writer.write(data)
+                self.messages_out += 1
+
+        match = SHADOW_TOPIC.match(topic)
+        if match:
+            self.shadow_request(*match.groups(), payload)
+
+    def shadow_request(self, thing, shadow, action, payload):
+        prefix = f"$aws/things/{thing}/shadow/name/{shadow}/{action}"
+        try:
+            request = json.loads(payload) if payload else {}
+        except ValueError:
+            self.respond(f"{prefix}/rejected", {"code": 400, "message": "Payload contains invalid json"})
+            return
+        token = request.get("clientToken")
+        key = (thing, shadow)
+        document = self.shadows.get(key)
+        timestamp = int(time.time())
+
+        if action == "update":
+            state = request.get("state") or {}
+            if document is None:
+                document = {"state": {"desired": {}, "reported": {}},
+                            "metadata": {"desired": {}, "reported": {}}, "version": 0}
+            for section in ("desired", "reported"):
+                if section in state:
+                    document["state"][section] = merge_document(
+                        document["state"][section], state[section] or {})
+                    document["metadata"][section] = merge_document(
+                        document["metadata"][section], stamp(state[section] or {}, timestamp))
+            document["version"] += 1
+            self.shadows[key] = document
+            self.shadow_updates[thing] = self.shadow_updates.get(thing, 0) + 1
+            self.respond(f"{prefix}/accepted", {
+                "state": state, "metadata": {}, "version": document["version"],
+                "timestamp": timestamp, "clientToken": token})
+            changes = delta(document["state"]["desired"], document["state"]["reported"])
+            if "desired" in state and changes:
+                self.respond(f"{prefix}/delta", {
+                    "state": changes, "metadata": {}, "version": document["version"],
+                    "timestamp": timestamp, "clientToken": token})
+        elif document is None:
+            self.respond(f"{prefix}/rejected", {
+                "code": 404, "message": f"No shadow exists with name: '{shadow}'",
+                "timestamp": timestamp, "clientToken": token})
+        elif action == "get":
+            state = dict(document["state"])
+            changes = delta(state["desired"], state["reported"])
+            if changes:
+                state["delta"] = changes
+            self.respond(f"{prefix}/accepted", {
+                "state": state, "metadata": document["metadata"], "version": document["version"],
+                "timestamp": timestamp, "clientToken": token})
+        else:
+            del self.shadows[key]
+            self.respond(f"{prefix}/accepted", {
+                "version": document["version"], "timestamp": timestamp, "clientToken": token})
+
+    def respond(self, topic, message):
+        self.route("shadow-service", topic, json.dumps(message).encode())
+
+    def stats(self):
+        return {
+            "messages_in": self.messages_in,
+            "bytes_in": self.bytes_in,
+            "messages_out": self.messages_out,
+            "shadows": len(self.shadows),
+            "shadow_updates": dict(self.shadow_updates)
+        }
@@ -0,0 +1,125 @@
+"""Fake snsrpi REST API for local benchmarks. Serves /api/health, /api/devices/{id} and
+/api/settings/{id} like snsrpi-device, with a configurable number of sensors and per request
+latency
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import threading
+import json
+import time
+
+
+def default_settings(sensor_id):
+    return {
+        "Sample_rate": 100,
+        "Output_type": "csv",
+        "Offline_mode": False,
+        "Output_directory": "/data",
+        "File_upload": {"Active": False, "Endpoint": ""},
+        "Save_interval": {"Unit": "second", "Interval": 30}
+    }
+
+
+class FakeDeviceApi:
+    """One fake snsrpi API per simulated device, each on its own port
+    """
+
+    def __init__(self, device_id, sensors=2, latency=0.0, host="127.0.0.1", port=0,
+                 on_operate=None, on_settings=None) -> None:
+        """
+        Args:
+            device_id (str): device id reported by /api/health
+            sensors (int, optional): Number of sensors. Defaults to 2.
+            latency (float, optional): Seconds added to every request. Defaults to 0.0.
+            on_operate (callable, optional): on_operate(device_id, sensor_id, active, timestamp). Defaults to None.
+            on_settings (callable, optional): on_settings(device_id, sensor_id, settings, timestamp). Defaults to None.
+        """
+        self.device_id = device_id
+        self.latency = latency
+        self.on_operate = on_operate
+        self.on_settings = on_settings
+        self.lock = threading.Lock()
+        self.active = {f"CX1_{1900 + i}": True for i in range(sensors)}
+        self.settings = {s: default_settings(s) for s in self.active}
+        self.requests = 0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                api.handle(self, "GET")
+
+            def do_POST(self):
+                api.handle(self, "POST")
+
+            def do_PUT(self):
+                api.handle(self, "PUT")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    def health(self):
+        with self.lock:
+            return {
+                "device_id": self.device_id,
+                "sensors": [{"sensor_id": s, "active": a} for s, a in self.active.items()]
+            }
+
+    def handle(self, request, method):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlparse(request.path)
+        parts = url.path.strip("/").split("/")
+        status, body = 404, None
+        if parts == ["api", "health"] and method == "GET":
+            status, body = 200, self.health()
+        elif len(parts) == 3 and parts[:2] == ["api", "devices"] and parts[2] in self.active:
+            active = parse_qs(url.query).get("active", ["false"])[0].lower() == "true"
+            with self.lock:
+                changed = self.active[parts[2]] != active
+                self.active[parts[2]] = active
+            if self.on_operate:
+                self.on_operate(self.device_id, parts[2], active, time.monotonic())
+            # snsrpi-device rejects requests that don't change the sensor state
+            status, body = (200, self.health()) if changed else (400, None)
+        elif len(parts) == 3 and parts[:2] == ["api", "settings"] and parts[2] in self.settings:
+            if method == "PUT":
+                length = int(request.headers.get("Content-Length", 0))
+                settings = json.loads(request.rfile.read(length))
+                with self.lock:
+                    self.settings[parts[2]] = settings
+                if self.on_settings:
+                    self.on_settings(self.device_id, parts[2], settings, time.monotonic())
+            with self.lock:
+                status, body = 200, self.settings[parts[2]]
+
+        data = json.dumps(body).encode() if body is not None else b""
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name=f"fake-api-{self.device_id}", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,313 @@
+"""Fleet load simulator. Starts a local MQTT broker with a named shadow service and a fake
+snsrpi API per device, runs N agents with M sensors each as subprocesses and measures:
+
+- startup time of each agent
+- desired -> device latency: from a desired `active` change published to a sensor shadow until
+  the agent calls POST /api/devices/{id}, and until the agent reports the new state
+- publish throughput: a desired settings change is sent to every sensor at once and the time
+  until all sensors have reported the new settings is measured
+- CPU time and memory (RSS) of each agent process
+
+Example:
+    python benchmarks/fleet.py --agents 4 --sensors 8 --commands 50 --output fleet.json
+"""
+import subprocess
+import threading
+import argparse
+import platform
+import random
+import json
+import time
+import sys
+import os
+
+from fake_broker import FakeBroker, SHADOW_TOPIC, merge_document
+from fake_device_api import FakeDeviceApi
+
+AGENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent.py")
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Returns:
+        dict: count, mean, max and requested percentiles of values
+    """
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    result = {"count": len(ordered), "mean": sum(ordered) / len(ordered), "max": ordered[-1]}
+    for p in points:
+        result[f"p{p}"] = ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return result
+
+
+def process_usage(pid):
+    """CPU seconds and memory of a process, read from /proc (Linux only)
+
+    Returns:
+        dict: cpu_s, rss_mb and peak_rss_mb, or empty dict if unavailable
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except (FileNotFoundError, ProcessLookupError):
+        return {}
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "cpu_s": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss_mb": int(status["VmRSS"].split()[0]) / 1024,
+        "peak_rss_mb": int(status["VmHWM"].split()[0]) / 1024
+    }
+
+
+class Agent:
+    """Agent subprocess and its fake snsrpi API
+    """
+
+    def __init__(self, name, broker, api: FakeDeviceApi) -> None:
+        self.name = name
+        self.api = api
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.startup_s = None
+        self.launched_at = time.monotonic()
+        self.ready_at = None
+        self.usage = {}
+        self.process = subprocess.Popen(
+            [sys.executable, AGENT, "--name", name, "--broker", f"127.0.0.1:{broker.port}",
+             "--api", api.endpoint],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        self.reader = threading.Thread(target=self.read, name=f"{name}-stdout", daemon=True)
+        self.reader.start()
+
+    def read(self):
+        for line in self.process.stdout:
+            if not line.startswith('{"event"'):
+                continue
+            message = json.loads(line)
+            if message["event"] == "ready":
+                self.startup_s = message["startup_s"]
+                self.ready_at = time.monotonic()
+                self.ready.set()
+            elif message["event"] == "stopped":
+                self.stopped.set()
+        self.ready.set()
+        self.stopped.set()
+
+    def sample(self):
+        usage = process_usage(self.process.pid)
+        if usage:
+            self.usage = usage
+
+    def stop(self, timeout=30):
+        start = time.monotonic()
+        self.sample()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        return time.monotonic() - start
+
+
+class Fleet:
+    def __init__(self, agents, sensors, api_latency) -> None:
+        self.broker = FakeBroker().start()
+        self.broker.add_listener(self.on_message)
+        self.lock = threading.Lock()
+        self.waiting = {}  # (thing, shadow) -> (predicate, event, record)
+        self.apis = [
+            FakeDeviceApi(f"bench-{i:03d}", sensors=sensors, latency=api_latency,
+                          on_operate=self.on_operate).start()
+            for i in range(agents)
+        ]
+        self.agents = []
+
+    def on_operate(self, device_id, sensor_id, active, timestamp):
+        with self.lock:
+            waiting = self.waiting.get((device_id, sensor_id))
+        if waiting is not None:
+            waiting[2].setdefault("device_at", timestamp)
+
+    def on_message(self, client_id, topic, payload, timestamp):
+        """Broker listener. Completes waits on reported updates from agents
+        """
+        match = SHADOW_TOPIC.match(topic)
+        if not match or match.group(3) != "update" or client_id in ("bench", "shadow-service"):
+            return
+        key = match.group(1), match.group(2)
+        with self.lock:
+            waiting = self.waiting.get(key)
+        if waiting is None:
+            return
+        # Agents publish only changed keys, compare against the merged reported document
+        reported = (json.loads(payload).get("state") or {}).get("reported") or {}
+        document = self.broker.shadows.get(key) or {"state": {"reported": {}}}
+        reported = merge_document(document["state"]["reported"], reported)
+        predicate, event, record = waiting
+        if predicate(reported):
+            record.setdefault("reported_at", timestamp)
+            event.set()
+
+    def set_desired(self, thing, shadow, desired, predicate):
+        """Publishes desired state to a shadow as the cloud would
+
+        Returns:
+            tuple: (event set once the agent reports a matching state, timing record)
+        """
+        event = threading.Event()
+        record = {}
+        with self.lock:
+            self.waiting[(thing, shadow)] = (predicate, event, record)
+        record["sent_at"] = time.monotonic()
+        self.broker.publish(
+            f"$aws/things/{thing}/shadow/name/{shadow}/update",
+            {"state": {"desired": desired}, "clientToken": "bench"})
+        return event, record
+
+    def start_agents(self, timeout):
+        start = time.monotonic()
+        self.agents = [Agent(api.device_id, self.broker, api) for api in self.apis]
+        for agent in self.agents:
+            agent.ready.wait(max(0, timeout - (time.monotonic() - start)))
+        not_ready = [a.name for a in self.agents if a.startup_s is None]
+        if not_ready:
+            raise RuntimeError(f"Agents not ready within {timeout}s: {not_ready}")
+        return {
+            "agent_startup_s": percentiles([a.startup_s for a in self.agents]),
+            # Includes interpreter start and imports
+            "process_startup_s": percentiles([a.ready_at - a.launched_at for a in self.agents]),
+            "fleet_ready_s": time.monotonic() - start
+        }
+
+    def sample(self):
+        for agent in self.agents:
+            agent.sample()
+
+    def run_commands(self, count, timeout, rng):
+        """Toggles `active` of random sensors one at a time
+        """
+        device_latency, reported_latency = [], []
+        timeouts = 0
+        for _ in range(count):
+            api = rng.choice(self.apis)
+            sensor = rng.choice(list(api.active))
+            active = not api.active[sensor]
+            event, record = self.set_desired(
+                api.device_id, sensor, {"active": active},
+                lambda reported, active=active: reported.get("active") == active)
+            if not event.wait(timeout):
+                timeouts += 1
+                continue
+            if "device_at" in record:
+                device_latency.append((record["device_at"] - record["sent_at"]) * 1000)
+            reported_latency.append((record["reported_at"] - record["sent_at"]) * 1000)
+            self.sample()
+        with self.lock:
+            self.waiting.clear()
+        return {
+            "desired_to_device_ms": percentiles(device_latency),
+            "desired_to_reported_ms": percentiles(reported_latency),
+            "timeouts": timeouts
+        }
+
+    def run_burst(self, timeout):
+        """Sends a desired settings change to every sensor at once
+        """
+        messages_before = self.broker.messages_in
+        waits = []
+        start = time.monotonic()
+        for api in self.apis:
+            for sensor, settings in api.settings.items():
+                desired = {**settings, "Sample_rate": settings["Sample_rate"] + 1}
+                waits.append(self.set_desired(
+                    api.device_id, sensor, {"settings": desired},
+                    lambda reported, desired=desired: reported.get("settings") == desired))
+        completed = 0
+        for event, _ in waits:
+            if event.wait(max(0, timeout - (time.monotonic() - start))):
+                completed += 1
+        elapsed = time.monotonic() - start
+        self.sample()
+        with self.lock:
+            self.waiting.clear()
+        return {
+            "sensors": len(waits),
+            "completed": completed,
+            "seconds": elapsed,
+            "updates_per_s": completed / elapsed if elapsed else 0.0,
+            "broker_messages_per_s": (self.broker.messages_in - messages_before) / elapsed if elapsed else 0.0
+        }
+
+    def idle(self, duration):
+        """Leaves the fleet idle, e.g. to measure heartbeat overhead
+        """
+        updates_before = sum(self.broker.shadow_updates.values())
+        requests_before = sum(api.requests for api in self.apis)
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            time.sleep(min(1.0, max(0, end - time.monotonic())))
+            self.sample()
+        return {
+            "seconds": duration,
+            "shadow_updates_per_s": (sum(self.broker.shadow_updates.values()) - updates_before) / duration,
+            "api_requests_per_s": (sum(api.requests for api in self.apis) - requests_before) / duration
+        }
+
+    def stop(self):
+        shutdown = [agent.stop() for agent in self.agents]
+        for api in self.apis:
+            api.stop()
+        self.broker.stop()
+        return percentiles(shutdown)
+
+    def resources(self):
+        agents = {a.name: a.usage for a in self.agents}
+        return {
+            "cpu_s": percentiles([u["cpu_s"] for u in agents.values() if u]),
+            "peak_rss_mb": percentiles([u["peak_rss_mb"] for u in agents.values() if u]),
+            "agents": agents
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local fleet load simulator")
+    parser.add_argument("--agents", type=int, default=2, help="number of agents")
+    parser.add_argument("--sensors", type=int, default=4, help="sensors per agent")
+    parser.add_argument("--api-latency", type=float, default=0.005,
+                        help="seconds added to every snsrpi API request")
+    parser.add_argument("--commands", type=int, default=20, help="number of start/stop commands")
+    parser.add_argument("--idle", type=float, default=10, help="seconds to idle and measure heartbeat load")
+    parser.add_argument("--timeout", type=float, default=60, help="timeout per phase in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for command selection")
+    parser.add_argument("--output", help="write JSON results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    fleet = Fleet(args.agents, args.sensors, args.api_latency)
+    results = {
+        "config": {**vars(args), "python": platform.python_version(), "machine": platform.machine(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    }
+    try:
+        results["startup"] = fleet.start_agents(args.timeout)
+        results["commands"] = fleet.run_commands(args.commands, args.timeout, random.Random(args.seed))
+        results["burst"] = fleet.run_burst(args.timeout)
+        results["idle"] = fleet.idle(args.idle)
+        results["resources"] = fleet.resources()
+    finally:
+        results["shutdown_s"] = fleet.stop()
+        results["broker"] = fleet.broker.stats()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
@@ -0,0 +1,191 @@
+"""Compares the vectorised output file reader (iot/Reader.py) with naive parsing: the csv
+module with strptime per row, and pandas (read_csv then to_datetime with the logger's time
+format, if pandas is installed). Synthetic files in each layout are written to a temporary
+directory: logger csv, logger feather (V1, string times) and transcoded feather (int64 times).
+
+Example:
+    python benchmarks/reader.py --rows 1000000 --output reader.json
+"""
+from datetime import datetime, timedelta
+import tempfile
+import warnings
+import argparse
+import platform
+import json
+import time
+import sys
+import csv
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "iot"))
+
+import numpy as np  # noqa: E402
+import pyarrow as pa  # noqa: E402
+import pyarrow.feather as feather  # noqa: E402
+from Reader import read_samples, iter_samples, CSV_TIME_FORMAT, FEATHER_TIME_FORMAT, AXES  # noqa: E402
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def synthetic(rows, sample_rate, seed=0):
+    """
+    Returns:
+        tuple: (time strings in csv format, time strings in feather format, int64 epoch us,
+            samples of shape (3, rows))
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime(2021, 9, 1, 14, 0, 0)
+    times = [start + timedelta(microseconds=int(i * 1e6 / sample_rate)) for i in range(rows)]
+    epoch_us = np.array([(t - EPOCH) // timedelta(microseconds=1) for t in times], dtype=np.int64)
+    axes = rng.standard_normal((3, rows)) * 0.01 + np.array([[0.0], [0.0], [1.0]])
+    return ([t.strftime(CSV_TIME_FORMAT) for t in times],
+            [t.strftime(FEATHER_TIME_FORMAT) for t in times], epoch_us, axes)
+
+
+def write_files(directory, rows, sample_rate):
+    csv_times, feather_times, epoch_us, axes = synthetic(rows, sample_rate)
+    paths = {
+        "csv": os.path.join(directory, "CX1_1901_2021-09-01_14-00-00.csv"),
+        "feather_v1": os.path.join(directory, "CX1_1902_2021-09-01_14-00-00.feather"),
+        "feather_transcoded": os.path.join(directory, "CX1_1903_2021-09-01_14-00-00.feather")
+    }
+    with open(paths["csv"], "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\r\n")
+        writer.writerow(["time", *AXES])
+        writer.writerows(zip(csv_times, *(a.tolist() for a in axes)))
+    columns = {a: axes[i] for i, a in enumerate(AXES)}
+    feather.write_feather(pa.table({"time": feather_times, **columns}), paths["feather_v1"],
+                          version=1)
+    feather.write_feather(pa.table({"time": epoch_us, **columns}), paths["feather_transcoded"],
+                          compression="zstd")
+    return paths, epoch_us
+
+
+def strptime_us(value, fmt):
+    return (datetime.strptime(value, fmt) - EPOCH) // timedelta(microseconds=1)
+
+
+def naive_csv(path):
+    """csv module plus strptime per row
+    """
+    times, axes = [], []
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            times.append(strptime_us(row[0], CSV_TIME_FORMAT))
+            axes.append([float(v) for v in row[1:4]])
+    return np.array(times, dtype=np.int64), np.array(axes).T
+
+
+def naive_feather(path):
+    """feather read, then strptime per row for string times
+    """
+    table = feather.read_table(path)
+    column = table.column("time")
+    if pa.types.is_integer(column.type):
+        times = column.to_numpy()
+    else:
+        times = np.array([strptime_us(v, FEATHER_TIME_FORMAT) for v in column.to_pylist()], dtype=np.int64)
+    return times, np.stack([table.column(a).to_numpy() for a in AXES])
+
+
+def pandas_reader(layout):
+    """pandas read_csv/read_feather then to_datetime with an explicit format, or None if
+    pandas isn't installed
+    """
+    try:
+        import pandas as pd
+    except ImportError:
+        return None
+
+    def read(path):
+        if layout == "csv":
+            df = pd.read_csv(path)
+            times = pd.to_datetime(df["time"], format=CSV_TIME_FORMAT)
+        else:
+            df = pd.read_feather(path)
+            times = df["time"] if df["time"].dtype.kind == "i" else pd.to_datetime(
+                df["time"], format=FEATHER_TIME_FORMAT)
+        if times.dtype.kind == "M":
+            times = times.astype("datetime64[us]").astype(np.int64)
+        return np.asarray(times, dtype=np.int64), df[list(AXES)].to_numpy().T
+    return read
+
+
+def chunked(path):
+    parts = list(iter_samples(path, chunk_rows=1 << 16))
+    return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts], axis=1)
+
+
+def measure(fn, min_time):
+    fn()
+    loops = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        loops += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / loops
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Output file reader benchmark")
+    parser.add_argument("--rows", type=int, default=200000, help="rows per file")
+    parser.add_argument("--sample-rate", type=float, default=2000, help="samples per second")
+    parser.add_argument("--min-time", type=float, default=0.5, help="min seconds per measurement")
+    parser.add_argument("--output", help="write JSON results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # The logger writes Feather V1 files, which pyarrow warns about
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths, expected = write_files(directory, args.rows, args.sample_rate)
+        for layout, path in paths.items():
+            readers = {
+                "reader": read_samples,
+                "reader_chunked": chunked,
+                "naive": naive_csv if layout == "csv" else naive_feather,
+                "pandas": pandas_reader(layout)
+            }
+            for name, read in readers.items():
+                if read is None:
+                    print(f"{layout:<19} {name:<15} skipped (pandas not installed)", file=sys.stderr)
+                    continue
+                times, axes = read(path)
+                seconds = measure(lambda: read(path), args.min_time)
+                results.append({
+                    "layout": layout,
+                    "reader": name,
+                    "file_bytes": os.path.getsize(path),
+                    "seconds": seconds,
+                    "mrows_s": args.rows / seconds / 1e6,
+                    "times_match": bool(np.array_equal(times, expected)),
+                    "shape": list(axes.shape)
+                })
+                r = results[-1]
+                print(f"{layout:<19} {name:<15} {r['seconds'] * 1000:9.1f}ms  {r['mrows_s']:6.2f}M rows/s"
+                      f"  times match: {r['times_match']}", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "numpy": np.__version__,
+            "pyarrow": pa.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "rows": args.rows
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
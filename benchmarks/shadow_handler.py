@@ -0,0 +1,260 @@
+"""Micro-benchmarks for ShadowHandler hot paths, run against a mocked IotShadowClient so no
+broker is needed. Each case is measured at several sensor counts (default 1, 10, 100, 1000)
+and reports time per call and peak memory allocated per call.
+
+Cases:
+- publish_full: publish_state with the full reported state (startup, resync)
+- publish_diff: publish_state after one sensor changed (heartbeat with a change)
+- publish_unchanged: publish_state with nothing changed (heartbeat without a change)
+- update_request: update_state, i.e. queueing a request with the coalescing publisher
+- index_state: GlobalShadowHandler.set_state with update_index, rebuilding the sensor index
+- settings_compare: update/accepted with unchanged desired settings for every sensor handler
+
+Results are written as JSON. Pass a previous result file with --compare to print changes.
+
+Example:
+    python benchmarks/shadow_handler.py --output shadow_handler.json
+    python benchmarks/shadow_handler.py --compare shadow_handler.json
+"""
+from concurrent.futures import Future
+import contextlib
+import subprocess
+import tracemalloc
+import statistics
+import argparse
+import platform
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "iot"))
+
+from awsiot.iotshadow import UpdateShadowResponse, ShadowState  # noqa: E402
+from ShadowHandler import GlobalShadowHandler, SensorShadowHandler  # noqa: E402
+from fake_device_api import default_settings  # noqa: E402
+
+
+def done_future(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class MockShadowClient:
+    """Stands in for IotShadowClient. Requests are serialised like the real client, and every
+    publish and subscribe completes immediately
+    """
+
+    def __init__(self) -> None:
+        self.published = 0
+
+    def publish_update_named_shadow(self, request, qos):
+        self.published += 1
+        json.dumps(request.to_payload())
+        return done_future()
+
+    def publish_delete_named_shadow(self, request, qos):
+        return done_future()
+
+    def __getattr__(self, name):
+        if name.startswith("subscribe_to_"):
+            return lambda request, qos, callback: (done_future(), None)
+        raise AttributeError(name)
+
+
+def sensor_ids(count):
+    return [f"CX1_{i:04d}" for i in range(count)]
+
+
+def health(count, active=True):
+    return {
+        "device_id": "bench",
+        "sensors": [{"sensor_id": s, "active": active} for s in sensor_ids(count)]
+    }
+
+
+def global_handler(count, debounce=3600):
+    handler = GlobalShadowHandler(MockShadowClient(), "bench", "global", None, None)
+    handler.publisher.debounce = debounce
+    handler.set_state(health(count), update_index=True)
+    handler.publish_state(full=True)
+    return handler
+
+
+def case_publish_full(count):
+    handler = global_handler(count)
+    return lambda: handler.publish_state(full=True)
+
+
+def case_publish_diff(count):
+    handler = global_handler(count)
+    sensors = handler.local_state["sensors"]
+    state = {"i": 0}
+
+    def call():
+        sensor = sensors[state["i"] % len(sensors)]
+        sensor["active"] = not sensor["active"]
+        state["i"] += 1
+        handler.publish_state()
+    return call
+
+
+def case_publish_unchanged(count):
+    handler = global_handler(count)
+    return lambda: handler.publish_state()
+
+
+def case_update_request(count):
+    handler = global_handler(count)
+    return lambda: handler.update_state()
+
+
+def case_index_state(count):
+    handler = global_handler(count)
+    state = health(count)
+    return lambda: handler.set_state(state, update_index=True)
+
+
+def case_settings_compare(count):
+    handlers = []
+    for sensor in sensor_ids(count):
+        handler = SensorShadowHandler(MockShadowClient(), "bench", sensor, sensor, None, None)
+        handler.publisher.debounce = 3600
+        handler.set_state("active", True)
+        handler.set_state("settings", default_settings(sensor))
+        handlers.append(handler)
+    responses = [
+        UpdateShadowResponse(client_token="bench", state=ShadowState(
+            desired={"active": True, "settings": default_settings(h.sensor_name)}))
+        for h in handlers
+    ]
+
+    def call():
+        for handler, response in zip(handlers, responses):
+            handler.on_update_shadow_accepted(response)
+    return call
+
+
+CASES = {
+    "publish_full": case_publish_full,
+    "publish_diff": case_publish_diff,
+    "publish_unchanged": case_publish_unchanged,
+    "update_request": case_update_request,
+    "index_state": case_index_state,
+    "settings_compare": case_settings_compare,
+}
+
+
+def measure(call, repeat, min_time):
+    """Times call in batches sized to take at least min_time, then measures the peak memory
+    allocated during single calls with tracemalloc
+
+    Returns:
+        dict: calls, ns per call (min/median over repeats) and peak bytes per call
+    """
+    call()
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            call()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1 << 20:
+            break
+        loops *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    timings = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            call()
+        timings.append((time.perf_counter() - start) / loops)
+
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(loops, 20)):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        call()
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    return {
+        "calls": loops * repeat,
+        "ns_per_call": {
+            "min": min(timings) * 1e9,
+            "median": statistics.median(timings) * 1e9
+        },
+        "peak_bytes_per_call": statistics.median(peaks)
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints median time and memory change of each case against a previous run
+    """
+    previous = {(r["case"], r["sensors"]): r for r in baseline["results"]}
+    print(f"{'case':<20}{'sensors':>8}{'median us':>12}{'change':>9}{'peak KiB':>10}{'change':>9}")
+    for r in results:
+        old = previous.get((r["case"], r["sensors"]))
+        time_us = r["ns_per_call"]["median"] / 1000
+        peak = r["peak_bytes_per_call"] / 1024
+        time_change = peak_change = ""
+        if old:
+            time_change = f"{r['ns_per_call']['median'] / old['ns_per_call']['median'] - 1:+.0%}"
+            if old["peak_bytes_per_call"]:
+                peak_change = f"{r['peak_bytes_per_call'] / old['peak_bytes_per_call'] - 1:+.0%}"
+        print(f"{r['case']:<20}{r['sensors']:>8}{time_us:>12.1f}{time_change:>9}{peak:>10.1f}{peak_change:>9}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ShadowHandler micro-benchmarks")
+    parser.add_argument("--sensors", default="1,10,100,1000", help="comma separated sensor counts")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated cases to run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats per case")
+    parser.add_argument("--min-time", type=float, default=0.2, help="min seconds per timing repeat")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    counts = [int(c) for c in args.sensors.split(",")]
+    results = []
+    # Handlers print on every publish, keep that out of the terminal but in the measurement
+    with open(os.devnull, "w") as devnull:
+        for case in args.cases.split(","):
+            for count in counts:
+                with contextlib.redirect_stdout(devnull):
+                    result = measure(CASES[case](count), args.repeat, args.min_time)
+                results.append({"case": case, "sensors": count, **result})
+                print(f"{case} sensors={count}: {result['ns_per_call']['median'] / 1000:.1f}us/call, "
+                      f"{result['peak_bytes_per_call'] / 1024:.1f}KiB peak", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    elif not args.output:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,126 @@
+"""Throughput benchmark of the binary vibration frame codec. Encodes and decodes a synthetic
+three-axis vibration signal with every combination of encoding, delta encoding and
+compression, and reports encode/decode speed, frame size and error compared with JSON.
+
+Example:
+    python benchmarks/telemetry_codec.py --sample-rate 2000 --output telemetry_codec.json
+"""
+import argparse
+import platform
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "iot"))
+
+import numpy as np  # noqa: E402
+from Telemetry import encode_frame, decode_frame, COMPRESSIONS  # noqa: E402
+
+
+def signal(sample_rate, seconds, seed=0):
+    """Synthetic vibration: a few harmonics plus noise and gravity on z
+
+    Returns:
+        numpy.ndarray: float64 samples of shape (3, samples)
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    axes = []
+    for i, offset in enumerate((0.0, 0.0, 9.81)):
+        tone = sum(a * np.sin(2 * np.pi * f * t + i) for f, a in ((12.5, 0.2), (50, 0.05), (180, 0.01)))
+        axes.append(offset + tone + 0.002 * rng.standard_normal(len(t)))
+    return np.stack(axes)
+
+
+def json_size(axes, sample_rate):
+    """Size of the same samples as per-sample JSON rows with formatted timestamps
+    """
+    rows = [[f"2021-09-01 12:00:{i / sample_rate:09.6f}", *map(float, axes[:, i])]
+            for i in range(axes.shape[1])]
+    return len(json.dumps(rows, separators=(",", ":")))
+
+
+def available(compression):
+    if compression != "lz4":
+        return True
+    try:
+        import lz4.frame  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def measure(fn, min_time):
+    fn()
+    loops = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        loops += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / loops
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Vibration frame codec benchmark")
+    parser.add_argument("--sample-rate", type=float, default=2000, help="samples per second")
+    parser.add_argument("--frame-seconds", type=float, default=1, help="seconds of samples per frame")
+    parser.add_argument("--min-time", type=float, default=0.2, help="min seconds per measurement")
+    parser.add_argument("--output", help="write JSON results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    axes = signal(args.sample_rate, args.frame_seconds)
+    samples = axes.shape[1]
+    raw_bytes = axes.size * 8
+    baseline = json_size(axes, args.sample_rate)
+    interval_ns = int(round(1e9 / args.sample_rate))
+
+    results = []
+    for encoding in ("float32", "int16"):
+        for delta in (False, True):
+            for compression in COMPRESSIONS:
+                if not available(compression):
+                    continue
+                options = dict(encoding=encoding, delta=delta, compression=compression)
+                frame = encode_frame(axes, 0, interval_ns, **options)
+                decoded = decode_frame(frame).axes
+                encode_s = measure(lambda: encode_frame(axes, 0, interval_ns, **options), args.min_time)
+                decode_s = measure(lambda: decode_frame(frame), args.min_time)
+                results.append({
+                    **options,
+                    "frame_bytes": len(frame),
+                    "bytes_per_sample": len(frame) / samples,
+                    "ratio_vs_json": baseline / len(frame),
+                    "max_abs_error": float(np.max(np.abs(decoded - axes))),
+                    "encode_msamples_s": samples / encode_s / 1e6,
+                    "decode_msamples_s": samples / decode_s / 1e6,
+                    "encode_mb_s": raw_bytes / encode_s / 1e6
+                })
+                r = results[-1]
+                print(f"{encoding:<8} delta={str(delta):<5} {compression:<5} {r['frame_bytes']:>7}B "
+                      f"x{r['ratio_vs_json']:.0f} vs json  err={r['max_abs_error']:.1e}  "
+                      f"enc {r['encode_msamples_s']:.1f}M/s  dec {r['decode_msamples_s']:.1f}M/s",
+                      file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "numpy": np.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "sample_rate": args.sample_rate,
+            "samples_per_frame": samples,
+            "json_bytes": baseline
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import json
+import os
+
+from awscrt import mqtt
+
+from OutputFiles import OutputFile, get_setting
+from OfflineQueue import OfflineQueue, TELEMETRY
+from Reader import read_samples, AXES
+
+# Publish vibration summaries of finished output files over MQTT
+ANALYTICS_ENABLED = os.environ.get("ANALYTICS_ENABLED", "false").lower() == "true"
+# Length of each summary window in seconds
+ANALYTICS_WINDOW = float(os.environ.get("ANALYTICS_WINDOW", 10))
+# Edges of FFT bands in Hz. Last band always extends to the Nyquist frequency
+ANALYTICS_BANDS = [float(b) for b in os.environ.get(
+    "ANALYTICS_BANDS", "0,5,10,25,50,100,250").split(",")]
+
+
+def telemetry_topic(thing, sensor_id):
+    return f"snsrpi/{thing}/telemetry/{sensor_id}"
+
+
+def summarise(values, sample_rate, window=ANALYTICS_WINDOW, bands=ANALYTICS_BANDS):
+    """Computes RMS, peak, crest factor and FFT band energies for each window of a signal.
+    The mean of each window is removed first so gravity/offsets don't dominate. Band energies
+    are mean square acceleration per band, so they sum to the RMS squared
+
+    Args:
+        values (numpy.ndarray): samples
+        sample_rate (float): samples per second
+        window (float, optional): Window length in seconds. Defaults to ANALYTICS_WINDOW.
+        bands (list, optional): Band edges in Hz. Defaults to ANALYTICS_BANDS.
+
+    Returns:
+        dict: lists of rms, peak, crest and bands (one list of band energies per window)
+    """
+    import numpy as np
+
+    n = max(1, min(int(window * sample_rate), len(values)))
+    count = len(values) // n
+    frames = values[:count * n].reshape(count, n)
+    frames = frames - frames.mean(axis=1, keepdims=True)
+
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    peak = np.max(np.abs(frames), axis=1)
+    crest = np.divide(peak, rms, out=np.zeros_like(peak), where=rms > 0)
+
+    # One-sided power spectrum scaled so the sum over all bins equals the mean square
+    power = np.abs(np.fft.rfft(frames, axis=1)) ** 2 / n ** 2
+    power[:, 1:(n + 1) // 2] *= 2
+    freqs = np.fft.rfftfreq(n, d=1.0 / sample_rate)
+    edges = list(bands) + [np.inf]
+    band_index = np.digitize(freqs, edges) - 1
+    band_energy = np.stack([
+        power[:, band_index == b].sum(axis=1) for b in range(len(bands))], axis=1)
+
+    return {
+        "rms": rms.tolist(),
+        "peak": peak.tolist(),
+        "crest": crest.tolist(),
+        "bands": band_energy.tolist()
+    }
+
+
+def round_floats(value, digits=5):
+    """Rounds floats in nested lists/dicts to keep payloads small
+    """
+    if isinstance(value, float):
+        return float(f"{value:.{digits}g}")
+    if isinstance(value, list):
+        return [round_floats(v, digits) for v in value]
+    if isinstance(value, dict):
+        return {k: round_floats(v, digits) for k, v in value.items()}
+    return value
+
+
+class EdgeAnalytics:
+    """Computes vibration summaries for each finished output file and publishes them to a
+    per-sensor telemetry topic, so vibration levels can be monitored without pulling files
+    """
+
+    def __init__(self, thing, get_settings, mqtt_connection=None, outbox: OfflineQueue = None,
+                 max_workers=1, extensions=("csv", "feather")) -> None:
+        """
+        Args:
+            thing (str): thing name, used in the telemetry topic
+            get_settings (callable): returns dict of sensor_id -> current sensor settings
+            mqtt_connection (mqtt.Connection, optional): connection to publish on. Can be set later. Defaults to None.
+            outbox (OfflineQueue, optional): queue for telemetry while offline. Defaults to None.
+            max_workers (int, optional): Files analysed in parallel. Defaults to 1.
+            extensions (tuple, optional): File types to analyse. Defaults to ("csv", "feather").
+        """
+        self.thing = thing
+        self.get_settings = get_settings
+        self.mqtt = mqtt_connection
+        self.outbox = outbox
+        self.extensions = extensions
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="analytics")
+
+    def on_file(self, output_file: OutputFile):
+        """File watcher listener. Queues file for analysis
+        """
+        if output_file.ext in self.extensions:
+            self.executor.submit(self.process, output_file)
+
+    def sample_rate(self, sensor_id):
+        settings = self.get_settings().get(sensor_id) or {}
+        return get_setting(settings, "Sample_rate")
+
+    def offline_mode(self, sensor_id):
+        """Sensors in Offline_mode don't publish telemetry live. It is stored in the offline
+        queue and forwarded by the rate limited drain instead
+        """
+        settings = self.get_settings().get(sensor_id) or {}
+        return bool(get_setting(settings, "Offline_mode"))
+
+    def analyse(self, output_file: OutputFile, sample_rate):
+        """
+        Returns:
+            dict: telemetry message for file
+        """
+        _, samples = read_samples(output_file.path)
+        axes = dict(zip(AXES, samples))
+        return {
+            "sensor_id": output_file.sensor_id,
+            "file": output_file.name,
+            "start": output_file.start.isoformat(),
+            "sample_rate": sample_rate,
+            "samples": len(axes["accel_x"]),
+            "window_s": ANALYTICS_WINDOW,
+            "bands_hz": ANALYTICS_BANDS,
+            "axes": {a.split("_")[1]: round_floats(summarise(v, sample_rate)) for a, v in axes.items()}
+        }
+
+    def process(self, output_file: OutputFile):
+        sample_rate = self.sample_rate(output_file.sensor_id)
+        if not sample_rate:
+            logging.error(
+                f"{output_file.sensor_id}:Unknown sample rate, skipping analysis of {output_file.name}")
+            return
+        try:
+            message = self.analyse(output_file, sample_rate)
+            self.publish(output_file.sensor_id, message)
+        except Exception as e:
+            logging.error(f"{output_file.sensor_id}:Analysis of {output_file.name} failed")
+            logging.error(e)
+
+    def publish(self, sensor_id, message):
+        topic = telemetry_topic(self.thing, sensor_id)
+        payload = json.dumps(message, separators=(",", ":"))
+        if self.outbox is not None and (not self.outbox.online or self.offline_mode(sensor_id)):
+            self.outbox.append(TELEMETRY, topic, {"topic": topic, "payload": payload})
+            if self.outbox.online:
+                self.outbox.start_drain()
+            return
+        if self.mqtt is None:
+            return
+        future, _ = self.mqtt.publish(
+            topic=topic, payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE)
+        future.add_done_callback(lambda f: self.on_publish(f, topic, payload))
+
+    def on_publish(self, future, topic, payload):
+        try:
+            future.result()
+            print(f"Telemetry published to {topic}")
+        except Exception as e:
+            logging.error(f"Telemetry publish to {topic} failed")
+            logging.error(e)
+            if self.outbox is not None:
+                self.outbox.append(TELEMETRY, topic, {"topic": topic, "payload": payload})
+
+    def stop(self, wait=False):
+        self.executor.shutdown(wait=wait)
@@ -1,17 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor, Future
 import json
 import os
-from awsiot.iotshadow import IotShadowClient
-import requests
+from awsiot.iotshadow import IotShadowClient, DeleteNamedShadowRequest
 import threading
 import logging
 import time
 from awscrt import io, mqtt, auth, http
-from requests.api import request
 from Auth import Auth
-from ShadowHandler import GlobalShadowHandler
+from DeviceApi import DeviceApiClient
+from Dispatcher import Dispatcher
+from Uploader import FileUploader
+from FileLedger import FileLedger, LEDGER_PATH
+from FileWatcher import FileWatcher
+from Transcoder import Transcoder, TRANSCODE_CSV
+from Analytics import EdgeAnalytics, ANALYTICS_ENABLED
+from Telemetry import TelemetryStreamer, STREAM_TELEMETRY
+from Retention import RetentionManager, RETENTION_INTERVAL
+from TimeIndex import TimeIndex, RangeQueryService, RANGE_QUERIES
+from Pyramid import PyramidBuilder, PYRAMID_ENABLED
+from OfflineQueue import OfflineQueue, SHADOW, TELEMETRY, OFFLINE_QUEUE_DIR
+from PublishQueue import OutboundPublisher, STATE, HEARTBEAT, TELEMETRY as TELEMETRY_PRIORITY
+from Scheduler import Scheduler
+from Metrics import REGISTRY, MetricsServer, METRICS_PORT, METRICS_INTERVAL, metrics_topic
+from ShadowHandler import GlobalShadowHandler, SensorShadowHandler
+from SettingsCache import SettingsCache
+from ShadowSnapshot import ShadowSnapshot, WARM_RESTART, SHADOW_SNAPSHOT_PATH
+from OutputFiles import OUTPUT_DATA_DIR
 
-DEVICE_ENDPOINT = os.environ["DEVICE_ENDPOINT"]
-DEVICE_NAME = os.environ["DEVICE_NAME"]
+# Not set in gateway mode, where each device is configured through GATEWAY_DEVICES
+DEVICE_ENDPOINT = os.environ.get("DEVICE_ENDPOINT")
+DEVICE_NAME = os.environ.get("DEVICE_NAME")
+
+# Heartbeat interval (seconds) after a change. Backs off up to the max interval while state is stable
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 10))
+HEARTBEAT_MAX_INTERVAL = float(os.environ.get("HEARTBEAT_MAX_INTERVAL", 60))
+# Heartbeat interval (seconds) for HEARTBEAT_BOOST_DURATION seconds after a command
+HEARTBEAT_FAST_INTERVAL = float(os.environ.get("HEARTBEAT_FAST_INTERVAL", 5))
+HEARTBEAT_BOOST_DURATION = float(os.environ.get("HEARTBEAT_BOOST_DURATION", 30))
+# Random +/- fraction applied to each heartbeat interval
+HEARTBEAT_JITTER = float(os.environ.get("HEARTBEAT_JITTER", 0.1))
 
 
 class Device:
@@ -19,17 +46,102 @@ class Device:
     are abstracted away through this class
     """
 
-    def __init__(self, device_name, device_endpoint) -> None:
+    def __init__(self, device_name, device_endpoint, dispatcher: Dispatcher = None, scheduler: Scheduler = None,
+                 data_dir=None, outbound: OutboundPublisher = None) -> None:
+        """
+        Args:
+            device_name (str): thing name
+            device_endpoint (str): host:port of the snsrpi API
+            dispatcher (Dispatcher, optional): Shared callback dispatcher (gateway mode). Defaults to None (own dispatcher).
+            scheduler (Scheduler, optional): Shared scheduler (gateway mode). Process wide metrics are left to its owner. Defaults to None (own scheduler).
+            data_dir (str, optional): Output directory of this device, holding its ledger, offline queue and shadow snapshot. Defaults to None (OUTPUT_DATA_DIR and configured paths).
+            outbound (OutboundPublisher, optional): Shared rate limited publisher of the MQTT connection (gateway mode). Defaults to None (own publisher).
+        """
         self.auth = Auth()
         self.name = device_name
         self.mqtt = None
         self.device_endpoint = device_endpoint
-        self.heartbeat_thread = threading.Thread(
-            target=self.heartbeat, name="health", kwargs={"timer": 10})
-        self.disable_heartbeat_event = threading.Event()
+        self.api = DeviceApiClient(device_endpoint)
+        self.dispatcher = dispatcher or Dispatcher()
+        # All publishes go through one priority queue per connection, within its rate limit
+        self.outbound = outbound or OutboundPublisher()
+        self.settings_cache = SettingsCache()
+        # In gateway mode each device keeps its state in its own data directory
+        self.data_dir = data_dir or OUTPUT_DATA_DIR
+        # Shadows are kept on shutdown and reconciled on startup rather than deleted and recreated
+        self.snapshot = ShadowSnapshot(
+            self.name, os.path.join(data_dir, ".iot_shadows.json") if data_dir else SHADOW_SNAPSHOT_PATH
+        ) if WARM_RESTART else None
+        self.outbox = OfflineQueue(os.path.join(data_dir, ".iot_outbox") if data_dir else OFFLINE_QUEUE_DIR)
+        self.file_ledger = FileLedger(os.path.join(data_dir, ".iot_ledger.db") if data_dir else LEDGER_PATH)
+        self.file_watcher = FileWatcher(self.file_ledger, self.data_dir)
+        self.retention = RetentionManager(self.file_ledger, self.data_dir)
+        # When transcoding, csv files are converted to feather and only the feather files uploaded
+        self.transcoder = Transcoder(self.file_ledger) if TRANSCODE_CSV else None
+        self.pyramids = PyramidBuilder(
+            self.file_ledger,
+            extensions=("feather",) if TRANSCODE_CSV else ("csv", "feather")) if PYRAMID_ENABLED else None
+        self.time_index = TimeIndex(self.file_ledger) if RANGE_QUERIES else None
+        self.range_queries = RangeQueryService(
+            self.name, self.time_index, outbox=self.outbox, pyramids=self.pyramids) if RANGE_QUERIES else None
+        self.uploader = FileUploader(
+            self.upload_settings, self.file_ledger,
+            extensions=("feather",) if TRANSCODE_CSV else ("csv", "feather"))
+        self.analytics = EdgeAnalytics(
+            self.name, self.upload_settings, outbox=self.outbox,
+            extensions=("feather",) if TRANSCODE_CSV else ("csv", "feather")) if ANALYTICS_ENABLED else None
+        self.streamer = TelemetryStreamer(
+            self.name, self.upload_settings, outbox=self.outbox,
+            extensions=("feather",) if TRANSCODE_CSV else ("csv", "feather")) if STREAM_TELEMETRY else None
+        self.file_watcher.add_listener(self.retention.on_file)
+        if self.time_index:
+            self.file_watcher.add_listener(self.time_index.on_file)
+        if self.transcoder:
+            self.file_watcher.add_listener(self.transcoder.on_file)
+        self.file_watcher.add_listener(self.uploader.on_file)
+        if self.analytics:
+            self.file_watcher.add_listener(self.analytics.on_file)
+        if self.streamer:
+            self.file_watcher.add_listener(self.streamer.on_file)
+        if self.pyramids:
+            self.file_watcher.add_listener(self.pyramids.on_file)
+        # Periodic tasks. Jitter is seeded by device name so devices in a fleet stay spread out.
+        # Tasks on a shared scheduler are prefixed with the device name
+        self.shared_scheduler = scheduler is not None
+        self.scheduler = scheduler or Scheduler(name="scheduler", seed=self.name)
+        self.task_prefix = f"{self.name}/" if self.shared_scheduler else ""
+        self.tasks = []
+        self.add_task(
+            "heartbeat", self.get_healthcheck, HEARTBEAT_INTERVAL,
+            max_interval=HEARTBEAT_MAX_INTERVAL, backoff=1.5,
+            fast_interval=HEARTBEAT_FAST_INTERVAL, jitter=HEARTBEAT_JITTER)
+        self.add_task("retention", self.enforce_retention, RETENTION_INTERVAL)
+        # Operate/settings calls invalidate the health snapshot, poll faster to pick up the result
+        self.api.health_cache.add_listener(
+            lambda: self.scheduler.boost(self.task_prefix + "heartbeat", HEARTBEAT_BOOST_DURATION))
+        self.metrics_server = None
+        if not self.shared_scheduler:
+            self.add_task("dispatch-stats", self.log_dispatch_stats, 60)
+            if METRICS_INTERVAL > 0:
+                self.add_task("metrics", self.publish_metrics, METRICS_INTERVAL)
+            self.metrics_server = MetricsServer() if METRICS_PORT else None
+            REGISTRY.gauge("dispatcher_pending", "Shadow callbacks waiting to run",
+                           lambda: self.dispatcher.stats()["pending"])
+            REGISTRY.gauge("offline_queue_bytes", "Bytes of messages stored in the offline queue",
+                           self.outbox.size)
+            REGISTRY.gauge("offline_queue_dropped_segments", "Offline queue segments dropped as queue was full",
+                           lambda: self.outbox.dropped)
+            REGISTRY.gauge("outbound_queue_depth", "Outbound publishes waiting for the rate limiter",
+                           lambda: sum(self.outbound.stats()["queued"].values()))
+            REGISTRY.gauge("outbound_inflight", "Outbound publishes sent and not yet acknowledged",
+                           lambda: self.outbound.stats()["inflight"])
+        self.health_lock = threading.Lock()
+        self.health_version = 0  # Version of last health snapshot applied to global shadow
+        self.last_health = None
 
         self.global_shadow = None
         self.sensor_shadows = []
+        self.outbox.register(SHADOW, self.resync_shadow)
 
     def set_global_shadow(self, shadow_client: IotShadowClient):
         """Sets global shadow after instantiation of class
@@ -38,26 +150,233 @@ class Device:
             shadow_client (IotShadowClient): AWS shadow client, created in main.py
         """
         self.global_shadow = GlobalShadowHandler(
-            shadow_client, self.name, "global", self.device_endpoint, self.get_healthcheck)
+            shadow_client, self.name, "global", self.api, self.get_healthcheck,
+            dispatcher=self.dispatcher, outbox=self.outbox, outbound=self.outbound)
+
+    def create_sensor_shadows(self, shadow_client: IotShadowClient, max_workers=8):
+        """Creates a shadow handler for each sensor in global state. Subscriptions for all
+        sensors are set up concurrently, then initial settings are fetched concurrently before
+        publishing initial state
+
+        Args:
+            shadow_client (IotShadowClient): AWS shadow client, created in main.py
+            max_workers (int, optional): Max sensors to subscribe concurrently. Defaults to 8.
+        """
+        sensors = self.global_shadow.local_state['sensors']
+        self.delete_stale_shadows(shadow_client, [s['sensor_id'] for s in sensors])
+        if not sensors:
+            return
+
+        def create(sensor):
+            id = sensor['sensor_id']
+            shadow = SensorShadowHandler(
+                shadow_client, self.name, id, id, self.api, self.get_healthcheck,
+                dispatcher=self.dispatcher, outbox=self.outbox, settings_cache=self.settings_cache,
+                outbound=self.outbound
+            )
+            shadow.set_state('active', sensor['active'])
+            return shadow
+
+        phase = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(sensors))) as pool:
+            shadows = list(pool.map(create, sensors))
+        print(
+            f"Startup: subscribed {len(shadows)} sensor shadows in {time.monotonic() - phase:.2f}s")
+
+        phase = time.monotonic()
+        results = self.api.run_concurrently(
+            [(s.get_or_update_sensor_settings, ()) for s in shadows])
+        for shadow, result in zip(shadows, results):
+            if isinstance(result, Exception) or result['error']:
+                print(f'failed to get initial settings of sensor {shadow.sensor_name}')
+                entry = self.snapshot.get(shadow.sensor_name) if self.snapshot else None
+                if entry and entry['local_state'].get('settings'):
+                    # Settings from before the restart are better than none for file processing
+                    shadow.set_state('settings', entry['local_state']['settings'])
+        print(
+            f"Startup: fetched settings for {len(shadows)} sensors in {time.monotonic() - phase:.2f}s")
+
+        # Need to call update state outside of the MQTT event-loop thread otherwise we risk creating thread
+        # dead-lock and the program hangs. Subscription callbacks run on the device dispatcher for this reason
+        for shadow in shadows:
+            self.global_shadow.register_sensor(shadow)
+        self.sensor_shadows.extend(shadows)
+        if self.snapshot and self.snapshot.shadows:
+            # Shadow gets wait on responses, reconcile sensors concurrently
+            phase = time.monotonic()
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(shadows))) as pool:
+                list(pool.map(self.sync_shadow, shadows))
+            print(
+                f"Startup: reconciled {len(shadows)} sensor shadows in {time.monotonic() - phase:.2f}s")
+        else:
+            for shadow in shadows:
+                self.sync_shadow(shadow)
+
+    def load_snapshot(self):
+        """Loads shadow snapshot of the last shutdown if warm restarts are enabled
+
+        Returns:
+            bool: True if shadows will be reconciled rather than recreated
+        """
+        return bool(self.snapshot and self.snapshot.load())
+
+    def sync_shadow(self, shadow, apply=True):
+        """Publishes initial state of a shadow. After a warm restart only the differences with
+        the cloud shadow are published and desired state changed while the agent was down is
+        applied, otherwise the full state replaces desired and reported state of the shadow
+
+        Args:
+            shadow (ShadowHandler): shadow handler
+            apply (bool, optional): If False, desired state changed while down is returned instead of applied. Defaults to True.
 
-    def set_mqtt(self, mqtt):
+        Returns:
+            dict: desired state changed while down, if not applied
+        """
+        if not (self.snapshot and self.snapshot.shadows):
+            shadow.update_state(override_desired=True)
+            return None
+        desired = shadow.reconcile(
+            self.snapshot.get(shadow.shadow_request['shadow_name']), self.snapshot.saved_at)
+        if desired and apply:
+            shadow.apply_desired(desired)
+            return None
+        return desired
+
+    def delete_stale_shadows(self, shadow_client: IotShadowClient, sensor_ids):
+        """Deletes shadows kept from before a warm restart of sensors the device no longer has
+
+        Args:
+            shadow_client (IotShadowClient): AWS shadow client, created in main.py
+            sensor_ids (list): current sensor ids
+        """
+        if not self.snapshot:
+            return
+        for name in self.snapshot.shadows.keys() - set(sensor_ids) - {"global"}:
+            print(f"Deleting shadow of removed sensor {name}")
+            try:
+                self.outbound.submit(STATE, lambda name=name: shadow_client.publish_delete_named_shadow(
+                    request=DeleteNamedShadowRequest(thing_name=self.name, shadow_name=name),
+                    qos=mqtt.QoS.AT_LEAST_ONCE), name=name)
+            except Exception as e:
+                logging.error(f"Deleting shadow {name} failed")
+                logging.error(e)
+
+    def resync_shadow(self, body, timeout=10):
+        """Offline queue publisher of shadow updates. A queued update is a diff against the
+        state reported before the outage, so publishing it as is could land after, and roll
+        back, newer live updates. Instead the shadow's handler publishes its full current state
+        through its own publish queue, in order with live updates. Updates of shadows without
+        a handler were queued before a restart and are dropped, as startup publishes every
+        shadow anyway
+
+        Args:
+            body (dict): queued update
+            timeout (float, optional): Max seconds to wait for the publish. Defaults to 10.
+
+        Returns:
+            Future: resolved once the shadow is in sync, failed if the publish failed
+        """
+        future = Future()
+        handlers = [self.global_shadow, *self.sensor_shadows]
+        handler = next((h for h in handlers
+                        if h is not None and h.shadow_request['shadow_name'] == body["shadow_name"]), None)
+        if handler is None:
+            print(f"{body['shadow_name']}:Dropping update queued before restart")
+            future.set_result(None)
+        elif handler.resync(override_desired=body.get("desired") is not None, timeout=timeout):
+            future.set_result(None)
+        else:
+            future.set_exception(RuntimeError(f"Resync of shadow {body['shadow_name']} failed"))
+        return future
+
+    def upload_settings(self):
+        """Current settings of each sensor, used by file processing stages (e.g. upload endpoints,
+        sample rates for analytics)
+
+        Returns:
+            dict: sensor_id -> settings
+        """
+        return {s.sensor_name: s.local_state['settings'] for s in self.sensor_shadows}
+
+    def set_mqtt(self, mqtt_connection):
         """Setts MQTT connection after instantiation
 
         Args:
-            mqtt (mqtt_connection_builder): AWS mqtt builder object
+            mqtt_connection (mqtt_connection_builder): AWS mqtt builder object
+        """
+        self.mqtt = mqtt_connection
+        # Telemetry and query responses are sent at the lowest priority. Streams wait for
+        # room in the outbound queue rather than having chunks dropped
+        if self.analytics:
+            self.analytics.mqtt = self.outbound.connection(mqtt_connection, TELEMETRY_PRIORITY)
+        if self.streamer:
+            self.streamer.mqtt = self.outbound.connection(mqtt_connection, TELEMETRY_PRIORITY, block=True)
+        if self.range_queries:
+            self.range_queries.mqtt = self.outbound.connection(mqtt_connection, TELEMETRY_PRIORITY)
+        self.outbox.register(TELEMETRY, lambda body: self.outbound.submit(
+            TELEMETRY_PRIORITY, lambda: mqtt_connection.publish(
+                topic=body["topic"], payload=body["payload"], qos=mqtt.QoS.AT_LEAST_ONCE)[0],
+            name=body["topic"]))
+
+    def set_online(self, online):
+        """Updates MQTT connection state. While offline, shadow updates and telemetry are
+        stored in the offline queue, which is drained once back online
+
+        Args:
+            online (bool): Whether the MQTT connection is up
         """
-        self.mqtt = mqtt
+        self.outbox.set_online(online)
+
+    def add_task(self, name, fn, interval, **kwargs):
+        """Adds periodic task of this device to the scheduler. See PeriodicTask for options
+        """
+        self.tasks.append(self.task_prefix + name)
+        return self.scheduler.add(self.task_prefix + name, fn, interval, **kwargs)
 
     def enable_heartbeat(self):
-        """Starts heartbeat thread to send periodic state updates
+        """Starts scheduler running the heartbeat and other periodic tasks
         """
-        self.disable_heartbeat_event.clear()
-        self.heartbeat_thread.start()
+        self.resume_heartbeat()
+        self.scheduler.start()
 
     def disable_heartbeat(self):
-        """Disables heartbeat thread
+        """Stops scheduler. Returns immediately unless a heartbeat is in progress. On a shared
+        scheduler only this device's tasks are removed
+        """
+        if not self.shared_scheduler:
+            self.scheduler.stop()
+            return
+        for name in self.tasks:
+            self.scheduler.remove(name)
+
+    def pause_heartbeat(self):
+        """Pauses periodic tasks without stopping the scheduler thread
         """
-        self.disable_heartbeat_event.set()
+        if not self.shared_scheduler:
+            self.scheduler.pause()
+            return
+        for name in self.tasks:
+            self.scheduler.pause(name)
+
+    def resume_heartbeat(self):
+        if not self.shared_scheduler:
+            self.scheduler.resume()
+            return
+        for name in self.tasks:
+            self.scheduler.resume(name)
+
+    def save_shadows(self, timeout=5):
+        """Used for graceful exit with warm restarts. Disables heartbeat, publishes pending
+        updates and saves a snapshot of all shadow handlers, leaving the shadows in place
+
+        Args:
+            timeout (float, optional): Max seconds to wait for pending updates per shadow. Defaults to 5.
+        """
+        self.disable_heartbeat()
+        handlers = [self.global_shadow, *self.sensor_shadows]
+        for shadow in handlers:
+            shadow.flush_updates(timeout)
+        self.snapshot.save(handlers)
 
     def delete_shadows(self):
         """Used for graceful exit. Disables heartbeat and deletes all shadows associated with
@@ -68,39 +387,62 @@ class Device:
         for s in self.sensor_shadows:
             s.delete_shadow()
 
-    def heartbeat(self, timer=60):
-        """Periodically checks the snsrpi/api/health endpoint for device state
-        and updates global shadow
+    def publish_metrics(self):
+        """Publishes snapshot of all metrics to the metrics topic. Skipped while offline as
+        metrics are only of interest while current
+        """
+        if self.mqtt is None or not self.outbox.online:
+            return
+        payload = json.dumps({
+            "thing": self.name,
+            "timestamp": time.time(),
+            "metrics": REGISTRY.snapshot()
+        }, separators=(",", ":"))
+        self.outbound.submit(TELEMETRY_PRIORITY, lambda: self.mqtt.publish(
+            topic=metrics_topic(self.name), payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE)[0],
+            name=metrics_topic(self.name))
 
-        Args:
-            timer (int, optional): Time interval between heartbeats. Defaults to 60.
+    def enforce_retention(self):
+        """Deletes output files to stay within the retention limits and reports storage
+        headroom in the global shadow. Run periodically by the scheduler
         """
-        while not self.disable_heartbeat_event.is_set():
-            self.get_healthcheck()
-            time.sleep(timer)
+        report = self.retention.enforce()
+        if self.global_shadow is None:
+            return
+        if report != self.global_shadow.local_state.get("storage"):
+            self.global_shadow.set_state({"storage": report})
+            self.global_shadow.update_state()
 
-    def get_healthcheck(self):
-        """Hits snsrpi/api/health for device state and updates state
+    def log_dispatch_stats(self):
+        """Logs callback backlog of dispatcher so slow shadow callbacks are visible
         """
-        url = f"http://{self.device_endpoint}/api/health"
-        logging.info(f"Getting heartbeat from {url}...")
+        stats = self.dispatcher.stats()
+        logging.info(
+            f"Dispatcher: pending={stats['pending']} processed={stats['processed']} "
+            f"dropped={stats['dropped']} avg_wait={stats['avg_wait_ms']:.1f}ms "
+            f"max_wait={stats['max_wait_ms']:.1f}ms depths={stats['queue_depths']}")
 
+    def get_healthcheck(self):
+        """Gets device state from the shared health cache (snsrpi/api/health) and updates global
+        state if the snapshot is new. Run periodically by the scheduler as the heartbeat
+
+        Returns:
+            bool: True if device state changed, used by the scheduler to adapt the interval
+        """
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            result = response.json()
+            result, version = self.api.get_cached_health()
+            # Snapshot already applied by another caller within the cache TTL
+            with self.health_lock:
+                if version == self.health_version:
+                    return False
+                self.health_version = version
+                changed = result != self.last_health
+                self.last_health = result
             self.global_shadow.set_state(result)
-            self.global_shadow.update_state()
+            self.global_shadow.update_state(priority=HEARTBEAT)
+            return changed
         except Exception as e:
             logging.error("Heartbeat failed")
             print("Error: ", e)
 
-        return
-
-
-if __name__ == "__main__":
-    DEVICE_ENDPOINT = "localhost:5000"
-    DEVICE_NAME = "tst-device"
-
-    device = Device(DEVICE_NAME, DEVICE_ENDPOINT)
-    resp = device.get_healthcheck()
+        return False
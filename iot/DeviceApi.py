@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from HealthCache import HealthCache, HEALTH_CACHE_TTL
+from Metrics import REGISTRY
+
+# (connect, read) timeouts in seconds. The snsrpi API is on the same host so connecting
+# should be near instant, reads can take a little longer while a sensor is starting
+DEFAULT_TIMEOUT = (3.05, 10)
+
+API_REQUESTS = REGISTRY.counter(
+    "device_api_requests_total", "snsrpi API requests by result status", ("method", "route", "status"))
+API_REQUEST_SECONDS = REGISTRY.histogram(
+    "device_api_request_seconds", "snsrpi API request latency including retries", ("method", "route"))
+
+
+def api_route(path):
+    """Replaces sensor id in api path with a placeholder so metrics aren't split per sensor
+
+    Args:
+        path (str): api path, e.g. /api/devices/CX1_1901
+
+    Returns:
+        str: route, e.g. /api/devices/{id}
+    """
+    parts = path.split("/")
+    if len(parts) == 4 and parts[2] in ("devices", "settings"):
+        return "/".join(parts[:3] + ["{id}"])
+    return path
+
+
+class DeviceApiClient:
+    """Shared client for the snsrpi REST API. Keeps a pooled keep-alive session so
+    heartbeats, operate and settings calls reuse connections instead of opening a new
+    one per request. Every call has a timeout and is retried with backoff on connection
+    errors and 5xx responses
+    """
+
+    def __init__(self, endpoint, timeout=DEFAULT_TIMEOUT, retries=3, backoff=0.3, pool_size=8,
+                 health_ttl=HEALTH_CACHE_TTL) -> None:
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.health_cache = HealthCache(self.get_health, ttl=health_ttl)
+
+        # Device operations are idempotent (set active/replace settings), so it's safe to
+        # retry POST/PUT as well as GET
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST", "PUT"]),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="device-api")
+
+    def url(self, path):
+        """Builds full url for an api path
+
+        Args:
+            path (str): api path, e.g. /api/health
+
+        Returns:
+            str: full url
+        """
+        return f"http://{self.endpoint}{path}"
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """Sends request to the snsrpi API through the pooled session
+
+        Args:
+            method (str): HTTP method
+            path (str): api path, e.g. /api/health
+            timeout (float|tuple, optional): Per call timeout. Defaults to client timeout.
+
+        Raises:
+            requests.RequestException: if request fails after all retries or returns an error status
+
+        Returns:
+            dict: JSON response body, or None if response is empty
+        """
+        url = self.url(path)
+        route = api_route(path)
+        start = time.perf_counter()
+        try:
+            resp = self.session.request(
+                method=method, url=url, timeout=timeout or self.timeout, **kwargs)
+        except requests.RequestException:
+            API_REQUESTS.inc(method=method, route=route, status="error")
+            raise
+        finally:
+            API_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method, route=route)
+        API_REQUESTS.inc(method=method, route=route, status=resp.status_code)
+        resp.raise_for_status()
+        if not resp.content:
+            return None
+        return resp.json()
+
+    def get_health(self, timeout=None):
+        """GET /api/health
+
+        Returns:
+            dict: device health, containing device_id and sensors
+        """
+        logging.info(f"Getting heartbeat from {self.url('/api/health')}...")
+        return self.request("GET", "/api/health", timeout=timeout)
+
+    def get_cached_health(self, max_age=None):
+        """Health snapshot shared by all callers. Only one /api/health request is made per TTL
+        however many handlers ask for it concurrently
+
+        Args:
+            max_age (float, optional): Override cache TTL for this call. Defaults to None.
+
+        Returns:
+            tuple: (device health, snapshot version)
+        """
+        return self.health_cache.get(max_age)
+
+    def wait_until_ready(self, timeout=120, initial_delay=0.25, max_delay=5.0):
+        """Polls /api/health until the snsrpi API responds, backing off exponentially between
+        attempts. Used on startup instead of a fixed sleep
+
+        Args:
+            timeout (float, optional): Max seconds to wait. Defaults to 120.
+            initial_delay (float, optional): Delay after first failed attempt. Defaults to 0.25.
+            max_delay (float, optional): Max delay between attempts. Defaults to 5.0.
+
+        Raises:
+            TimeoutError: if API is not ready within timeout
+
+        Returns:
+            dict: first successful health response
+        """
+        deadline = time.monotonic() + timeout
+        delay = initial_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self.get_health(timeout=(1, 3))
+            except Exception as e:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"snsrpi API at {self.endpoint} not ready after {attempt} attempts") from e
+                logging.info(
+                    f"snsrpi API not ready (attempt {attempt}), retrying in {delay:.2f}s")
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, max_delay)
+
+    def operate_device(self, sensor_id, active: bool, timeout=None):
+        """POST /api/devices/{id}?active={bool}. Starts/stops sensor
+
+        Args:
+            sensor_id (str): sensor id
+            active (bool): Whether the sensor should be running or not
+        """
+        try:
+            return self.request("POST", f"/api/devices/{sensor_id}", timeout=timeout,
+                                params={"active": active})
+        finally:
+            # Sensor state has (possibly) changed, next health check must hit the API
+            self.health_cache.invalidate()
+
+    def get_settings(self, sensor_id, timeout=None):
+        """GET /api/settings/{id}
+
+        Returns:
+            dict: sensor settings
+        """
+        return self.request("GET", f"/api/settings/{sensor_id}", timeout=timeout)
+
+    def update_settings(self, sensor_id, settings, timeout=None):
+        """PUT /api/settings/{id}. Replaces settings of sensor in full
+
+        Args:
+            sensor_id (str): sensor id
+            settings (dict): new settings
+
+        Returns:
+            dict: updated settings
+        """
+        try:
+            return self.request("PUT", f"/api/settings/{sensor_id}", timeout=timeout, json=settings)
+        finally:
+            self.health_cache.invalidate()
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs a call on the client's worker pool
+
+        Args:
+            fn (callable): function to run, typically one of the api methods
+
+        Returns:
+            Future: future for result
+        """
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def run_concurrently(self, calls):
+        """Runs several calls concurrently and waits for all of them
+
+        Args:
+            calls (list): list of (fn, args) tuples
+
+        Returns:
+            list: result of each call in same order as calls. Failed calls return the raised exception
+        """
+        futures = [self.submit(fn, *args) for fn, args in calls]
+        results = []
+        for f in futures:
+            try:
+                results.append(f.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        """Shuts down worker pool and closes pooled connections
+        """
+        self.executor.shutdown(wait=False)
+        self.session.close()
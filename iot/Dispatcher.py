@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import logging
+import time
+
+
+class Dispatcher:
+    """Runs shadow callbacks on a bounded worker pool instead of the MQTT event-loop thread.
+    Callbacks are queued per key (typically the shadow name) so messages for the same sensor
+    run in order, while different sensors are processed in parallel. With max_per_group,
+    keys of the form "group/name" (e.g. thing/shadow) are limited to that many workers per
+    group, so one group blocking on a slow endpoint can't occupy the whole pool
+    """
+
+    def __init__(self, max_workers=4, max_pending=1000, max_per_group=None) -> None:
+        self.max_pending = max_pending
+        self.max_per_group = max_per_group
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="dispatch")
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.queues = {}  # key -> deque of (enqueue time, fn, args, kwargs)
+        self.running = set()  # keys that currently have a drain task scheduled or are parked
+        self.pending = 0
+        self.group_running = {}  # group -> number of drain tasks scheduled
+        self.parked = {}  # group -> deque of keys waiting for a free slot of their group
+
+        # Stats
+        self.processed = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queues fn to run after any earlier work for the same key
+
+        Args:
+            key (str): ordering key, e.g. shadow name
+            fn (callable): function to run
+
+        Returns:
+            bool: True if queued, False if dropped because the queue is full
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.dropped += 1
+                logging.error(
+                    f"Dispatch queue full ({self.pending}). Dropping message for {key}")
+                return False
+
+            queue = self.queues.setdefault(key, deque())
+            queue.append((time.monotonic(), fn, args, kwargs))
+            self.pending += 1
+
+            if key not in self.running:
+                try:
+                    self._schedule(key)
+                except RuntimeError:
+                    # Raised once the pool has been shut down
+                    queue.pop()
+                    self.pending -= 1
+                    logging.error(f"Dispatcher stopped. Dropping message for {key}")
+                    return False
+        return True
+
+    def _group(self, key):
+        if not self.max_per_group or "/" not in key:
+            return None
+        return key.split("/", 1)[0]
+
+    def _schedule(self, key):
+        """Schedules a drain task for key, or parks key if its group already has
+        max_per_group drain tasks. Must be called with lock held
+        """
+        group = self._group(key)
+        if group is not None and self.group_running.get(group, 0) >= self.max_per_group:
+            self.parked.setdefault(group, deque()).append(key)
+        else:
+            self.executor.submit(self._drain, key)
+            if group is not None:
+                self.group_running[group] = self.group_running.get(group, 0) + 1
+        self.running.add(key)
+
+    def wrap(self, key, callback):
+        """Wraps a callback so that calling it queues it on the dispatcher. Used when
+        subscribing to shadow topics
+
+        Args:
+            key (str): ordering key
+            callback (callable): callback function
+
+        Returns:
+            callable: wrapped callback
+        """
+        def dispatched(*args, **kwargs):
+            self.submit(key, callback, *args, **kwargs)
+        return dispatched
+
+    def _drain(self, key):
+        """Runs next item queued for key. Re-schedules itself if there is more work so that
+        a busy key doesn't hog a worker while other keys wait
+
+        Args:
+            key (str): ordering key
+        """
+        with self.lock:
+            queue = self.queues.get(key)
+            item = queue.popleft() if queue else None
+            if item is not None:
+                self.pending -= 1
+
+        if item is not None:
+            enqueued, fn, args, kwargs = item
+            wait = time.monotonic() - enqueued
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"{key}:Dispatched callback failed")
+                logging.error(e)
+
+        group = self._group(key)
+        handed_on = False
+        with self.lock:
+            try:
+                if item is not None:
+                    self.processed += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+
+                # The drain task's slot passes to the next key: this key again, or a parked key
+                # of the same group so keys of a busy group take turns
+                parked = self.parked.get(group)
+                if self.queues.get(key):
+                    if parked:
+                        parked.append(key)
+                        key = parked.popleft()
+                    next_key = key
+                else:
+                    self.queues.pop(key, None)
+                    self.running.discard(key)
+                    next_key = parked.popleft() if parked else None
+
+                if next_key is not None:
+                    try:
+                        self.executor.submit(self._drain, next_key)
+                        handed_on = True
+                    except RuntimeError:
+                        for k in [next_key, *(parked or ())]:
+                            dropped = len(self.queues.get(k) or ())
+                            logging.error(f"Dispatcher stopped. Dropping {dropped} messages for {k}")
+                            self.pending -= dropped
+                            self.dropped += dropped
+                            self.queues.pop(k, None)
+                            self.running.discard(k)
+                        if parked:
+                            parked.clear()
+            finally:
+                # Released on every path that doesn't hand the slot on, so the group can't get
+                # stuck at max_per_group
+                if group is not None and not handed_on:
+                    self.group_running[group] -= 1
+                if not self.running:
+                    self.idle.notify_all()
+
+    def stats(self):
+        """Snapshot of queue depth and wait times
+
+        Returns:
+            dict: dispatcher statistics
+        """
+        with self.lock:
+            return {
+                "pending": self.pending,
+                "queue_depths": {k: len(q) for k, q in self.queues.items() if q},
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "avg_wait_ms": 1000 * self.total_wait / self.processed if self.processed else 0.0,
+                "max_wait_ms": 1000 * self.max_wait
+            }
+
+    def shutdown(self, wait=True):
+        """Stops accepting work and waits for queued callbacks to finish
+
+        Args:
+            wait (bool, optional): Whether to wait for pending work. Defaults to True.
+        """
+        if wait:
+            with self.lock:
+                self.idle.wait_for(lambda: not self.running)
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,213 @@
+from datetime import datetime
+import threading
+import logging
+import sqlite3
+import time
+import os
+
+from OutputFiles import OUTPUT_DATA_DIR, OutputFile
+
+# SQLite database recording every output file seen and its processing state per stage
+LEDGER_PATH = os.environ.get(
+    "FILE_LEDGER_PATH", os.path.join(OUTPUT_DATA_DIR, ".iot_ledger.db"))
+
+# Processing states
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class FileLedger:
+    """Small on-disk ledger of logger output files. Each file is recorded once when it is
+    completed, and each processing stage (e.g. upload) tracks its own state per file so that
+    restarts pick up where they left off instead of rescanning or reprocessing files
+    """
+
+    def __init__(self, path=LEDGER_PATH) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.open_lock = threading.Lock()
+        self.connection = None
+
+    @property
+    def db(self):
+        """Database connection, opened on first use so the ledger directory isn't created
+        when the ledger is constructed
+        """
+        with self.open_lock:
+            if self.connection is None:
+                self.connection = self.connect()
+            return self.connection
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                sensor_id TEXT NOT NULL,
+                start TEXT NOT NULL,
+                ext TEXT NOT NULL,
+                size INTEGER,
+                completed_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS files_sensor_start ON files (sensor_id, start);
+            CREATE TABLE IF NOT EXISTS stages (
+                path TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL,
+                PRIMARY KEY (path, stage)
+            );
+        """)
+        db.commit()
+        return db
+
+    def add_listener(self, callback):
+        """Registers callback(path) to be called when a file is removed from the ledger, so
+        in-memory indexes of files can drop it
+
+        Args:
+            callback (callable): listener
+        """
+        self.listeners.append(callback)
+
+    def add(self, output_file: OutputFile, size=None):
+        """Records a completed file
+
+        Args:
+            output_file (OutputFile): completed file
+            size (int, optional): size in bytes. Defaults to None.
+
+        Returns:
+            bool: True if file was not already in the ledger
+        """
+        with self.lock:
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (str(output_file.path), output_file.sensor_id, output_file.start.isoformat(),
+                 output_file.ext, size, time.time()))
+            self.db.commit()
+            return cur.rowcount > 0
+
+    def update_size(self, path, size):
+        with self.lock:
+            self.db.execute(
+                "UPDATE files SET size = ? WHERE path = ?", (size, str(path)))
+            self.db.commit()
+
+    def contains(self, path):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM files WHERE path = ?", (str(path),)).fetchone()
+        return row is not None
+
+    def known_paths(self):
+        """
+        Returns:
+            set: paths of all recorded files
+        """
+        with self.lock:
+            return {r[0] for r in self.db.execute("SELECT path FROM files")}
+
+    def files(self):
+        """All recorded files, oldest first. Used to rebuild in-memory indexes on startup
+
+        Returns:
+            list: (OutputFile, size) tuples
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path, sensor_id, start, ext, size FROM files ORDER BY start").fetchall()
+        return [(OutputFile(p, sensor, datetime.fromisoformat(start), ext), size)
+                for p, sensor, start, ext, size in rows]
+
+    def mark(self, path, stage, state):
+        """Sets processing state of file for a stage
+
+        Args:
+            path (str|Path): file path
+            stage (str): stage name, e.g. upload
+            state (str): PENDING, DONE or FAILED
+        """
+        with self.lock:
+            self.db.execute("""
+                INSERT INTO stages (path, stage, state, attempts, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (path, stage) DO UPDATE SET
+                    state = excluded.state,
+                    attempts = stages.attempts + excluded.attempts,
+                    updated_at = excluded.updated_at
+            """, (str(path), stage, state, 0 if state == PENDING else 1, time.time()))
+            self.db.commit()
+
+    def state(self, path, stage):
+        """
+        Returns:
+            str: processing state of file for stage, or None if stage hasn't seen the file
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT state FROM stages WHERE path = ? AND stage = ?", (str(path), stage)).fetchone()
+        return row[0] if row else None
+
+    def done_paths(self, stage):
+        """
+        Returns:
+            set: paths of files a stage has finished processing
+        """
+        with self.lock:
+            return {r[0] for r in self.db.execute(
+                "SELECT path FROM stages WHERE stage = ? AND state = ?", (stage, DONE))}
+
+    def pending(self, stage, max_attempts=None, limit=None):
+        """Files that haven't been processed by a stage yet, oldest first
+
+        Args:
+            stage (str): stage name
+            max_attempts (int, optional): Exclude files that failed this many times. Defaults to None.
+            limit (int, optional): Max number of files. Defaults to None.
+
+        Returns:
+            list: OutputFile for each file
+        """
+        query = """
+            SELECT f.path, f.sensor_id, f.start, f.ext FROM files f
+            LEFT JOIN stages s ON s.path = f.path AND s.stage = ?
+            WHERE (s.state IS NULL OR s.state != ?)
+        """
+        params = [stage, DONE]
+        if max_attempts is not None:
+            query += " AND (s.attempts IS NULL OR s.attempts < ?)"
+            params.append(max_attempts)
+        query += " ORDER BY f.start"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [OutputFile(p, sensor, datetime.fromisoformat(start), ext) for p, sensor, start, ext in rows]
+
+    def remove(self, path):
+        """Removes file and its stage states, e.g. once the file is deleted
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM stages WHERE path = ?", (str(path),))
+            self.db.execute("DELETE FROM files WHERE path = ?", (str(path),))
+            self.db.commit()
+
+        for listener in self.listeners:
+            try:
+                listener(str(path))
+            except Exception as e:
+                logging.error(f"Ledger listener failed for {path}")
+                logging.error(e)
+
+    def close(self):
+        with self.lock, self.open_lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,189 @@
+import ctypes
+import ctypes.util
+import threading
+import logging
+import select
+import struct
+import time
+import os
+
+from OutputFiles import OUTPUT_DATA_DIR, OutputFile, list_output_files
+from FileLedger import FileLedger
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Inotify:
+    """Minimal ctypes wrapper around Linux inotify
+    """
+
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c")
+                           or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read(self):
+        """Reads pending events. Blocks until at least one event is available
+
+        Returns:
+            list: (mask, name) for each event
+        """
+        buf = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    """Watches the output directory for files the logger has finished writing. Uses inotify
+    (close-after-write and moved-in events) so completed files are detected without polling,
+    and records each file in the file ledger before notifying listeners. Falls back to
+    periodic directory listing where inotify isn't available
+    """
+
+    def __init__(self, ledger: FileLedger, data_dir=OUTPUT_DATA_DIR, poll_interval=30, settle_time=30) -> None:
+        """
+        Args:
+            ledger (FileLedger): ledger to record files in
+            data_dir (str, optional): Output directory. Defaults to OUTPUT_DATA_DIR.
+            poll_interval (int, optional): Seconds between listings if inotify is unavailable. Defaults to 30.
+            settle_time (int, optional): When listing the directory, files modified within this many
+                seconds may still be being written and are skipped. Defaults to 30.
+        """
+        self.ledger = ledger
+        self.data_dir = data_dir
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.listeners = []
+        self.stop_event = threading.Event()
+        self.stop_r, self.stop_w = os.pipe()
+        self.thread = None
+
+    def add_listener(self, callback):
+        """Registers callback(output_file) to be called for each newly completed file
+
+        Args:
+            callback (callable): listener
+        """
+        self.listeners.append(callback)
+
+    def record(self, output_file: OutputFile):
+        """Adds file to ledger and notifies listeners if it's new
+
+        Args:
+            output_file (OutputFile): completed file
+
+        Returns:
+            bool: True if file was new
+        """
+        try:
+            size = os.path.getsize(output_file.path)
+        except FileNotFoundError:
+            return False
+        if not self.ledger.add(output_file, size):
+            return False
+
+        for listener in self.listeners:
+            try:
+                listener(output_file)
+            except Exception as e:
+                logging.error(f"File listener failed for {output_file.name}")
+                logging.error(e)
+        return True
+
+    def catch_up(self):
+        """Records files completed while the agent wasn't running. Only compares file names
+        against the ledger, files already recorded are not touched
+        """
+        known = self.ledger.known_paths()
+        now = time.time()
+        for f in list_output_files(self.data_dir):
+            if str(f.path) in known:
+                continue
+            try:
+                if now - os.path.getmtime(f.path) < self.settle_time:
+                    continue
+            except FileNotFoundError:
+                continue
+            self.record(f)
+
+    def run(self):
+        try:
+            inotify = Inotify()
+            inotify.add_watch(self.data_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            logging.error(f"inotify unavailable ({e}), polling {self.data_dir} instead")
+            self.poll()
+            return
+
+        # Watch is in place, so anything written from now on generates an event. Files that were
+        # still settling during the first catch up are picked up by a second one
+        self.catch_up()
+        recheck_at = time.monotonic() + self.settle_time
+        try:
+            while not self.stop_event.is_set():
+                timeout = None
+                if recheck_at is not None:
+                    timeout = max(0, recheck_at - time.monotonic())
+                ready, _, _ = select.select([inotify.fd, self.stop_r], [], [], timeout)
+                if recheck_at is not None and time.monotonic() >= recheck_at:
+                    recheck_at = None
+                    self.catch_up()
+                if inotify.fd not in ready:
+                    continue
+                for mask, name in inotify.read():
+                    if mask & IN_Q_OVERFLOW:
+                        logging.error("inotify queue overflow, catching up from directory listing")
+                        self.catch_up()
+                        continue
+                    f = OutputFile.parse(os.path.join(self.data_dir, name))
+                    if f:
+                        self.record(f)
+        finally:
+            inotify.close()
+
+    def poll(self):
+        while not self.stop_event.is_set():
+            try:
+                self.catch_up()
+            except Exception as e:
+                logging.error("Output directory scan failed")
+                logging.error(e)
+            self.stop_event.wait(self.poll_interval)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="file-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops watching. Wakes the watcher thread immediately
+        """
+        self.stop_event.set()
+        os.write(self.stop_w, b"\0")
@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import json
+import time
+import os
+
+from awscrt import mqtt
+from Device import Device
+from Dispatcher import Dispatcher
+from Scheduler import Scheduler
+from PublishQueue import OutboundPublisher, TELEMETRY
+from OutputFiles import OUTPUT_DATA_DIR
+from Metrics import REGISTRY, MetricsServer, METRICS_PORT, METRICS_INTERVAL, metrics_topic
+
+# Devices managed by one agent in gateway mode, comma separated name=host:port pairs.
+# Gateway mode is off if unset
+GATEWAY_DEVICES = os.environ.get("GATEWAY_DEVICES", "")
+# MQTT client id of the gateway connection, also used as thing name for gateway metrics
+GATEWAY_NAME = os.environ.get("GATEWAY_NAME", "gateway")
+# Worker threads shared by all devices for shadow callbacks, and for periodic tasks
+GATEWAY_WORKERS = int(os.environ.get("GATEWAY_WORKERS", 8))
+# Max shadow callbacks of one device running at once, so an unresponsive device can't hold every worker
+GATEWAY_DEVICE_WORKERS = int(os.environ.get("GATEWAY_DEVICE_WORKERS", 2))
+
+
+def parse_devices(value):
+    """
+    Args:
+        value (str): comma separated name=host:port pairs
+
+    Returns:
+        list: (name, endpoint) tuples
+    """
+    devices = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, endpoint = item.partition("=")
+        if not sep or not name or not endpoint:
+            raise ValueError(f"Invalid gateway device '{item}', expected name=host:port")
+        devices.append((name.strip(), endpoint.strip()))
+    return devices
+
+
+class Gateway:
+    """Runs several devices (snsrpi hosts) in one agent. The devices share one MQTT
+    connection, callback dispatcher, scheduler and outbound publisher (so the connection's
+    publish rate limit holds across devices), while each keeps its own shadows, snsrpi API
+    client and data directory. Dispatcher and scheduler run work on worker pools with a per
+    device limit, so one unresponsive endpoint doesn't stall the others
+    """
+
+    def __init__(self, devices, name=GATEWAY_NAME, workers=GATEWAY_WORKERS,
+                 device_workers=GATEWAY_DEVICE_WORKERS, data_dir=OUTPUT_DATA_DIR) -> None:
+        """
+        Args:
+            devices (list): (name, endpoint) of each device
+            name (str, optional): Gateway name. Defaults to GATEWAY_NAME.
+            workers (int, optional): Shared worker threads. Defaults to GATEWAY_WORKERS.
+            device_workers (int, optional): Max callbacks of one device running at once. Defaults to GATEWAY_DEVICE_WORKERS.
+            data_dir (str, optional): Parent of the devices' data directories (data_dir/name). Defaults to OUTPUT_DATA_DIR.
+        """
+        self.name = name
+        self.mqtt = None
+        self.online = False
+        self.dispatcher = Dispatcher(max_workers=workers, max_pending=1000 * len(devices),
+                                     max_per_group=device_workers)
+        self.scheduler = Scheduler(name="scheduler", seed=name, workers=workers)
+        self.outbound = OutboundPublisher()
+        self.devices = [
+            Device(device_name, endpoint, dispatcher=self.dispatcher, scheduler=self.scheduler,
+                   data_dir=os.path.join(data_dir, device_name), outbound=self.outbound)
+            for device_name, endpoint in devices
+        ]
+
+        self.scheduler.add("dispatch-stats", self.log_dispatch_stats, 60)
+        if METRICS_INTERVAL > 0:
+            self.scheduler.add("metrics", self.publish_metrics, METRICS_INTERVAL)
+        self.metrics_server = MetricsServer() if METRICS_PORT else None
+        REGISTRY.gauge("dispatcher_pending", "Shadow callbacks waiting to run",
+                       lambda: self.dispatcher.stats()["pending"])
+        REGISTRY.gauge("offline_queue_bytes", "Bytes of messages stored in the offline queue",
+                       lambda: sum(d.outbox.size() for d in self.devices))
+        REGISTRY.gauge("offline_queue_dropped_segments", "Offline queue segments dropped as queue was full",
+                       lambda: sum(d.outbox.dropped for d in self.devices))
+        REGISTRY.gauge("outbound_queue_depth", "Outbound publishes waiting for the rate limiter",
+                       lambda: sum(self.outbound.stats()["queued"].values()))
+        REGISTRY.gauge("outbound_inflight", "Outbound publishes sent and not yet acknowledged",
+                       lambda: self.outbound.stats()["inflight"])
+
+    def set_mqtt(self, mqtt_connection):
+        self.mqtt = mqtt_connection
+        for device in self.devices:
+            device.set_mqtt(mqtt_connection)
+
+    def set_online(self, online):
+        self.online = online
+        for device in self.devices:
+            device.set_online(online)
+
+    def run_all(self, fn, *args):
+        """Runs fn(device, *args) for every device at once, so a device that is slow to
+        respond doesn't hold up the rest. Failures are logged per device
+
+        Returns:
+            list: result per device, or the exception raised
+        """
+        def run(device):
+            try:
+                return fn(device, *args)
+            except Exception as e:
+                logging.error(f"{device.name}:{fn.__name__} failed")
+                logging.error(e)
+                return e
+
+        with ThreadPoolExecutor(max_workers=len(self.devices), thread_name_prefix="gateway") as pool:
+            return list(pool.map(run, self.devices))
+
+    def publish_metrics(self):
+        """Publishes snapshot of all metrics of the agent to the gateway's metrics topic
+        """
+        if self.mqtt is None or not self.online:
+            return
+        payload = json.dumps({
+            "thing": self.name,
+            "devices": [d.name for d in self.devices],
+            "timestamp": time.time(),
+            "metrics": REGISTRY.snapshot()
+        }, separators=(",", ":"))
+        self.outbound.submit(TELEMETRY, lambda: self.mqtt.publish(
+            topic=metrics_topic(self.name), payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE)[0],
+            name=metrics_topic(self.name))
+
+    def log_dispatch_stats(self):
+        stats = self.dispatcher.stats()
+        logging.info(
+            f"Dispatcher: pending={stats['pending']} processed={stats['processed']} "
+            f"dropped={stats['dropped']} avg_wait={stats['avg_wait_ms']:.1f}ms "
+            f"max_wait={stats['max_wait_ms']:.1f}ms depths={stats['queue_depths']}")
+
+    def stop(self):
+        """Stops shared scheduler and dispatcher, once all devices are stopped, then sends
+        what is left in the outbound queue
+        """
+        self.scheduler.shutdown()
+        self.dispatcher.shutdown()
+        self.outbound.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
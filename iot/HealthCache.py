@@ -0,0 +1,107 @@
+import threading
+import time
+import os
+
+# Seconds a health snapshot is reused before /api/health is called again
+HEALTH_CACHE_TTL = float(os.environ.get("HEALTH_CACHE_TTL", 5))
+
+
+class HealthCache:
+    """TTL cache for the device health snapshot with single-flight fetching: concurrent
+    callers asking for an expired snapshot share one request instead of each calling the
+    snsrpi API. Each new snapshot gets a new version so callers can tell whether anything
+    was fetched since they last looked
+    """
+
+    def __init__(self, fetch, ttl=HEALTH_CACHE_TTL) -> None:
+        """
+        Args:
+            fetch (callable): function returning a fresh health snapshot
+            ttl (float, optional): Seconds a snapshot is valid. Defaults to HEALTH_CACHE_TTL.
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.value = None
+        self.version = 0
+        self.fetched_at = None
+        self.inflight = None  # Event set when current fetch completes
+        self.error = None
+        self.listeners = []
+
+        # Stats
+        self.hits = 0
+        self.fetches = 0
+
+    def add_listener(self, listener):
+        """Registers function called whenever the snapshot is invalidated
+        """
+        self.listeners.append(listener)
+
+    def is_fresh(self, max_age=None):
+        """Must be called with lock held
+        """
+        if self.fetched_at is None:
+            return False
+        age = time.monotonic() - self.fetched_at
+        return age < (self.ttl if max_age is None else max_age)
+
+    def get(self, max_age=None):
+        """Returns cached snapshot if fresh, otherwise fetches a new one. If another thread is
+        already fetching, waits for its result instead
+
+        Args:
+            max_age (float, optional): Override TTL for this call. Defaults to None.
+
+        Raises:
+            Exception: whatever the fetch raised, for all callers waiting on it
+
+        Returns:
+            tuple: (snapshot, version)
+        """
+        with self.lock:
+            if self.is_fresh(max_age):
+                self.hits += 1
+                return self.value, self.version
+            if self.inflight is not None:
+                event = self.inflight
+                leader = False
+            else:
+                event = self.inflight = threading.Event()
+                leader = True
+
+        if not leader:
+            event.wait()
+            with self.lock:
+                self.hits += 1
+                if self.error is not None:
+                    raise self.error
+                return self.value, self.version
+
+        try:
+            value = self.fetch()
+            error = None
+        except Exception as e:
+            value = None
+            error = e
+
+        with self.lock:
+            self.fetches += 1
+            self.error = error
+            if error is None:
+                self.value = value
+                self.version += 1
+                self.fetched_at = time.monotonic()
+            self.inflight = None
+            event.set()
+            if error is not None:
+                raise error
+            return self.value, self.version
+
+    def invalidate(self):
+        """Expires current snapshot, e.g. after a sensor was started/stopped
+        """
+        with self.lock:
+            self.fetched_at = None
+        for listener in self.listeners:
+            listener()
@@ -0,0 +1,291 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import contextlib
+import functools
+import threading
+import logging
+import bisect
+import time
+import os
+
+# Port of the local Prometheus metrics endpoint. 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# Seconds between metrics messages published over MQTT. 0 disables them
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", 0))
+# Time functions decorated with @timed. Can also be switched at runtime with set_tracing
+METRICS_TRACE = os.environ.get("METRICS_TRACE", "false").lower() == "true"
+
+# Latency buckets in seconds, from fast local calls to slow network round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def metrics_topic(thing):
+    return f"snsrpi/{thing}/metrics"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{escape_label(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """Base class of metrics. Values are kept per combination of label values
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def render(self):
+        """
+        Returns:
+            list: lines in Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return [f"{self.name}{format_labels(self.label_names, key)} {value}"]
+
+    def snapshot(self):
+        """
+        Returns:
+            list: dict per label combination with labels and value(s), for JSON export
+        """
+        with self.lock:
+            items = sorted(self.values.items())
+        return [{**dict(zip(self.label_names, key)), **self.snapshot_value(value)} for key, value in items]
+
+    def snapshot_value(self, value):
+        return {"value": value}
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Gauge whose value is read from a function when exported, e.g. a queue depth
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, fn) -> None:
+        super().__init__(name, help)
+        self.fn = fn
+
+    def render(self):
+        self.update()
+        return super().render()
+
+    def snapshot(self):
+        self.update()
+        return super().snapshot()
+
+    def update(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            logging.error(f"Reading gauge {self.name} failed")
+            logging.error(e)
+            return
+        with self.lock:
+            self.values[()] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # Per bucket counts (last is +Inf), sum
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Context manager observing the time spent in the block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            labels = format_labels(self.label_names + ("le",), key + (bound,))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def snapshot_value(self, value):
+        counts, total = value
+        count = sum(counts)
+        return {"count": count, "sum": total, "mean": total / count if count else 0.0}
+
+    def stats(self, **labels):
+        """
+        Returns:
+            dict: count, sum and mean for one label combination
+        """
+        with self.lock:
+            value = self.values.get(self.key(labels))
+            return self.snapshot_value(value) if value else {"count": 0, "sum": 0.0, "mean": 0.0}
+
+
+class Registry:
+    """Collection of metrics exported together. Registering a metric twice returns the
+    existing one so modules can declare their metrics at import time
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, fn):
+        """Registers gauge, replacing any previous gauge of the same name
+        """
+        with self.lock:
+            self.metrics[name] = Gauge(name, help, fn)
+            return self.metrics[name]
+
+    def render(self):
+        """
+        Returns:
+            str: all metrics in Prometheus text format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: metric name -> list of values, for the MQTT metrics message
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {m.name: m.snapshot() for m in metrics}
+
+
+REGISTRY = Registry()
+
+HOT_PATH_SECONDS = REGISTRY.histogram(
+    "iot_hot_path_seconds", "Time spent in functions decorated with @timed (only while tracing)",
+    ("function",))
+
+tracing = METRICS_TRACE
+
+
+def set_tracing(enabled):
+    """Switches @timed instrumentation on or off at runtime
+    """
+    global tracing
+    tracing = enabled
+
+
+def timed(fn):
+    """Records time spent in fn in iot_hot_path_seconds while tracing is on. When off, the
+    only overhead is checking a flag
+    """
+    name = fn.__qualname__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not tracing:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            HOT_PATH_SECONDS.observe(time.perf_counter() - start, function=name)
+    return wrapper
+
+
+class MetricsServer:
+    """Serves registry in Prometheus text format on /metrics
+    """
+
+    def __init__(self, registry=REGISTRY, port=METRICS_PORT, host="0.0.0.0") -> None:
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                data = self.registry.render().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(data)))
+                handler.end_headers()
+                handler.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        print(f"Serving metrics on port {self.port}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,350 @@
+import threading
+import logging
+import struct
+import zlib
+import json
+import time
+import os
+
+from OutputFiles import OUTPUT_DATA_DIR
+
+# Directory of the durable outbound queue
+OFFLINE_QUEUE_DIR = os.environ.get(
+    "OFFLINE_QUEUE_DIR", os.path.join(OUTPUT_DATA_DIR, ".iot_outbox"))
+# Max bytes kept on disk. Oldest messages are dropped once exceeded
+OFFLINE_QUEUE_MAX_BYTES = int(os.environ.get("OFFLINE_QUEUE_MAX_BYTES", 64 * 1024 * 1024))
+# Max messages per second published when draining the queue
+OFFLINE_DRAIN_RATE = float(os.environ.get("OFFLINE_DRAIN_RATE", 10))
+
+SEGMENT_SUFFIX = ".seg"
+RECORD_HEADER = struct.Struct(">II")  # length, crc32
+
+# Message kinds
+SHADOW = "shadow"
+TELEMETRY = "telemetry"
+
+
+def merge_state(old, new):
+    """Merges a newer partial shadow state into an older one following shadow semantics:
+    nested objects merge key by key, None (delete) and arrays replace
+
+    Returns:
+        dict: merged state
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    merged = dict(old)
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_state(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def collapse(records):
+    """Collapses superseded shadow updates. All updates for the same shadow are merged into
+    one, sent at the position of the latest update. Telemetry is kept in order
+
+    Args:
+        records (list): message dicts with kind, key and body
+
+    Returns:
+        list: collapsed messages, each with the position of the record it is sent at
+    """
+    latest = {}
+    for i, r in enumerate(records):
+        if r["kind"] == SHADOW:
+            latest[r["key"]] = i
+
+    merged = {}
+    result = []
+    for i, r in enumerate(records):
+        if r["kind"] != SHADOW:
+            result.append({**r, "position": i})
+            continue
+        body = merged.get(r["key"])
+        if body is None:
+            body = r["body"]
+        else:
+            body = {
+                **body, **r["body"],
+                "reported": merge_state(body.get("reported"), r["body"].get("reported")),
+                "desired": merge_state(body.get("desired"), r["body"].get("desired"))
+            }
+        merged[r["key"]] = body
+        if latest[r["key"]] == i:
+            result.append({**r, "body": body, "position": i})
+    return result
+
+
+def sent_prefix(records, position):
+    """Number of records from the start of a batch that are fully sent once the collapsed
+    messages before position are. A shadow update is only sent with the latest update of
+    its shadow, so the prefix ends at the first update whose shadow is still to be sent
+
+    Args:
+        records (list): message dicts with kind and key, as passed to collapse
+        position (int): position of first collapsed message not sent
+
+    Returns:
+        int: number of records that can be committed
+    """
+    latest = {}
+    for i, r in enumerate(records):
+        if r["kind"] == SHADOW:
+            latest[r["key"]] = i
+    for i, r in enumerate(records[:position]):
+        if r["kind"] == SHADOW and latest[r["key"]] >= position:
+            return i
+    return min(position, len(records))
+
+
+class OfflineQueue:
+    """Durable append-only queue of outbound messages, kept on local disk as a ring of
+    segment files capped at max_bytes. Messages are queued while the MQTT connection is down
+    and drained in order, at a limited rate, once it resumes. Superseded shadow states are
+    collapsed into one update per shadow when draining. The directory is created and the
+    segments opened on first use, not on construction
+    """
+
+    def __init__(self, directory=OFFLINE_QUEUE_DIR, max_bytes=OFFLINE_QUEUE_MAX_BYTES,
+                 segment_bytes=1024 * 1024, drain_rate=OFFLINE_DRAIN_RATE) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes)
+        self.drain_rate = drain_rate
+        self.publishers = {}  # kind -> callable(body) returning a future
+        self.lock = threading.Lock()
+        self.online = False
+        self.drain_thread = None
+        self.dropped = 0
+        self.segments = []
+        self.cursor = None
+        self.writer = None
+
+    def open(self):
+        """Creates the queue directory and opens the current segment, unless already open.
+        Must be called with lock held
+        """
+        if self.writer is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.segments = sorted(
+            int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(self.directory) if f.endswith(SEGMENT_SUFFIX))
+        self.cursor = self.load_cursor()
+        if not self.segments:
+            self.segments = [self.cursor[0]]
+        self.writer = open(self.segment_path(self.segments[-1]), "ab")
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:010d}{SEGMENT_SUFFIX}")
+
+    @property
+    def cursor_path(self):
+        return os.path.join(self.directory, "cursor")
+
+    def load_cursor(self):
+        """
+        Returns:
+            tuple: (segment, offset) of next message to drain
+        """
+        try:
+            with open(self.cursor_path) as f:
+                segment, offset = json.load(f)
+                return segment, offset
+        except (FileNotFoundError, ValueError):
+            return (self.segments[0] if self.segments else 1, 0)
+
+    def save_cursor(self):
+        tmp = self.cursor_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(list(self.cursor), f)
+        os.replace(tmp, self.cursor_path)
+
+    def size(self):
+        total = 0
+        for s in self.segments:
+            try:
+                total += os.path.getsize(self.segment_path(s))
+            except FileNotFoundError:
+                pass
+        return total
+
+    def register(self, kind, publish):
+        """Registers function used to publish messages of a kind when draining
+
+        Args:
+            kind (str): SHADOW or TELEMETRY
+            publish (callable): publish(body) -> Future
+        """
+        self.publishers[kind] = publish
+
+    def append(self, kind, key, body):
+        """Appends message to queue
+
+        Args:
+            kind (str): SHADOW or TELEMETRY
+            key (str): shadow name or topic. Shadow messages with the same key are collapsed
+            body (dict): message, passed to the publisher of its kind
+        """
+        data = json.dumps({"kind": kind, "key": key, "body": body},
+                          separators=(",", ":")).encode()
+        record = RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self.lock:
+            self.open()
+            if self.writer.tell() > 0 and self.writer.tell() + len(record) > self.segment_bytes:
+                self.rotate()
+            self.writer.write(record)
+            self.writer.flush()
+            self.enforce_cap()
+
+    def rotate(self):
+        """Starts a new segment. Must be called with lock held
+        """
+        self.writer.close()
+        self.segments.append(self.segments[-1] + 1)
+        self.writer = open(self.segment_path(self.segments[-1]), "ab")
+
+    def enforce_cap(self):
+        """Drops oldest segments until queue fits in max_bytes. Must be called with lock held
+        """
+        while len(self.segments) > 1 and self.size() > self.max_bytes:
+            oldest = self.segments.pop(0)
+            os.remove(self.segment_path(oldest))
+            self.dropped += 1
+            logging.error(f"Offline queue full, dropped segment {oldest}")
+            if self.cursor[0] <= oldest:
+                self.cursor = (self.segments[0], 0)
+                self.save_cursor()
+
+    def read_batch(self, max_records=100):
+        """Reads messages from cursor without consuming them
+
+        Returns:
+            tuple: (list of messages, each with the cursor after it as "end", cursor after last message)
+        """
+        with self.lock:
+            self.open()
+            self.writer.flush()
+            segments = [s for s in self.segments if s >= self.cursor[0]]
+            segment, offset = self.cursor
+            # Don't read past what has been fully written to the current segment
+            write_segment, write_end = self.segments[-1], self.writer.tell()
+
+        records = []
+        for s in segments:
+            if s != segment:
+                segment, offset = s, 0
+            try:
+                f = open(self.segment_path(s), "rb")
+            except FileNotFoundError:
+                # Dropped by the size cap while reading
+                continue
+            with f:
+                f.seek(offset)
+                end = write_end if s == write_segment else os.path.getsize(self.segment_path(s))
+                while len(records) < max_records and f.tell() < end:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, crc = RECORD_HEADER.unpack(header)
+                    data = f.read(length)
+                    if len(data) < length or zlib.crc32(data) != crc:
+                        logging.error(f"Corrupt record in offline queue segment {s}, skipping rest")
+                        offset = end
+                        break
+                    offset = f.tell()
+                    records.append({**json.loads(data), "end": (s, offset)})
+            if len(records) >= max_records:
+                break
+        return records, (segment, offset)
+
+    def commit(self, cursor):
+        """Marks messages up to cursor as sent and removes fully drained segments
+        """
+        with self.lock:
+            self.open()
+            self.cursor = cursor
+            while len(self.segments) > 1 and self.segments[0] < cursor[0]:
+                os.remove(self.segment_path(self.segments.pop(0)))
+            self.save_cursor()
+
+    def commit_sent(self, records, position):
+        """Commits the records of a batch sent before the collapsed message at position
+        """
+        count = sent_prefix(records, position)
+        if count:
+            self.commit(records[count - 1]["end"])
+
+    def is_empty(self):
+        records, _ = self.read_batch(max_records=1)
+        return not records
+
+    def set_online(self, online):
+        """Updates connection state. Going online starts draining. Safe to call from the MQTT
+        event-loop thread as draining happens on its own thread
+        """
+        self.online = online
+        if online:
+            self.start_drain()
+
+    def start_drain(self):
+        with self.lock:
+            if self.drain_thread is not None and self.drain_thread.is_alive():
+                return
+            self.drain_thread = threading.Thread(
+                target=self.drain, name="offline-drain", daemon=True)
+            self.drain_thread.start()
+
+    def drain(self, timeout=10):
+        """Publishes queued messages in order while online, limited to drain_rate messages per
+        second. Stops at the first failed publish, leaving it queued for the next attempt.
+        Messages of the batch sent before it are committed so they aren't sent again
+
+        Args:
+            timeout (int, optional): Seconds to wait for each publish. Defaults to 10.
+
+        Returns:
+            int: number of messages published
+        """
+        sent = 0
+        interval = 1.0 / self.drain_rate if self.drain_rate > 0 else 0
+        while self.online:
+            records, cursor = self.read_batch()
+            if not records:
+                break
+            for r in collapse(records):
+                if not self.online:
+                    self.commit_sent(records, r["position"])
+                    return sent
+                publish = self.publishers.get(r["kind"])
+                if publish is None:
+                    logging.error(f"No publisher for offline message kind {r['kind']}, dropping")
+                    continue
+                try:
+                    publish(r["body"]).result(timeout)
+                except Exception as e:
+                    logging.error(f"Publishing queued {r['kind']} message for {r['key']} failed")
+                    logging.error(e)
+                    self.commit_sent(records, r["position"])
+                    return sent
+                sent += 1
+                time.sleep(interval)
+            self.commit(cursor)
+        if sent:
+            print(f"Offline queue drained {sent} messages")
+        return sent
+
+    def close(self, timeout=10):
+        """Stops draining, waiting up to timeout for a running drain to finish, and closes
+        the current segment
+        """
+        self.online = False
+        drain_thread = self.drain_thread
+        if drain_thread is not None and drain_thread is not threading.current_thread():
+            drain_thread.join(timeout)
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
@@ -0,0 +1,100 @@
+from datetime import datetime
+from pathlib import Path
+import re
+import os
+
+# Directory the snsrpi service writes output files to. Should be the same volume as the
+# OUTPUT_DATA_DIR of the snsrpi container
+OUTPUT_DATA_DIR = os.environ.get("OUTPUT_DATA_DIR", "/data")
+
+# Matches OutputData.GetFileName: <device>_yyyy-MM-dd_HH-mm-ss.csv|.feather
+# Sensor ids can contain underscores (e.g. CX1_1901) so the timestamp is matched from the end
+FILE_NAME_PATTERN = re.compile(
+    r"^(?P<sensor_id>.+)_(?P<timestamp>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.(?P<ext>csv|feather)$")
+FILE_NAME_TIME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+class OutputFile:
+    """Output file written by the snsrpi Logger. Holds the sensor id and start time parsed
+    from the file name
+    """
+
+    def __init__(self, path, sensor_id, start: datetime, ext) -> None:
+        self.path = Path(path)
+        self.sensor_id = sensor_id
+        self.start = start
+        self.ext = ext
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @classmethod
+    def parse(cls, path):
+        """Parses output file path
+
+        Args:
+            path (str|Path): file path
+
+        Returns:
+            OutputFile: parsed file, or None if name doesn't match the logger naming scheme
+        """
+        match = FILE_NAME_PATTERN.match(Path(path).name)
+        if not match:
+            return None
+        try:
+            start = datetime.strptime(
+                match['timestamp'], FILE_NAME_TIME_FORMAT)
+        except ValueError:
+            return None
+        return cls(path, match['sensor_id'], start, match['ext'])
+
+    def __repr__(self) -> str:
+        return f"OutputFile({self.path})"
+
+
+def list_output_files(data_dir=OUTPUT_DATA_DIR):
+    """Lists logger output files in directory, sorted by sensor and start time
+
+    Args:
+        data_dir (str, optional): Directory to list. Defaults to OUTPUT_DATA_DIR.
+
+    Returns:
+        list: OutputFile for each matching file
+    """
+    files = []
+    try:
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                f = OutputFile.parse(entry.path)
+                if f:
+                    files.append(f)
+    except FileNotFoundError:
+        return []
+    files.sort(key=lambda f: (f.sensor_id, f.start))
+    return files
+
+
+def get_setting(settings, *keys, default=None):
+    """Gets nested value from sensor settings. The snsrpi API may serialise the settings keys
+    in PascalCase (as in config files) or camelCase, so keys are matched case-insensitively
+
+    Args:
+        settings (dict): sensor settings
+        keys (str): path of keys, e.g. "File_upload", "Endpoint"
+        default (optional): Value if key not found. Defaults to None.
+
+    Returns:
+        value of setting
+    """
+    value = settings
+    for key in keys:
+        if not isinstance(value, dict):
+            return default
+        lookup = {k.lower(): v for k, v in value.items()}
+        if key.lower() not in lookup:
+            return default
+        value = lookup[key.lower()]
+    return value
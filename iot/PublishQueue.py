@@ -0,0 +1,411 @@
+from concurrent.futures import Future
+from collections import deque
+import threading
+import logging
+import time
+import os
+
+from Metrics import REGISTRY
+
+# Max publishes per second on the MQTT connection (AWS IoT allows 100 per connection)
+PUBLISH_RATE = float(os.environ.get("MQTT_PUBLISH_RATE", 50))
+# Publishes that may be sent at once after an idle period
+PUBLISH_BURST = int(os.environ.get("MQTT_PUBLISH_BURST", 20))
+# Max publishes waiting for the rate limiter. Lower priority publishes are dropped first
+PUBLISH_QUEUE_SIZE = int(os.environ.get("MQTT_PUBLISH_QUEUE_SIZE", 10000))
+
+# Priority classes of outbound publishes, highest first
+ACK, STATE, HEARTBEAT, TELEMETRY = range(4)
+PRIORITIES = ("ack", "state", "heartbeat", "telemetry")
+
+OUTBOUND_PUBLISHES = REGISTRY.counter(
+    "outbound_publishes_total", "Outbound MQTT publishes by priority and result: acked, failed or dropped",
+    ("priority", "result"))
+OUTBOUND_QUEUE_SECONDS = REGISTRY.histogram(
+    "outbound_queue_seconds", "Time outbound publishes waited for the rate limiter", ("priority",))
+OUTBOUND_ACK_SECONDS = REGISTRY.histogram(
+    "outbound_ack_seconds", "Time from sending an outbound publish to its acknowledgement", ("priority",))
+OUTBOUND_THROTTLED = REGISTRY.counter(
+    "outbound_throttled_total", "Times the outbound publisher waited for the rate limiter, by priority of the next publish",
+    ("priority",))
+
+
+class CoalescingPublisher:
+    """Per-shadow publish queue. Update requests within a short debounce window are merged
+    into a single publish, and while a publish is in flight further requests are held and
+    sent as one update once it completes. As the handler publishes its current local state
+    at flush time, merging is just a matter of remembering that an update is pending
+    """
+
+    def __init__(self, name, publish, debounce=0.25, inflight_timeout=10.0) -> None:
+        """
+        Args:
+            name (str): shadow name, used for logging
+            publish (callable): publish(override_desired, full, priority) -> Future or None if nothing was sent
+            debounce (float, optional): Seconds to wait for more updates before publishing. Defaults to 0.25.
+            inflight_timeout (float, optional): Seconds after which an unacknowledged publish no longer
+                holds back new ones. Defaults to 10.0.
+        """
+        self.name = name
+        self.publish = publish
+        self.debounce = debounce
+        self.inflight_timeout = inflight_timeout
+
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.timer = None
+        self.pending = False
+        self.override_desired = False
+        self.full = False
+        self.priority = None
+        self.inflight = 0
+        self.inflight_since = 0.0
+
+        # Stats
+        self.requested = 0
+        self.published = 0
+
+    def request(self, override_desired=False, full=False, priority=STATE):
+        """Requests a shadow update. Flags are OR-ed with any update already pending, and the
+        merged update takes the highest priority requested
+
+        Args:
+            override_desired (bool, optional): Update desired as well as reported. Defaults to False.
+            full (bool, optional): Publish full state rather than changes. Defaults to False.
+            priority (int, optional): Outbound priority class. Defaults to STATE.
+        """
+        with self.lock:
+            self.requested += 1
+            self.pending = True
+            self.override_desired |= override_desired
+            self.full |= full
+            self.priority = priority if self.priority is None else min(self.priority, priority)
+            self._schedule()
+
+    def _schedule(self):
+        """Starts debounce timer unless one is running or a publish is still in flight.
+        Must be called with lock held
+        """
+        if self.timer is not None or not self.pending:
+            return
+        if self.inflight:
+            if time.monotonic() - self.inflight_since < self.inflight_timeout:
+                return
+            logging.error(
+                f"{self.name}:Publish not acknowledged after {self.inflight_timeout}s, no longer waiting")
+            self.inflight = 0
+
+        self.timer = threading.Timer(self.debounce, self._flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _flush(self):
+        """Publishes pending update
+        """
+        with self.lock:
+            self.timer = None
+            if not self.pending:
+                return
+            override_desired, full = self.override_desired, self.full
+            priority = STATE if self.priority is None else self.priority
+            self.pending = self.override_desired = self.full = False
+            self.priority = None
+            self.inflight += 1
+            self.inflight_since = time.monotonic()
+
+        future = None
+        try:
+            future = self.publish(override_desired, full, priority)
+        except Exception as e:
+            logging.error(f"{self.name}:Publish failed")
+            logging.error(e)
+
+        if future is None:
+            self._on_done(None, counted=False)
+        else:
+            future.add_done_callback(self._on_done)
+
+    def _on_done(self, future, counted=True):
+        """Marks publish as complete and sends any update that arrived in the meantime
+
+        Args:
+            future (Future): completed publish future
+            counted (bool, optional): Whether a message was actually published. Defaults to True.
+        """
+        with self.lock:
+            self.inflight = max(0, self.inflight - 1)
+            if counted:
+                self.published += 1
+            self._schedule()
+            self.done.notify_all()
+
+    def flush(self, timeout=None):
+        """Publishes any pending update immediately and waits for in-flight publishes
+
+        Args:
+            timeout (float, optional): Max seconds to wait. Defaults to None (no limit).
+
+        Returns:
+            bool: True if nothing is left pending or in flight
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            run_now = self.pending and not self.inflight
+        if run_now:
+            self._flush()
+
+        with self.lock:
+            return self.done.wait_for(
+                lambda: not self.inflight and not self.pending, timeout=timeout)
+
+    def cancel(self):
+        """Drops any pending update, e.g. before deleting the shadow
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = self.override_desired = self.full = False
+            self.priority = None
+
+    def stats(self):
+        """
+        Returns:
+            dict: number of update requests, publishes and current in-flight count
+        """
+        with self.lock:
+            return {
+                "requested": self.requested,
+                "published": self.published,
+                "inflight": self.inflight,
+                "pending": self.pending
+            }
+
+
+class TokenBucket:
+    """Token bucket rate limiter. Holds up to burst tokens, refilled at rate per second
+    """
+
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """
+        Returns:
+            float: seconds until a token is available, 0 if one is available now
+        """
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class OutboundPublisher:
+    """Single outbound path for MQTT publishes of a connection. Publishes are queued by
+    priority class (command acknowledgements, state changes, heartbeats, telemetry) and sent
+    by one thread as a token bucket allows, so acknowledgements aren't throttled behind
+    routine traffic. The publisher tracks each publish until it is acknowledged and resolves
+    the future returned by submit
+    """
+
+    def __init__(self, rate=PUBLISH_RATE, burst=PUBLISH_BURST, max_queue=PUBLISH_QUEUE_SIZE) -> None:
+        """
+        Args:
+            rate (float, optional): Max publishes per second, 0 for no limit. Defaults to PUBLISH_RATE.
+            burst (int, optional): Bucket size. Defaults to PUBLISH_BURST.
+            max_queue (int, optional): Max queued publishes. Defaults to PUBLISH_QUEUE_SIZE.
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.queues = [deque() for _ in PRIORITIES]  # (enqueue time, send, future, name)
+        self.queued = 0
+        self.inflight = {}  # future -> (priority, name, sent at)
+        self.stopped = False
+        self.thread = None
+
+    def submit(self, priority, send, name="", block=False, timeout=None):
+        """Queues a publish
+
+        Args:
+            priority (int): ACK, STATE, HEARTBEAT or TELEMETRY
+            send (callable): sends the publish, returning its future (e.g. lambda: connection.publish(...)[0])
+            name (str, optional): Topic or shadow name for logging. Defaults to "".
+            block (bool, optional): If the queue is full, wait for space rather than dropping. Used
+                by bulk producers such as telemetry streams. Defaults to False.
+            timeout (float, optional): Max seconds to wait for space when blocking. Defaults to None.
+
+        Returns:
+            Future: resolved with the publish result once acknowledged, or failed if dropped
+        """
+        future = Future()
+        dropped = None
+        with self.condition:
+            if block and not self.stopped:
+                self.condition.wait_for(lambda: self.queued < self.max_queue or self.stopped, timeout)
+            if self.stopped:
+                dropped = (future, priority, name)
+            elif self.queued >= self.max_queue:
+                dropped = self._evict(priority) or (future, priority, name)
+            if dropped is None or dropped[0] is not future:
+                self.queues[priority].append((time.monotonic(), send, future, name))
+                self.queued += 1
+                self._start()
+                self.condition.notify_all()
+        if dropped is not None:
+            self._drop(*dropped)
+        return future
+
+    def _evict(self, priority):
+        """Removes the newest queued publish of the lowest class below priority. Must be
+        called with lock held
+
+        Returns:
+            tuple: (future, priority, name) of evicted publish, or None if none is lower
+        """
+        for lower in range(len(PRIORITIES) - 1, priority, -1):
+            if self.queues[lower]:
+                _, _, future, name = self.queues[lower].pop()
+                self.queued -= 1
+                return future, lower, name
+        return None
+
+    def _drop(self, future, priority, name):
+        logging.error(f"{name}:Outbound {PRIORITIES[priority]} publish dropped, queue full or stopped")
+        OUTBOUND_PUBLISHES.inc(priority=PRIORITIES[priority], result="dropped")
+        future.set_exception(RuntimeError("Publish dropped"))
+
+    def _start(self):
+        """Starts sender thread if not running. Must be called with lock held
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name="outbound", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.queued:
+                        if self.stopped:
+                            return
+                        self.condition.wait()
+                        continue
+                    delay = self.bucket.delay(time.monotonic())
+                    if delay <= 0:
+                        break
+                    head = next(i for i, q in enumerate(self.queues) if q)
+                    OUTBOUND_THROTTLED.inc(priority=PRIORITIES[head])
+                    self.condition.wait(delay)
+                priority = next(i for i, q in enumerate(self.queues) if q)
+                enqueued, send, future, name = self.queues[priority].popleft()
+                self.queued -= 1
+                self.bucket.take()
+                # Room for blocked producers
+                self.condition.notify_all()
+            OUTBOUND_QUEUE_SECONDS.observe(time.monotonic() - enqueued, priority=PRIORITIES[priority])
+            self._send(priority, send, future, name)
+
+    def _send(self, priority, send, future, name):
+        try:
+            sent = send()
+        except Exception as e:
+            OUTBOUND_PUBLISHES.inc(priority=PRIORITIES[priority], result="failed")
+            future.set_exception(e)
+            return
+        if sent is None:
+            future.set_result(None)
+            return
+        with self.lock:
+            self.inflight[sent] = (priority, name, time.monotonic())
+        sent.add_done_callback(lambda f: self._on_done(f, future))
+
+    def _on_done(self, sent, future):
+        """Completes a tracked publish. Runs on the MQTT event-loop thread, so only resolves
+        the future; callbacks of the future must not block
+        """
+        with self.lock:
+            priority, name, sent_at = self.inflight.pop(sent)
+        label = PRIORITIES[priority]
+        OUTBOUND_ACK_SECONDS.observe(time.monotonic() - sent_at, priority=label)
+        try:
+            result = sent.result()
+        except Exception as e:
+            OUTBOUND_PUBLISHES.inc(priority=label, result="failed")
+            future.set_exception(e)
+            return
+        OUTBOUND_PUBLISHES.inc(priority=label, result="acked")
+        future.set_result(result)
+
+    def connection(self, mqtt_connection, priority, block=False):
+        """
+        Returns:
+            PriorityConnection: mqtt_connection whose publishes go through this publisher
+        """
+        return PriorityConnection(self, mqtt_connection, priority, block)
+
+    def stats(self):
+        """
+        Returns:
+            dict: queued publishes per priority class and number in flight
+        """
+        with self.lock:
+            return {
+                "queued": {PRIORITIES[i]: len(q) for i, q in enumerate(self.queues)},
+                "inflight": len(self.inflight)
+            }
+
+    def stop(self, timeout=5):
+        """Sends what is queued, waiting up to timeout, then drops anything left
+
+        Args:
+            timeout (float, optional): Max seconds to wait for the queue to empty. Defaults to 5.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: not self.queued, timeout)
+            self.stopped = True
+            left = [(future, i, name) for i, q in enumerate(self.queues) for _, _, future, name in q]
+            for q in self.queues:
+                q.clear()
+            self.queued = 0
+            self.condition.notify_all()
+        for item in left:
+            self._drop(*item)
+
+
+class PriorityConnection:
+    """Stands in for an MQTT connection in components that publish (telemetry, query
+    responses). Publishes are queued on the outbound publisher with a fixed priority,
+    everything else (e.g. subscribe) goes to the connection
+    """
+
+    def __init__(self, outbound: OutboundPublisher, mqtt_connection, priority, block=False) -> None:
+        self.outbound = outbound
+        self.connection = mqtt_connection
+        self.priority = priority
+        self.block = block
+
+    def publish(self, topic, payload, qos, **kwargs):
+        """Same as mqtt.Connection.publish
+
+        Returns:
+            tuple: (Future resolved once acknowledged, None as the packet id isn't known yet)
+        """
+        future = self.outbound.submit(
+            self.priority, lambda: self.connection.publish(topic=topic, payload=payload, qos=qos, **kwargs)[0],
+            name=topic, block=self.block)
+        return future, None
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
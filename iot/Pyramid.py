@@ -0,0 +1,269 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, OrderedDict
+import threading
+import logging
+import os
+
+from OutputFiles import OutputFile
+from FileLedger import FileLedger
+from Reader import read_samples, AXES
+
+# Build min/max/mean preview pyramids of finished output files
+PYRAMID_ENABLED = os.environ.get("PYRAMID_ENABLED", "false").lower() == "true"
+# Bucket sizes of the pyramid levels in seconds, finest first
+PYRAMID_LEVELS = [float(s) for s in os.environ.get("PYRAMID_LEVELS", "1,10,60").split(",")]
+# Number of sidecars kept in memory for answering preview requests
+PYRAMID_CACHE_SIZE = int(os.environ.get("PYRAMID_CACHE_SIZE", 64))
+
+# Pyramid of data.feather is stored next to it in data.feather.pyramid.npz
+SIDECAR_SUFFIX = ".pyramid.npz"
+
+# Buckets of one pyramid level. times are bucket start times (epoch us), counts the number of
+# samples per bucket and min/max/mean have shape (axes, buckets)
+Level = namedtuple("Level", ["times", "counts", "min", "max", "mean"])
+
+
+def sidecar_path(path):
+    return str(path) + SIDECAR_SUFFIX
+
+
+def level_us(seconds):
+    return int(round(seconds * 1_000_000))
+
+
+def aggregate(keys, counts, mins, maxs, sums):
+    """Reduces consecutive entries with the same key into one bucket with np.*.reduceat,
+    so samples or buckets are merged without a Python loop. keys must be sorted
+
+    Returns:
+        Level: one bucket per distinct key
+    """
+    import numpy as np
+
+    if len(keys) == 0:
+        empty = np.zeros((mins.shape[0], 0), np.float32)
+        return Level(np.zeros(0, np.int64), np.zeros(0, np.int64), empty, empty, empty)
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    total = np.add.reduceat(counts, starts)
+    return Level(
+        keys[starts],
+        total,
+        np.minimum.reduceat(mins, starts, axis=1).astype(np.float32),
+        np.maximum.reduceat(maxs, starts, axis=1).astype(np.float32),
+        (np.add.reduceat(sums, starts, axis=1) / total).astype(np.float32))
+
+
+def coarsen(level: Level, bucket_us):
+    """Merges buckets of a level into buckets of bucket_us. Also merges buckets split across
+    files when bucket_us is the level's own bucket size
+
+    Returns:
+        Level: merged level
+    """
+    import numpy as np
+
+    keys = level.times // bucket_us * bucket_us
+    return aggregate(keys, level.counts, level.min, level.max,
+                     level.mean.astype(np.float64) * level.counts)
+
+
+def build_pyramid(times, axes, levels=PYRAMID_LEVELS):
+    """Builds min/max/mean buckets of samples for each level. The finest level is reduced
+    from the samples, each coarser level from the level before it. Buckets are aligned to
+    multiples of the bucket size, so buckets of consecutive files line up
+
+    Args:
+        times (numpy.ndarray): int64 epoch microseconds, sorted
+        axes (numpy.ndarray): samples of shape (axes, samples)
+        levels (list, optional): Bucket sizes in seconds. Defaults to PYRAMID_LEVELS.
+
+    Returns:
+        dict: bucket size in seconds -> Level
+    """
+    import numpy as np
+
+    pyramid = {}
+    level = None
+    for seconds in sorted(levels):
+        bucket_us = level_us(seconds)
+        if level is None:
+            level = aggregate(times // bucket_us * bucket_us, np.ones(len(times), np.int64),
+                              axes, axes, axes.astype(np.float64))
+        else:
+            level = coarsen(level, bucket_us)
+        pyramid[seconds] = level
+    return pyramid
+
+
+def save_pyramid(path, pyramid):
+    """Writes pyramid to a compressed npz sidecar, atomically
+    """
+    import numpy as np
+
+    arrays = {}
+    for seconds, level in pyramid.items():
+        for field, value in level._asdict().items():
+            arrays[f"{seconds}/{field}"] = value
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp, path)
+
+
+def load_pyramid(path):
+    """
+    Returns:
+        dict: bucket size in seconds -> Level, as written by save_pyramid
+    """
+    import numpy as np
+
+    fields = {}
+    with np.load(path) as data:
+        for key in data.files:
+            seconds, field = key.split("/")
+            fields.setdefault(float(seconds), {})[field] = data[key]
+    return {seconds: Level(**f) for seconds, f in fields.items()}
+
+
+class PyramidBuilder:
+    """Builds a min/max/mean pyramid sidecar for each finished output file so previews of
+    long time ranges are answered from a few kilobytes of buckets instead of millions of rows.
+    Sidecars are deleted along with their file
+    """
+
+    def __init__(self, ledger: FileLedger, levels=PYRAMID_LEVELS, cache_size=PYRAMID_CACHE_SIZE,
+                 extensions=("csv", "feather")) -> None:
+        """
+        Args:
+            ledger (FileLedger): ledger of output files
+            levels (list, optional): Bucket sizes in seconds. Defaults to PYRAMID_LEVELS.
+            cache_size (int, optional): Sidecars kept in memory. Defaults to PYRAMID_CACHE_SIZE.
+            extensions (tuple, optional): File types to build pyramids for. Defaults to ("csv", "feather").
+        """
+        self.levels = sorted(levels)
+        self.cache_size = cache_size
+        self.extensions = extensions
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # sidecar path -> pyramid
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pyramid")
+        ledger.add_listener(self.on_remove)
+
+        # Stats
+        self.files = 0
+        self.failed = 0
+
+    def on_file(self, output_file: OutputFile):
+        """File watcher listener. Queues file for building its pyramid
+        """
+        if output_file.ext in self.extensions:
+            self.executor.submit(self.build, output_file.path)
+
+    def on_remove(self, path):
+        """Ledger listener. Deletes sidecar of removed file
+        """
+        sidecar = sidecar_path(path)
+        with self.lock:
+            self.cache.pop(sidecar, None)
+        try:
+            os.remove(sidecar)
+        except FileNotFoundError:
+            pass
+
+    def build(self, path):
+        """Builds and saves pyramid of file
+
+        Returns:
+            dict: pyramid, or None if the file couldn't be read
+        """
+        try:
+            times, axes = read_samples(path)
+            pyramid = build_pyramid(times, axes, self.levels)
+            save_pyramid(sidecar_path(path), pyramid)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Building pyramid of {os.path.basename(str(path))} failed")
+            logging.error(e)
+            return None
+        self.files += 1
+        self.remember(sidecar_path(path), pyramid)
+        return pyramid
+
+    def remember(self, sidecar, pyramid):
+        with self.lock:
+            self.cache[sidecar] = pyramid
+            self.cache.move_to_end(sidecar)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def get(self, path):
+        """Pyramid of file, from the cache, its sidecar, or built now if the sidecar is missing
+        (e.g. files recorded before pyramids were enabled)
+
+        Returns:
+            dict: pyramid, or None if unavailable
+        """
+        sidecar = sidecar_path(path)
+        with self.lock:
+            pyramid = self.cache.get(sidecar)
+            if pyramid is not None:
+                self.cache.move_to_end(sidecar)
+                return pyramid
+        try:
+            pyramid = load_pyramid(sidecar)
+        except FileNotFoundError:
+            return self.build(path)
+        except Exception as e:
+            logging.error(f"Reading {os.path.basename(sidecar)} failed, rebuilding")
+            logging.error(e)
+            return self.build(path)
+        self.remember(sidecar, pyramid)
+        return pyramid
+
+    def choose_level(self, start_us, end_us, resolution=None, max_points=None):
+        """Picks the finest level giving at most max_points buckets over the range, or the
+        finest level at least as coarse as resolution
+
+        Returns:
+            float: bucket size in seconds
+        """
+        if resolution is not None:
+            return next((s for s in self.levels if s >= resolution), self.levels[-1])
+        if max_points:
+            span = max(end_us - start_us, 0)
+            return next((s for s in self.levels if span / level_us(s) <= max_points), self.levels[-1])
+        return self.levels[0]
+
+    def query(self, paths, start_us, end_us, seconds):
+        """Buckets of a level overlapping the range, merged across files
+
+        Args:
+            paths (list): files of sensor covering the range, oldest first
+            start_us (int): range start, epoch us
+            end_us (int): range end, epoch us
+            seconds (float): level bucket size
+
+        Returns:
+            Level: buckets, oldest first
+        """
+        import numpy as np
+
+        bucket_us = level_us(seconds)
+        parts = []
+        for path in paths:
+            pyramid = self.get(path)
+            if not pyramid or seconds not in pyramid:
+                continue
+            level = pyramid[seconds]
+            lo = np.searchsorted(level.times, start_us // bucket_us * bucket_us, side="left")
+            hi = np.searchsorted(level.times, end_us, side="right")
+            parts.append(Level(*(v[..., lo:hi] for v in level)))
+        if not parts:
+            empty = np.zeros((len(AXES), 0), np.float32)
+            return Level(np.zeros(0, np.int64), np.zeros(0, np.int64), empty, empty, empty)
+        merged = Level(*(np.concatenate(values, axis=-1) for values in zip(*parts)))
+        return coarsen(merged, bucket_us)
+
+    def stop(self, wait=False):
+        self.executor.shutdown(wait=wait)
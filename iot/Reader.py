@@ -0,0 +1,163 @@
+AXES = ("accel_x", "accel_y", "accel_z")
+
+# CSVOutput writes DateTime with its culture's general format: yyyy-MM-dd HH:mm:ss:ffffff
+CSV_TIME_WIDTH = 26
+CSV_TIME_FORMAT = "%Y-%m-%d %H:%M:%S:%f"
+# FeatherOutput.DatetimeFormat: yyyy-MM-dd_HH-mm-ss:ffffff
+FEATHER_TIME_FORMAT = "%Y-%m-%d_%H-%M-%S:%f"
+
+# Default rows per chunk of iter_samples
+READ_CHUNK_ROWS = 1 << 20
+# Approximate bytes per csv row, used to size csv read blocks
+CSV_ROW_BYTES = 64
+
+
+def parse_timestamps(values):
+    """Parses fixed width logger timestamps into int64 epoch microseconds by slicing digits
+    out of the raw bytes rather than calling strptime per row. Works for both the csv
+    (yyyy-MM-dd HH:mm:ss:ffffff) and feather (yyyy-MM-dd_HH-mm-ss:ffffff) layouts as only the
+    digit positions are used. Times are wall clock times of the device, no timezone is applied
+
+    Args:
+        values (array-like): timestamp strings or bytes
+
+    Returns:
+        numpy.ndarray: int64 epoch microseconds
+    """
+    import numpy as np
+
+    raw = np.asarray(values, dtype=f"S{CSV_TIME_WIDTH}")
+    digits = raw.view(np.uint8).reshape(-1, CSV_TIME_WIDTH)
+
+    def field(start, width):
+        # Digits of a field as int64, most significant first
+        value = digits[:, start].astype(np.int64) - ord("0")
+        for i in range(start + 1, start + width):
+            value = value * 10 + (digits[:, i] - ord("0"))
+        return value
+
+    year, month, day = field(0, 4), field(5, 2), field(8, 2)
+    hour, minute, second, micro = field(11, 2), field(14, 2), field(17, 2), field(20, 6)
+
+    months = (year - 1970) * 12 + (month - 1)
+    days = (months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+            + day - 1)
+    return ((days * 86400 + hour * 3600 + minute * 60 + second) * 1_000_000 + micro)
+
+
+def time_to_us(column):
+    """
+    Args:
+        column (pyarrow.Array|pyarrow.ChunkedArray): time column, int64 epoch microseconds
+            (transcoded files) or logger time strings
+
+    Returns:
+        numpy.ndarray: int64 epoch microseconds
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks() if column.num_chunks else pa.array([], column.type)
+    if pa.types.is_integer(column.type):
+        return column.to_numpy(zero_copy_only=False).astype(np.int64, copy=False)
+    if not len(column):
+        return np.zeros(0, np.int64)
+    return parse_timestamps(column.to_numpy(zero_copy_only=False))
+
+
+def open_feather(path):
+    """Opens feather file for reading record batches through a memory map
+
+    Returns:
+        pyarrow.ipc.RecordBatchFileReader: reader, or None for Feather V1 files (written by
+            the logger) which have no record batches
+    """
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    source = pa.memory_map(str(path))
+    try:
+        return ipc.open_file(source)
+    except pa.ArrowInvalid:
+        source.close()
+        return None
+
+
+def csv_options(columns):
+    import pyarrow as pa
+    import pyarrow.csv as csv
+
+    return csv.ConvertOptions(
+        include_columns=["time", *columns],
+        column_types={"time": pa.binary(), **{c: pa.float64() for c in columns}})
+
+
+def to_samples(table, columns):
+    """
+    Returns:
+        tuple: (int64 epoch microseconds, float64 samples of shape (columns, rows))
+    """
+    import numpy as np
+
+    times = time_to_us(table.column("time"))
+    if not len(columns):
+        return times, np.zeros((0, len(times)))
+    return times, np.stack([table.column(c).to_numpy() for c in columns])
+
+
+def read_samples(path, columns=AXES):
+    """Reads time and acceleration columns of a logger output file
+
+    Args:
+        path (str): csv or feather file
+        columns (tuple, optional): Sample columns. Defaults to AXES.
+
+    Returns:
+        tuple: (int64 epoch microseconds, float64 samples of shape (columns, rows))
+    """
+    import pyarrow.csv as csv
+    import pyarrow.feather as feather
+
+    columns = list(columns)
+    if str(path).endswith(".feather"):
+        table = feather.read_table(path, columns=["time", *columns], memory_map=True)
+    else:
+        table = csv.read_csv(path, convert_options=csv_options(columns))
+    return to_samples(table, columns)
+
+
+def iter_samples(path, columns=AXES, chunk_rows=READ_CHUNK_ROWS):
+    """Reads a logger output file chunk by chunk, so memory use doesn't depend on file size.
+    csv files are streamed in blocks of roughly chunk_rows rows, feather files are read a
+    record batch (or for Feather V1, a slice of the memory mapped columns) at a time
+
+    Args:
+        path (str): csv or feather file
+        columns (tuple, optional): Sample columns. Defaults to AXES.
+        chunk_rows (int, optional): Max rows per chunk (approximate for csv). Defaults to READ_CHUNK_ROWS.
+
+    Yields:
+        tuple: (int64 epoch microseconds, float64 samples of shape (columns, rows))
+    """
+    import pyarrow.csv as csv
+    import pyarrow.feather as feather
+
+    columns = list(columns)
+    if not str(path).endswith(".feather"):
+        reader = csv.open_csv(path, read_options=csv.ReadOptions(block_size=chunk_rows * CSV_ROW_BYTES),
+                              convert_options=csv_options(columns))
+        for batch in reader:
+            yield to_samples(batch, columns)
+        return
+
+    reader = open_feather(path)
+    if reader is None:
+        table = feather.read_table(path, columns=["time", *columns], memory_map=True)
+        for start in range(0, table.num_rows, chunk_rows):
+            yield to_samples(table.slice(start, chunk_rows), columns)
+        return
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i).select(["time", *columns])
+        for start in range(0, batch.num_rows, chunk_rows):
+            yield to_samples(batch.slice(start, chunk_rows), columns)
@@ -0,0 +1,226 @@
+from collections import namedtuple
+from datetime import datetime
+import threading
+import logging
+import shutil
+import os
+
+from OutputFiles import OUTPUT_DATA_DIR, OutputFile
+from FileLedger import FileLedger
+from Uploader import UPLOAD_STAGE
+from Metrics import REGISTRY
+
+# Max bytes of output files kept in OUTPUT_DATA_DIR. 0 disables the quota
+RETENTION_MAX_BYTES = int(os.environ.get("RETENTION_MAX_BYTES", 0))
+# Max age of output files in days. 0 disables age based eviction
+RETENTION_MAX_AGE = float(os.environ.get("RETENTION_MAX_AGE", 0))
+# Bytes kept free on the data volume so the logger can always write its next file
+RETENTION_MIN_FREE_BYTES = int(os.environ.get("RETENTION_MIN_FREE_BYTES", 256 * 1024 * 1024))
+# Seconds between retention checks
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", 60))
+# Byte values in the storage report are rounded down to a multiple of this, so the global
+# shadow is only republished when usage crosses a step rather than on every check
+RETENTION_REPORT_STEP = int(os.environ.get("RETENTION_REPORT_STEP", 256 * 1024 * 1024))
+
+EVICTED_FILES = REGISTRY.counter(
+    "retention_evicted_files_total", "Output files deleted by the retention manager",
+    ("reason", "uploaded"))
+EVICTED_BYTES = REGISTRY.counter(
+    "retention_evicted_bytes_total", "Bytes of output files deleted by the retention manager",
+    ("reason",))
+
+RetainedFile = namedtuple("RetainedFile", ["path", "sensor_id", "start", "size"])
+
+
+def round_bytes(value, step=RETENTION_REPORT_STEP):
+    """
+    Returns:
+        int: value rounded down to a multiple of step, or None if value is None
+    """
+    if value is None or step <= 0:
+        return value
+    return value - value % step
+
+
+class RetentionManager:
+    """Keeps the output directory within a byte quota, a max file age and a minimum amount of
+    free space. Files are tracked in memory from the file watcher and the ledger so checks
+    don't walk the directory. When space is needed the oldest uploaded files are deleted
+    first, then the oldest files not uploaded (yet) as a last resort so acquisition can continue
+    """
+
+    def __init__(self, ledger: FileLedger, data_dir=OUTPUT_DATA_DIR, max_bytes=RETENTION_MAX_BYTES,
+                 max_age=RETENTION_MAX_AGE, min_free_bytes=RETENTION_MIN_FREE_BYTES,
+                 report_step=RETENTION_REPORT_STEP) -> None:
+        """
+        Args:
+            ledger (FileLedger): ledger of output files and their upload state
+            data_dir (str, optional): Output directory. Defaults to OUTPUT_DATA_DIR.
+            max_bytes (int, optional): Byte quota, 0 for none. Defaults to RETENTION_MAX_BYTES.
+            max_age (float, optional): Max age in days, 0 for none. Defaults to RETENTION_MAX_AGE.
+            min_free_bytes (int, optional): Free space to keep on the volume. Defaults to RETENTION_MIN_FREE_BYTES.
+            report_step (int, optional): Granularity of byte values in the storage report. Defaults to RETENTION_REPORT_STEP.
+        """
+        self.ledger = ledger
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_free_bytes = min_free_bytes
+        self.report_step = report_step
+        self.lock = threading.Lock()
+        self.files = {}  # path -> RetainedFile
+        self.total_bytes = 0
+        self.ledger.add_listener(self.on_remove)
+
+        # Stats
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+    def load(self):
+        """Indexes files already recorded in the ledger, e.g. on startup
+        """
+        for output_file, size in self.ledger.files():
+            self.add(output_file, size)
+
+    def add(self, output_file: OutputFile, size=None):
+        key = str(output_file.path)
+        if size is None:
+            try:
+                size = os.path.getsize(key)
+            except FileNotFoundError:
+                return
+        entry = RetainedFile(key, output_file.sensor_id, output_file.start, size or 0)
+        with self.lock:
+            previous = self.files.get(key)
+            if previous:
+                self.total_bytes -= previous.size
+            self.files[key] = entry
+            self.total_bytes += entry.size
+
+    def on_file(self, output_file: OutputFile):
+        """File watcher listener. Adds completed file to the index
+        """
+        self.add(output_file)
+
+    def on_remove(self, path):
+        """Ledger listener. Drops file removed by another stage (e.g. csv after transcoding)
+        """
+        with self.lock:
+            entry = self.files.pop(path, None)
+            if entry:
+                self.total_bytes -= entry.size
+
+    def disk_usage(self):
+        try:
+            return shutil.disk_usage(self.data_dir)
+        except OSError:
+            return None
+
+    def bytes_to_free(self, disk):
+        """
+        Returns:
+            int: bytes that have to be deleted to meet the quota and free space limits
+        """
+        needed = 0
+        if self.max_bytes:
+            needed = max(needed, self.total_bytes - self.max_bytes)
+        if self.min_free_bytes and disk is not None:
+            needed = max(needed, self.min_free_bytes - disk.free)
+        return needed
+
+    def candidates(self, uploaded):
+        """Files in eviction order: uploaded files oldest first, then the rest oldest first
+
+        Returns:
+            list: RetainedFile
+        """
+        with self.lock:
+            files = list(self.files.values())
+        return sorted(files, key=lambda f: (f.path not in uploaded, f.start))
+
+    def evict(self, entry: RetainedFile, reason, uploaded):
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"{entry.sensor_id}:Deleting {os.path.basename(entry.path)} failed")
+            logging.error(e)
+            return False
+        # Removing from the ledger also drops the file from this index via on_remove
+        self.ledger.remove(entry.path)
+        self.evicted += 1
+        self.evicted_bytes += entry.size
+        EVICTED_FILES.inc(reason=reason, uploaded=str(entry.path in uploaded).lower())
+        EVICTED_BYTES.inc(entry.size, reason=reason)
+        print(f"{entry.sensor_id}:Deleted {os.path.basename(entry.path)} ({reason}, "
+              f"{'uploaded' if entry.path in uploaded else 'not uploaded'})")
+        return True
+
+    def enforce(self, now=None):
+        """Deletes files older than the max age, then the oldest files until the quota and
+        free space limits are met. Run periodically by the scheduler
+
+        Args:
+            now (datetime, optional): Current wall clock time of the device. Defaults to now.
+
+        Returns:
+            dict: storage report, see report()
+        """
+        now = datetime.now() if now is None else now
+        evicted = self.evicted
+        uploaded = self.ledger.done_paths(UPLOAD_STAGE)
+        candidates = self.candidates(uploaded)
+
+        if self.max_age:
+            cutoff = now.timestamp() - self.max_age * 86400
+            remaining = []
+            for entry in candidates:
+                if entry.start.timestamp() < cutoff:
+                    self.evict(entry, "age", uploaded)
+                else:
+                    remaining.append(entry)
+            candidates = remaining
+
+        disk = self.disk_usage()
+        needed = self.bytes_to_free(disk)
+        reason = "quota" if self.max_bytes and self.total_bytes > self.max_bytes else "free_space"
+        for entry in candidates:
+            if needed <= 0:
+                break
+            if self.evict(entry, reason, uploaded):
+                needed -= entry.size
+
+        if needed > 0:
+            logging.error(f"Retention: {needed} bytes still over limit, no more files to delete")
+        return self.report(evicting=self.evicted > evicted or needed > 0)
+
+    def report(self, evicting=False):
+        """Storage state for the global shadow. Headroom is how many bytes can still be written
+        before the retention manager starts deleting files. Byte values are rounded down to
+        report_step and per file counts are left to the metrics, so the report only changes
+        when usage crosses a step, a limit changes or eviction starts/stops
+
+        Args:
+            evicting (bool, optional): Whether the last check had to delete files. Defaults to False.
+
+        Returns:
+            dict: free, data and quota bytes, headroom and eviction state
+        """
+        disk = self.disk_usage()
+        with self.lock:
+            data_bytes = self.total_bytes
+        limits = []
+        if self.max_bytes:
+            limits.append(self.max_bytes - data_bytes)
+        if disk is not None:
+            limits.append(disk.free - self.min_free_bytes)
+        return {
+            "free_bytes": round_bytes(disk.free if disk else None, self.report_step),
+            "total_bytes": disk.total if disk else None,
+            "data_bytes": round_bytes(data_bytes, self.report_step),
+            "quota_bytes": self.max_bytes or None,
+            "headroom_bytes": round_bytes(max(0, min(limits)), self.report_step) if limits else None,
+            "evicting": evicting
+        }
+
@@ -0,0 +1,251 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
+import random
+import time
+
+from Metrics import REGISTRY
+
+TASK_SECONDS = REGISTRY.histogram(
+    "scheduled_task_seconds", "Run time of periodic tasks, e.g. the heartbeat", ("task",))
+TASK_ERRORS = REGISTRY.counter(
+    "scheduled_task_errors_total", "Periodic task runs that raised an exception", ("task",))
+
+class PeriodicTask:
+    """Task run by the Scheduler. The interval grows by backoff each run the task reports no
+    change, up to max_interval, and drops back to interval as soon as it reports a change.
+    After a boost the task runs every fast_interval until the boost expires
+    """
+
+    def __init__(self, name, fn, interval, max_interval=None, backoff=1.0, fast_interval=None,
+                 jitter=0.1, rng=None) -> None:
+        """
+        Args:
+            name (str): task name
+            fn (callable): function to run. Returning True means state changed
+            interval (float): base interval in seconds
+            max_interval (float, optional): Max interval when backing off. Defaults to interval.
+            backoff (float, optional): Interval multiplier when nothing changed. Defaults to 1.0 (fixed interval).
+            fast_interval (float, optional): Interval while boosted. Defaults to interval.
+            jitter (float, optional): Random +/- fraction applied to each interval. Defaults to 0.1.
+            rng (random.Random, optional): Source of jitter. Defaults to None.
+        """
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.max_interval = max_interval or interval
+        self.backoff = backoff
+        self.fast_interval = fast_interval or interval
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+
+        self.current = interval
+        self.fast_until = 0.0
+        self.paused = False
+        # Spread first run over one interval so devices restarted together don't run in lockstep
+        self.next_run = time.monotonic() + self.rng.uniform(0, interval)
+
+        # Stats
+        self.runs = 0
+        self.errors = 0
+
+    def next_delay(self, changed, now):
+        """Updates interval after a run
+
+        Args:
+            changed (bool): Whether the run reported a change
+            now (float): monotonic time of run
+
+        Returns:
+            float: seconds until next run
+        """
+        if changed:
+            self.current = self.interval
+        else:
+            self.current = min(self.current * self.backoff, self.max_interval)
+        delay = self.current
+        if now < self.fast_until:
+            delay = min(delay, self.fast_interval)
+        return delay * (1 + self.rng.uniform(-self.jitter, self.jitter))
+
+    def boost(self, duration, now):
+        """Runs task every fast_interval for duration seconds, starting within fast_interval
+        """
+        self.fast_until = now + duration
+        self.current = self.interval
+        self.next_run = min(self.next_run, now + self.fast_interval)
+
+
+class Scheduler:
+    """Runs periodic tasks (e.g. heartbeat) on one thread. Unlike a sleep loop, the scheduler
+    wakes up immediately when stopped, boosted or resumed, can be started again after stopping,
+    and each task adapts its interval to how often its state changes. Jitter is seeded per
+    device so a fleet restarted at the same time spreads its requests out. With workers,
+    due tasks run on a worker pool so a slow task (e.g. the heartbeat of an unresponsive
+    device in gateway mode) doesn't delay the others. A task never runs twice at once
+    """
+
+    def __init__(self, name="scheduler", seed=None, workers=0) -> None:
+        """
+        Args:
+            name (str, optional): Thread name. Defaults to "scheduler".
+            seed (str, optional): Jitter seed, e.g. device name. Defaults to None (random).
+            workers (int, optional): Worker threads running tasks. Defaults to 0 (run on the scheduler thread).
+        """
+        self.name = name
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name) if workers > 0 else None
+        self.rng = random.Random(seed)
+        self.tasks = {}
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.paused = False
+        self.thread = None
+
+    def add(self, name, fn, interval, **kwargs):
+        """Adds periodic task. See PeriodicTask for options
+
+        Returns:
+            PeriodicTask: added task
+        """
+        task = PeriodicTask(name, fn, interval, rng=self.rng, **kwargs)
+        with self.condition:
+            self.tasks[name] = task
+            self.condition.notify()
+        return task
+
+    def remove(self, name):
+        with self.condition:
+            self.tasks.pop(name, None)
+            self.condition.notify()
+
+    def select(self, name=None):
+        """Must be called with condition held
+        """
+        if name is None:
+            return list(self.tasks.values())
+        return [self.tasks[name]] if name in self.tasks else []
+
+    def boost(self, name=None, duration=30):
+        """Polls faster for a while, e.g. after a command or state change
+
+        Args:
+            name (str, optional): Task to boost. Defaults to None (all tasks).
+            duration (float, optional): Seconds to stay boosted. Defaults to 30.
+        """
+        with self.condition:
+            now = time.monotonic()
+            for task in self.select(name):
+                task.boost(duration, now)
+            self.condition.notify()
+
+    def pause(self, name=None):
+        """Pauses a task, or the whole scheduler if no name is given
+        """
+        with self.condition:
+            if name is None:
+                self.paused = True
+            else:
+                for task in self.select(name):
+                    task.paused = True
+            self.condition.notify()
+
+    def resume(self, name=None):
+        """Resumes a paused task, or the whole scheduler if no name is given
+        """
+        with self.condition:
+            if name is None:
+                self.paused = False
+            else:
+                for task in self.select(name):
+                    task.paused = False
+            self.condition.notify()
+
+    def start(self):
+        """Starts scheduler thread. Can be called again after stop
+        """
+        with self.condition:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stops scheduler thread. Returns as soon as any running task has finished
+        """
+        with self.condition:
+            self.stop_event.set()
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def shutdown(self, wait=True):
+        """Stops scheduler thread and its worker pool. Unlike stop, the scheduler can't be
+        started again
+
+        Args:
+            wait (bool, optional): Whether to wait for running tasks. Defaults to True.
+        """
+        self.stop()
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+
+    def next_task(self):
+        """Waits until the next task is due. Must be called with condition held
+
+        Returns:
+            PeriodicTask: due task, or None if stopped
+        """
+        while not self.stop_event.is_set():
+            runnable = [] if self.paused else [t for t in self.tasks.values() if not t.paused]
+            if runnable:
+                task = min(runnable, key=lambda t: t.next_run)
+                delay = task.next_run - time.monotonic()
+                if delay <= 0:
+                    return task
+                self.condition.wait(delay)
+            else:
+                self.condition.wait()
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                task = self.next_task()
+                if task is None:
+                    return
+                # Placeholder so a boost during the run isn't overwritten by the stale schedule
+                task.next_run = float("inf")
+
+            if self.executor is None:
+                self.run_task(task)
+                continue
+            try:
+                self.executor.submit(self.run_task, task)
+            except RuntimeError:
+                return
+
+    def run_task(self, task):
+        """Runs task once and schedules its next run
+        """
+        changed = False
+        start = time.perf_counter()
+        try:
+            changed = bool(task.fn())
+        except Exception as e:
+            task.errors += 1
+            TASK_ERRORS.inc(task=task.name)
+            logging.error(f"Scheduled task {task.name} failed")
+            logging.error(e)
+
+        TASK_SECONDS.observe(time.perf_counter() - start, task=task.name)
+
+        with self.condition:
+            now = time.monotonic()
+            task.runs += 1
+            boosted = task.next_run
+            task.next_run = min(now + task.next_delay(changed, now), boosted)
+            # Wake the scheduler thread, which may be waiting while the task ran on a worker
+            self.condition.notify()
@@ -0,0 +1,125 @@
+import threading
+import hashlib
+import json
+
+from Metrics import REGISTRY
+
+SETTINGS_REQUESTS = REGISTRY.counter(
+    "settings_requests_total", "Desired settings by outcome: applied, unchanged (no API call) or failed",
+    ("result",))
+
+
+def normalize_settings(value):
+    """Canonical form of settings used for comparison and hashing. The snsrpi API and the
+    cloud may use different key casing (PascalCase/camelCase) and write whole numbers as
+    floats, so keys are lower cased and integral floats become ints. Booleans are kept as is
+
+    Returns:
+        normalized copy of value
+    """
+    if isinstance(value, dict):
+        return {str(k).lower(): normalize_settings(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [normalize_settings(v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def settings_hash(settings):
+    """
+    Returns:
+        str: short content hash of the canonical form of settings, or None for no settings
+    """
+    if settings is None:
+        return None
+    canonical = json.dumps(normalize_settings(settings), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+def merge_settings(current, desired):
+    """Applies desired (possibly partial) settings to current settings. Keys are matched
+    case-insensitively so the casing used by the snsrpi API is kept, nested objects are
+    merged key by key
+
+    Returns:
+        tuple: (merged settings, list of changed key paths)
+    """
+    if not isinstance(current, dict) or not isinstance(desired, dict):
+        changed = normalize_settings(current) != normalize_settings(desired)
+        return desired, [""] if changed else []
+
+    merged = dict(current)
+    keys = {k.lower(): k for k in current}
+    changed = []
+    for key, value in desired.items():
+        existing = keys.get(key.lower(), key)
+        if existing not in current:
+            merged[existing] = value
+            changed.append(existing)
+            continue
+        merged[existing], nested = merge_settings(current[existing], value)
+        changed.extend(f"{existing}.{n}" if n else existing for n in nested)
+    return merged, changed
+
+
+class SettingsCache:
+    """Current settings of each sensor with their canonical hash. Desired settings are
+    compared by hash, so only real changes result in a PUT to /api/settings, and desired
+    settings are merged into the cached settings so partial documents only change the
+    fields they contain
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = {}  # sensor_id -> (settings, hash)
+
+    def set(self, sensor_id, settings):
+        """Stores settings reported by the snsrpi API
+
+        Returns:
+            str: settings hash
+        """
+        digest = settings_hash(settings)
+        with self.lock:
+            self.entries[sensor_id] = (settings, digest)
+        return digest
+
+    def get(self, sensor_id):
+        """
+        Returns:
+            dict: cached settings of sensor, or None
+        """
+        with self.lock:
+            return self.entries.get(sensor_id, (None, None))[0]
+
+    def hash(self, sensor_id):
+        with self.lock:
+            return self.entries.get(sensor_id, (None, None))[1]
+
+    def plan(self, sensor_id, desired, fetch=None):
+        """Works out the settings to send for desired settings
+
+        Args:
+            sensor_id (str): sensor id
+            desired (dict): desired settings, in full or only the fields to change
+            fetch (callable, optional): returns current settings of the sensor (GET /api/settings)
+                when none are cached, so partial settings aren't sent as the full document.
+                Defaults to None.
+
+        Returns:
+            tuple: (full settings to PUT, changed key paths), or None if desired settings are
+                already applied. Without cached settings or fetch, desired settings are returned
+                with changed paths ["*"]
+        """
+        with self.lock:
+            current, digest = self.entries.get(sensor_id, (None, None))
+        if current is None:
+            if fetch is None:
+                return desired, ["*"]
+            current = fetch()
+            digest = settings_hash(current)
+        merged, changed = merge_settings(current, desired)
+        if not changed or settings_hash(merged) == digest:
+            return None
+        return merged, changed
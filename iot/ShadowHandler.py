@@ -2,19 +2,85 @@ from awscrt import mqtt
 from awsiot import iotshadow
 from awsiot.iotshadow import *
 from abc import ABC, abstractmethod, abstractproperty
+from collections import OrderedDict
 from uuid import uuid4
+import threading
 import logging
+import copy
+import time
+import os
+
+from DeviceApi import DeviceApiClient
+from Dispatcher import Dispatcher
+from StateDiff import diff_state
+from PublishQueue import CoalescingPublisher, OutboundPublisher, ACK, STATE
+from OfflineQueue import OfflineQueue, SHADOW
+from SettingsCache import SettingsCache, SETTINGS_REQUESTS
+from ShadowSnapshot import updated_since
+from Metrics import REGISTRY, timed
+
+# Interval (seconds) at which the full reported state is published even if nothing has changed
+RESYNC_INTERVAL = int(os.environ.get("SHADOW_RESYNC_INTERVAL", 900))
+# Window (seconds) in which successive update requests are merged into one publish
+PUBLISH_DEBOUNCE = float(os.environ.get("SHADOW_PUBLISH_DEBOUNCE", 0.25))
+# Max seconds to wait for the shadow document when reconciling on a warm restart
+GET_TIMEOUT = float(os.environ.get("SHADOW_GET_TIMEOUT", 10))
+# Number of recently applied (client token, version) pairs remembered per shadow to drop redeliveries
+DEDUPE_SIZE = int(os.environ.get("SHADOW_DEDUPE_SIZE", 256))
+
+PUBLISHES = REGISTRY.counter(
+    "shadow_publishes_total", "Shadow update publishes by result: acked, failed, queued or skipped",
+    ("shadow", "result"))
+PUBLISH_ACK_SECONDS = REGISTRY.histogram(
+    "shadow_publish_ack_seconds", "Time from shadow update publish to broker acknowledgement, including time queued by the rate limiter",
+    ("shadow",))
+SUBSCRIBE_SECONDS = REGISTRY.histogram(
+    "shadow_subscribe_seconds", "Time to set up all subscriptions of a shadow", ("shadow",))
+SUBSCRIBE_FAILURES = REGISTRY.counter(
+    "shadow_subscribe_failures_total", "Shadows whose subscriptions failed", ("shadow",))
+CALLBACK_SECONDS = REGISTRY.histogram(
+    "shadow_callback_seconds", "Run time of shadow subscription callbacks", ("handler",))
+CALLBACK_ERRORS = REGISTRY.counter(
+    "shadow_callback_errors_total", "Shadow subscription callbacks that raised an exception", ("handler",))
+DROPPED_MESSAGES = REGISTRY.counter(
+    "shadow_messages_dropped_total", "Incoming desired state messages dropped before any device call by reason: "
+    "own (our update), duplicate (redelivered) or stale (older version than one already applied)",
+    ("shadow", "reason"))
+RECONCILES = REGISTRY.counter(
+    "shadow_reconciles_total", "Shadows on a warm restart by result: reconciled, or recreated if the get failed",
+    ("result",))
+
+
+def instrument(fn):
+    """Wraps subscription callback to record its run time and errors
+    """
+    name = fn.__name__
 
-from requests.api import request
+    def callback(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            CALLBACK_ERRORS.inc(handler=name)
+            raise
+        finally:
+            CALLBACK_SECONDS.observe(time.perf_counter() - start, handler=name)
+    return callback
 
 
 class ShadowHandler(ABC):
     """Abstract class for shadow handler class
     """
 
-    def __init__(self, client: IotShadowClient, thing, shadow, health) -> None:
+    def __init__(self, client: IotShadowClient, thing, shadow, health, dispatcher: Dispatcher = None,
+                 outbox: OfflineQueue = None, resync_interval=RESYNC_INTERVAL, debounce=PUBLISH_DEBOUNCE,
+                 dedupe_size=DEDUPE_SIZE, outbound: OutboundPublisher = None) -> None:
         super().__init__()
         self.client = client
+        self.dispatcher = dispatcher
+        self.outbox = outbox
+        # Rate limited publisher shared by all publishes of the connection. Publishes directly if None
+        self.outbound = outbound
         self.token = str(uuid4())
         self.shadow_request = {
             "thing_name": thing,
@@ -24,24 +90,148 @@ class ShadowHandler(ABC):
         self.local_state = None
         self.get_healthcheck = health
 
+        # Last reported document acknowledged by the broker. Used to only publish changes
+        self.last_reported = None
+        self.last_full_sync = 0.0
+        self.resync_interval = resync_interval
+        self.publish_seq = 0
+        self.acked_seq = 0
+        self.report_lock = threading.Lock()
+        self.publisher = CoalescingPublisher(
+            shadow, self.publish_state, debounce=debounce)
+        # Set on shutdown. Callbacks still running must not recreate a deleted shadow
+        self.deleted = False
+
+        # Last known version of the shadow document
+        self.version = None
+        # Version of the last desired state applied, and recently applied (client token, version)
+        # pairs. Messages are redelivered after a reconnect as subscriptions are QoS 1
+        self.applied_version = None
+        self.applied = OrderedDict()
+        self.dedupe_size = dedupe_size
+        self.dedupe_lock = threading.Lock()
+        # Get requests, used to reconcile with the cloud on a warm restart
+        self.get_lock = threading.Lock()
+        self.get_done = threading.Event()
+        self.get_response = None
+        self.get_subscribed = False
+
+    def callback(self, fn):
+        """Wraps subscription callback so it runs on the dispatcher worker pool rather than
+        the MQTT event-loop thread. Callbacks for the same shadow are kept in order. Keys are
+        thing/shadow so shadows of several devices (gateway mode) don't share a queue
+
+        Args:
+            fn (callable): callback function
+
+        Returns:
+            callable: callback to pass to subscription
+        """
+        fn = instrument(fn)
+        if self.dispatcher is None:
+            return fn
+        return self.dispatcher.wrap(
+            f"{self.shadow_request['thing_name']}/{self.shadow_request['shadow_name']}", fn)
+
+    def dispatch(self, fn, *args):
+        """Queues fn on this shadow's dispatcher key so it runs in order with the shadow's
+        own callbacks
+
+        Args:
+            fn (callable): function to run
+
+        Returns:
+            bool: True if queued, False if there is no dispatcher or the queue is full
+        """
+        if self.dispatcher is None:
+            return False
+        return self.dispatcher.submit(
+            f"{self.shadow_request['thing_name']}/{self.shadow_request['shadow_name']}", fn, *args)
+
     def on_shadow_rejected(self, response: ErrorResponse):
         """Callback function for shadow error response. 
-        Logs error response if any shadow request was rejected
+        Logs error response if any shadow request was rejected. As the shadow may no longer
+        match what we last reported, the next update publishes the full state
 
         Args:
             response (ErrorResponse): AWS Error response object
         """
+        self.last_reported = None
         logging.error(
             f"Get Shadow message rejected:\ncode: {response.code}\nmessage: {response.message}")
 
     def on_get_shadow_accepted(self, response: GetShadowResponse):
-        """Callback function for get/accepted shadow response. Currently does nothing
+        """Callback function for get/accepted shadow response. Hands the document to the
+        pending get_shadow call
 
         Args:
             response (GetShadowResponse): AWS Response object
         """
-        print("Get shadow successful")
-        print(response.state)
+        if response.client_token != self.token:
+            return
+        print(f"{self.shadow_request['shadow_name']}:Get shadow successful")
+        self.note_version(response.version)
+        self.get_response = response
+        self.get_done.set()
+
+    def on_get_shadow_rejected(self, response: ErrorResponse):
+        """Callback function for get/rejected shadow response, e.g. 404 if the shadow
+        doesn't exist
+
+        Args:
+            response (ErrorResponse): AWS Error response object
+        """
+        if response.client_token != self.token:
+            return
+        print(f"{self.shadow_request['shadow_name']}:Get shadow rejected: {response.code} {response.message}")
+        self.get_response = None
+        self.get_done.set()
+
+    def accept_message(self, client_token, version):
+        """Checks an incoming desired state message before it is applied. Drops our own
+        updates, redelivered messages (client token and version already applied) and
+        messages older than the last applied version, which arrive out of order after a reconnect
+
+        Args:
+            client_token (str): client token of message
+            version (int): shadow version of message
+
+        Returns:
+            bool: True if message should be applied
+        """
+        name = self.shadow_request['shadow_name']
+        reason = None
+        with self.dedupe_lock:
+            key = (client_token, version)
+            if client_token == self.token:
+                # Our own desired state (set on a cold start) replaces anything older
+                if version is not None and (self.applied_version is None or version > self.applied_version):
+                    self.applied_version = version
+                reason = "own"
+            elif key in self.applied:
+                self.applied.move_to_end(key)
+                reason = "duplicate"
+            elif version is not None and self.applied_version is not None and version <= self.applied_version:
+                reason = "stale"
+            else:
+                if client_token is not None or version is not None:
+                    self.applied[key] = True
+                    while len(self.applied) > self.dedupe_size:
+                        self.applied.popitem(last=False)
+                if version is not None:
+                    self.applied_version = version
+        if reason is None:
+            return True
+        if reason != "own":
+            print(f"{name}:Dropping {reason} message (version {version}, last applied {self.applied_version})")
+        DROPPED_MESSAGES.inc(shadow=name, reason=reason)
+        return False
+
+    def note_version(self, version):
+        """Records shadow document version from a shadow response
+        """
+        if version is not None and (self.version is None or version > self.version):
+            self.version = version
 
     def on_delete_shadow_accepted(self, response: DeleteShadowResponse):
         """Callback function for delete/accepted shadow response. Currently does nothing
@@ -82,80 +272,338 @@ class ShadowHandler(ABC):
         """
         pass
 
-    def update_state(self, override_desired=False):
-        """Updates shadow with local state stored within class.
-        Typically should only ever update 'reported' part of the state
+    def subscribe(self):
+        """Subscribes to shadow topics, recording how long the subscriptions took
+        """
+        with SUBSCRIBE_SECONDS.time(shadow=self.shadow_request['shadow_name']):
+            self.subscribe_to_shadow_topics()
+
+    def update_state(self, override_desired=False, full=False, priority=STATE):
+        """Requests shadow update with local state stored within class.
+        Requests are queued and merged with any other update requested within the debounce
+        window (or while a previous update is in flight), so bursts result in one publish
 
         Args:
             override_desired (bool, optional): If specified, will update 'desired' part of state as well as 'reported'. Defaults to False.
+            full (bool, optional): If specified, publishes full reported state instead of changes. Defaults to False.
+            priority (int, optional): Outbound priority, ACK for command results, HEARTBEAT for heartbeats. Defaults to STATE.
+        """
+        if self.deleted:
+            return
+        self.publisher.request(override_desired, full, priority)
+
+    def send(self, priority, publish):
+        """Sends a publish through the outbound publisher, or directly without one
+
+        Args:
+            priority (int): outbound priority class
+            publish (callable): publishes request, returning its future
+
+        Returns:
+            Future: resolved once the publish is acknowledged
         """
-        print(f"{self.shadow_request['shadow_name']}:Sending new state")
-        new_state = ShadowState(reported=self.local_state)
+        if self.outbound is None:
+            return publish()
+        return self.outbound.submit(priority, publish, name=self.shadow_request['shadow_name'])
+
+    def flush_updates(self, timeout=None):
+        """Publishes any queued update now and waits until in-flight updates complete
+
+        Args:
+            timeout (float, optional): Max seconds to wait. Defaults to None.
+
+        Returns:
+            bool: True if all updates were published
+        """
+        return self.publisher.flush(timeout)
+
+    def resync(self, override_desired=False, timeout=None):
+        """Publishes the full local state through the publish queue and waits for it, e.g.
+        in place of updates queued while offline
+
+        Args:
+            override_desired (bool, optional): Update desired as well as reported. Defaults to False.
+            timeout (float, optional): Max seconds to wait. Defaults to None.
+
+        Returns:
+            bool: True if the full state (or a later update) was acknowledged
+        """
+        with self.report_lock:
+            seq = self.publish_seq
+        self.update_state(override_desired, full=True)
+        self.flush_updates(timeout)
+        with self.report_lock:
+            return self.acked_seq > seq
+
+    @timed
+    def publish_state(self, override_desired=False, full=False, priority=STATE):
+        """Publishes local state stored within class to shadow.
+        Typically should only ever update 'reported' part of the state. Only keys that changed
+        since the last acknowledged report are published, and nothing is published if there
+        are no changes. The full state is sent every resync_interval seconds regardless
+
+        Args:
+            override_desired (bool, optional): If specified, will update 'desired' part of state as well as 'reported'. Defaults to False.
+            full (bool, optional): If specified, publishes full reported state instead of changes. Defaults to False.
+            priority (int, optional): Outbound priority class. Defaults to STATE.
+
+        Returns:
+            Future: publish future, or None if nothing was published
+        """
+        name = self.shadow_request['shadow_name']
+        if self.deleted:
+            return None
+        with self.report_lock:
+            snapshot = copy.deepcopy(self.local_state)
+            resync_due = time.monotonic() - self.last_full_sync >= self.resync_interval
+            full = full or override_desired or resync_due or self.last_reported is None
+
+            if full:
+                reported = snapshot
+                self.last_full_sync = time.monotonic()
+            else:
+                reported = diff_state(self.last_reported, snapshot)
+                if not reported:
+                    print(f"{name}:No state change, skipping update")
+                    PUBLISHES.inc(shadow=name, result="skipped")
+                    return None
+
+            self.publish_seq += 1
+            seq = self.publish_seq
+
+        if self.outbox is not None and not self.outbox.online:
+            # Connection is down. Store update so it's sent once the connection resumes
+            self.queue_offline(reported, snapshot if override_desired else None)
+            PUBLISHES.inc(shadow=name, result="queued")
+            return None
+
+        print(f"{name}:Sending new state ({'full' if full else 'changes'})")
+        new_state = ShadowState(reported=reported)
         if(override_desired):
-            new_state.desired = self.local_state
+            new_state.desired = snapshot
 
         request = {**self.shadow_request, **{"state": new_state}}
         try:
-            future = self.client.publish_update_named_shadow(
+            sent_at = time.perf_counter()
+            future = self.send(priority, lambda: self.client.publish_update_named_shadow(
                 request=UpdateNamedShadowRequest(**request),
                 qos=mqtt.QoS.AT_LEAST_ONCE
-            )
-            future.add_done_callback(self.on_future_callback)
+            ))
+            future.add_done_callback(
+                lambda f: self.on_published(f, snapshot, seq, sent_at))
+            return future
         except Exception as e:
             logging.error(
-                f"{self.shadow_request['shadow_name']}:Update publish failed")
+                f"{name}:Update publish failed")
             logging.error(e)
+            PUBLISHES.inc(shadow=name, result="failed")
+            return None
+
+    def queue_offline(self, reported, desired=None):
+        """Stores state update in the offline queue
+
+        Args:
+            reported (dict): reported state
+            desired (dict, optional): desired state. Defaults to None.
+        """
+        print(f"{self.shadow_request['shadow_name']}:Offline, queueing state update")
+        self.outbox.append(SHADOW, self.shadow_request['shadow_name'], {
+            "thing_name": self.shadow_request['thing_name'],
+            "shadow_name": self.shadow_request['shadow_name'],
+            "reported": reported,
+            "desired": desired
+        })
+
+    def get_shadow(self, timeout=GET_TIMEOUT):
+        """Requests the current shadow document. Subscribes to the get response topics on
+        first use, so shadows that are never reconciled don't pay for the subscriptions
+
+        Args:
+            timeout (float, optional): Max seconds to wait for the document. Defaults to GET_TIMEOUT.
+
+        Returns:
+            GetShadowResponse: shadow document, or None if the shadow doesn't exist or the request failed
+        """
+        name = self.shadow_request['shadow_name']
+        with self.get_lock:
+            self.get_response = None
+            self.get_done.clear()
+            try:
+                if not self.get_subscribed:
+                    accepted_future, _ = self.client.subscribe_to_get_named_shadow_accepted(
+                        request=GetNamedShadowSubscriptionRequest(**self.shadow_request),
+                        qos=mqtt.QoS.AT_LEAST_ONCE,
+                        callback=self.callback(self.on_get_shadow_accepted)
+                    )
+                    rejected_future, _ = self.client.subscribe_to_get_named_shadow_rejected(
+                        request=GetNamedShadowSubscriptionRequest(**self.shadow_request),
+                        qos=mqtt.QoS.AT_LEAST_ONCE,
+                        callback=self.callback(self.on_get_shadow_rejected)
+                    )
+                    accepted_future.result()
+                    rejected_future.result()
+                    self.get_subscribed = True
+                self.send(STATE, lambda: self.client.publish_get_named_shadow(
+                    request=GetNamedShadowRequest(**self.shadow_request),
+                    qos=mqtt.QoS.AT_LEAST_ONCE
+                )).result()
+            except Exception as e:
+                logging.error(f"{name}:Get shadow failed")
+                logging.error(e)
+                return None
+            if not self.get_done.wait(timeout):
+                logging.error(f"{name}:Get shadow timed out")
+                return None
+            return self.get_response
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: local state and shadow version, saved for a warm restart
+        """
+        with self.report_lock:
+            return {
+                "local_state": copy.deepcopy(self.local_state),
+                "version": self.version
+            }
+
+    def reconcile(self, entry=None, since=0):
+        """Warm restart. Fetches the shadow document and publishes only the differences
+        between it and local state instead of replacing the whole shadow. If the shadow
+        can't be fetched, the full state is published as on a cold start
+
+        Args:
+            entry (dict, optional): snapshot of this handler from the last shutdown. Defaults to None.
+            since (float, optional): epoch seconds the snapshot was saved. Defaults to 0.
+
+        Returns:
+            dict: desired state changed in the cloud since the snapshot, to pass to apply_desired, or None
+        """
+        name = self.shadow_request['shadow_name']
+        response = self.get_shadow()
+        if response is None or response.state is None:
+            print(f"{name}:Shadow not available, recreating")
+            RECONCILES.inc(result="recreated")
+            self.update_state(override_desired=True)
+            return None
+
+        state = response.state
+        with self.report_lock:
+            # The next publish is a diff against what the cloud already has
+            self.last_reported = copy.deepcopy(state.reported or {})
+            self.last_full_sync = time.monotonic()
+        with self.dedupe_lock:
+            # Desired state up to this version is reconciled here, redeliveries of older messages are stale
+            self.applied_version = response.version
+        RECONCILES.inc(result="reconciled")
+        self.update_state()
+
+        if not entry or response.version == entry.get("version") or not state.desired:
+            return None
+        metadata = (response.metadata.desired if response.metadata else None) or {}
+        desired = updated_since(state.desired, metadata, since)
+        if desired:
+            print(f"{name}:Desired state changed while offline: {desired}")
+        return desired
+
+    def apply_desired(self, desired):
+        """Applies desired state. Does nothing unless overridden by the handler
+
+        Args:
+            desired (dict): desired state
+        """
+        print(f"{self.shadow_request['shadow_name']}:Ignoring desired state {desired}")
 
     def delete_shadow(self):
         """Deletes named shadow. Used for graceful shutdown
         """
+        self.deleted = True
+        self.publisher.cancel()
         try:
-            future = self.client.publish_delete_named_shadow(
+            future = self.send(STATE, lambda: self.client.publish_delete_named_shadow(
                 request=DeleteNamedShadowRequest(**self.shadow_request),
                 qos=mqtt.QoS.AT_LEAST_ONCE,
-            )
+            ))
             future.result()
+            self.last_reported = None
             print("Shadow deleted")
         except Exception as e:
             logging.error("Delete failed")
             logging.error(f"Error: {e}")
 
-    def on_future_callback(self, future):
-        """Callback function for publishing messages
+    def on_published(self, future, reported=None, seq=0, sent_at=None):
+        """Called once the outbound publisher has the result of a state update. On success
+        records the published state as the last acknowledged report, ignoring acks that
+        arrive after a newer publish. Failed (or dropped) updates go to the offline queue,
+        which is drained right away if the connection is up, unless a newer update was
+        acknowledged in the meantime
 
         Args:
             future (Future): AWS future object. future.result() will wait for a result and raise an error if result is bad
+            reported (dict, optional): Full reported state that was published. Defaults to None.
+            seq (int, optional): Sequence number of publish. Defaults to 0.
+            sent_at (float, optional): perf_counter time of publish, for ack latency. Defaults to None.
         """
+        name = self.shadow_request['shadow_name']
+        if sent_at is not None:
+            PUBLISH_ACK_SECONDS.observe(time.perf_counter() - sent_at, shadow=name)
         try:
             future.result()
+            PUBLISHES.inc(shadow=name, result="acked")
+            with self.report_lock:
+                if reported is not None and seq > self.acked_seq:
+                    self.acked_seq = seq
+                    self.last_reported = reported
             print(
                 f"{self.shadow_request['shadow_name']}:State update publish successful.")
         except Exception as e:
             logging.error("Failed to publish state update request.")
             logging.error(e)
+            PUBLISHES.inc(shadow=name, result="failed")
+            with self.report_lock:
+                superseded = seq <= self.acked_seq
+            if self.outbox is not None and reported is not None and not self.deleted and not superseded:
+                self.queue_offline(reported)
+                # Dropped or failed while connected. Nothing else starts a drain before the
+                # next reconnect
+                if self.outbox.online:
+                    self.outbox.start_drain()
 
 
 class GlobalShadowHandler(ShadowHandler):
     """Handler class for global shadow.
-    Does not expect to receive state changes. Predominantly used for publishing state
+    Predominantly used for publishing state. Desired sensor states set on the global shadow
+    are applied to all listed sensors at once (e.g. stopping every sensor)
     """
 
-    def __init__(self, client: IotShadowClient, thing, shadow, device_endpoint, health) -> None:
-        super().__init__(client, thing, shadow, health)
-        self.device_endpoint = device_endpoint
+    def __init__(self, client: IotShadowClient, thing, shadow, api: DeviceApiClient, health, dispatcher=None,
+                 outbox=None, outbound=None) -> None:
+        super().__init__(client, thing, shadow, health, dispatcher, outbox, outbound=outbound)
+        self.api = api
 
         self.local_state = {
             "device_id": None,
             "sensors": []
         }
 
-        self.subscribe_to_shadow_topics()
         self.sensor_index = {}  # dictionary for faster indexing of sensor_id
+        self.sensor_handlers = {}  # sensor_id -> SensorShadowHandler
+        self.subscribe()
+
+    def register_sensor(self, handler):
+        """Registers sensor shadow handler used to apply global deltas for its sensor
+
+        Args:
+            handler (SensorShadowHandler): handler of sensor
+        """
+        self.sensor_handlers[handler.sensor_name] = handler
 
     def set_state(self, state, update_index=False):
+        super().set_state(state)
         if update_index:
             self.__index_state__()
 
+    @timed
     def __index_state__(self):
         """Creates dictionary of local state for faster indexing
         """
@@ -176,56 +624,184 @@ class GlobalShadowHandler(ShadowHandler):
                 request=DeleteNamedShadowSubscriptionRequest(
                     **self.shadow_request),
                 qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=self.on_delete_shadow_accepted
+                callback=self.callback(self.on_delete_shadow_accepted)
             )
 
             delete_rejected_future, _ = self.client.subscribe_to_delete_named_shadow_rejected(
                 request=DeleteNamedShadowSubscriptionRequest(
                     **self.shadow_request),
                 qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=self.on_shadow_rejected
+                callback=self.callback(self.on_shadow_rejected)
             )
 
-            delete_accepted_future.result()
-            delete_rejected_future.result()
-            print("Successfully subscribed to DELETE topics")
-
             # Subscribe to UPDATE topics
             update_rejected_future, _ = self.client.subscribe_to_update_named_shadow_rejected(
                 request=UpdateNamedShadowSubscriptionRequest(
                     **self.shadow_request),
                 qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=self.on_shadow_rejected
+                callback=self.callback(self.on_shadow_rejected)
             )
 
-            update_rejected_future.result()
+            delta_future, _ = self.client.subscribe_to_named_shadow_delta_updated_events(
+                request=NamedShadowDeltaUpdatedSubscriptionRequest(
+                    **self.shadow_request),
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.callback(self.on_update_shadow_delta)
+            )
+
+            # All subscribe requests are in flight at once, wait for them together
+            delete_accepted_future.result()
+            delete_rejected_future.result()
             print("Successfully subscribed to DELETE topics")
+            update_rejected_future.result()
+            delta_future.result()
+            print("Successfully subscribed to UPDATE topics")
 
         except Exception as e:
             logging.error("Error in subscribing to key topics")
             logging.error(f"Error: {e}")
-
-    def on_shadow_rejected(self, response: ErrorResponse):
-        logging.error(
-            f"Get Shadow message rejected:\ncode: {response.code}\nmessage: {response.message}")
+            SUBSCRIBE_FAILURES.inc(shadow=self.shadow_request['shadow_name'])
 
     def on_delete_shadow_accepted(self, response: DeleteShadowResponse):
         print(
             f"Shadow {self.shadow_request['shadow_name']} successfully deleted")
 
     def on_update_shadow_delta(self, response: ShadowDeltaUpdatedEvent):
+        """Applies desired sensor states of the global shadow, unless the delta is a
+        duplicate or older than one already applied
+
+        Args:
+            response (ShadowDeltaUpdatedEvent): AWS Delta object containing state
+        """
         print(f"{self.shadow_request['shadow_name']}: Received state delta")
-        delta_state: ShadowState = response.state
-        try:
-            for sensor in delta_state['sensors']:
-                if sensor['sensor_id'] in self.sensor_index.keys():
-                    result = self.change_sensor_state(
-                        sensor["sensor_id"], sensor["active"])
-        except Exception as e:
-            logging.error("Unexpected key error")
+        self.note_version(response.version)
+        if not self.accept_message(response.client_token, response.version):
             return
+        self.apply_desired(response.state)
 
-        self.update_state()
+    def apply_desired(self, desired):
+        """Applies desired sensor states. Each sensor is looked up through sensor_index and its
+        start/stop and settings requests are queued as one unit on the sensor shadow's
+        dispatcher key, so they run in order with that sensor's own deltas. Units of different
+        sensors run concurrently and the unit finishing last reports all results with one
+        global shadow update. Settings already applied (same hash) are skipped without calling
+        the API
+
+        Args:
+            desired (dict): desired state, e.g. {"sensors": [{"sensor_id": ..., "active": ...}]}
+        """
+        delta_state = desired or {}
+
+        units = {}  # sensor_id -> [handler, active, settings]
+        for sensor in delta_state.get('sensors') or []:
+            if not isinstance(sensor, dict):
+                continue
+            if sensor.get('active') is None and sensor.get('settings') is None:
+                continue
+            sensor_id = sensor.get('sensor_id')
+            i = self.sensor_position(sensor_id)
+            handler = self.sensor_handlers.get(sensor_id)
+            if i is None or handler is None:
+                logging.error(f"Unknown sensor {sensor_id} in global delta")
+                continue
+            unit = units.setdefault(sensor_id, [handler, None, None])
+            if sensor.get('active') is not None and self.local_state['sensors'][i]['active'] != sensor['active']:
+                unit[1] = sensor['active']
+            if sensor.get('settings') is not None:
+                if handler.settings_cache.plan(sensor_id, sensor['settings']) is None:
+                    SETTINGS_REQUESTS.inc(result="unchanged")
+                else:
+                    unit[2] = sensor['settings']
+        units = [unit for unit in units.values() if unit[1] is not None or unit[2] is not None]
+        if not units:
+            return
+
+        lock = threading.Lock()
+        remaining = [len(units)]
+        applied = {}  # sensor_id -> active state applied
+
+        def run_unit(handler, active, settings):
+            try:
+                if self.run_sensor_commands(handler, active, settings):
+                    with lock:
+                        applied[handler.sensor_name] = active
+            except Exception as e:
+                logging.error(f"{handler.sensor_name}:Commands from global delta failed")
+                logging.error(e)
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    self.report_sensor_commands(applied)
+
+        if self.dispatcher is None:
+            self.api.run_concurrently([(run_unit, tuple(unit)) for unit in units])
+            return
+        for handler, active, settings in units:
+            # Unit of a full dispatch queue is dropped like any other message
+            if not handler.dispatch(run_unit, handler, active, settings):
+                run_unit(handler, None, None)
+
+    def sensor_position(self, sensor_id):
+        """Looks up position of a sensor in local state, re-indexing if the sensor list changed
+        since it was indexed
+
+        Args:
+            sensor_id (str): id of sensor
+
+        Returns:
+            int: index in local_state['sensors'], None if sensor is unknown
+        """
+        i = self.sensor_index.get(sensor_id)
+        if i is not None and (i >= len(self.local_state['sensors'])
+                              or self.local_state['sensors'][i]['sensor_id'] != sensor_id):
+            self.__index_state__()
+            i = self.sensor_index.get(sensor_id)
+        return i
+
+    def run_sensor_commands(self, handler, active, settings):
+        """Sends start/stop and settings from a global delta to one sensor, in that order
+
+        Args:
+            handler (SensorShadowHandler): handler of sensor
+            active (bool): desired running state, None to leave unchanged
+            settings (dict): desired settings, None to leave unchanged
+
+        Returns:
+            bool: True if start/stop was applied
+        """
+        updated = False
+        active_applied = False
+        if active is not None:
+            if handler.change_sensor_running(active)['error']:
+                logging.error(f"{handler.sensor_name}:Start/stop from global delta failed")
+            else:
+                updated = active_applied = True
+        if settings is not None:
+            if handler.get_or_update_sensor_settings(settings)['error']:
+                logging.error(f"{handler.sensor_name}:Settings from global delta failed")
+            else:
+                updated = True
+
+        # Command results are acknowledged ahead of routine publishes
+        if updated:
+            handler.update_state(priority=ACK)
+        return active_applied
+
+    def report_sensor_commands(self, applied):
+        """Records start/stop results of a global delta and acknowledges them with one global
+        shadow update
+
+        Args:
+            applied (dict): sensor_id -> active state applied
+        """
+        for sensor_id, active in applied.items():
+            i = self.sensor_position(sensor_id)
+            if i is not None:
+                self.local_state['sensors'][i]['active'] = active
+        if applied:
+            self.update_state(priority=ACK)
 
 
 class SensorShadowHandler(ShadowHandler):
@@ -233,19 +809,26 @@ class SensorShadowHandler(ShadowHandler):
 
     """
 
-    def __init__(self, client: IotShadowClient, thing, shadow, sensor_name, endpoint, health) -> None:
-        super().__init__(client, thing, shadow, health)
+    def __init__(self, client: IotShadowClient, thing, shadow, sensor_name, api: DeviceApiClient, health, dispatcher=None,
+                 outbox=None, settings_cache: SettingsCache = None, outbound=None) -> None:
+        super().__init__(client, thing, shadow, health, dispatcher, outbox, outbound=outbound)
         self.sensor_name = sensor_name
-        self.device_endpoint = endpoint
+        self.api = api
+        # Settings cache is shared between sensors of a device
+        self.settings_cache = settings_cache if settings_cache is not None else SettingsCache()
         self.local_state = {
             "active": None,
-            "settings": None
+            "settings": None,
+            # Content hash of settings so the cloud can check they are in sync without comparing them
+            "settings_hash": None
         }
 
-        self.subscribe_to_shadow_topics()
+        self.subscribe()
 
     def set_state(self, key, state):
         self.local_state[key] = state
+        if key == "settings":
+            self.local_state["settings_hash"] = self.settings_cache.set(self.sensor_name, state)
         print(
             f"{self.shadow_request['shadow_name']}:Updated state for {key} to {state}")
 
@@ -260,57 +843,65 @@ class SensorShadowHandler(ShadowHandler):
                 request=DeleteNamedShadowSubscriptionRequest(
                     **self.shadow_request),
                 qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=self.on_delete_shadow_accepted
+                callback=self.callback(self.on_delete_shadow_accepted)
             )
 
             delete_rejected_future, _ = self.client.subscribe_to_delete_named_shadow_rejected(
                 request=DeleteNamedShadowSubscriptionRequest(
                     **self.shadow_request),
                 qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=self.on_shadow_rejected
+                callback=self.callback(self.on_shadow_rejected)
             )
 
-            delete_accepted_future.result()
-            delete_rejected_future.result()
-
-            print("Successfully subscribed to DELETE topics")
-
             update_future, _ = self.client.subscribe_to_update_named_shadow_accepted(
                 request=UpdateNamedShadowSubscriptionRequest(
                     ** self.shadow_request),
                 qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=self.on_update_shadow_accepted
+                callback=self.callback(self.on_update_shadow_accepted)
             )
+
+            # All subscribe requests are in flight at once, wait for them together
+            delete_accepted_future.result()
+            delete_rejected_future.result()
+            print("Successfully subscribed to DELETE topics")
             update_future.result()
             print("Successfully subscribed to udpate topics")
 
         except Exception as e:
             logging.error("Error in subscribing to key topics")
             logging.error(f"Error: {e}")
+            SUBSCRIBE_FAILURES.inc(shadow=self.shadow_request['shadow_name'])
 
     def on_update_shadow_accepted(self, response: UpdateShadowResponse):
 
-        if response.client_token == self.token:
-            return
+        self.note_version(response.version)
         state: ShadowState = response.state
-        desired = state.desired
-        if not desired:
+        if not state or not state.desired:
             return
+        # Dropped before any device API call
+        if not self.accept_message(response.client_token, response.version):
+            return
+        self.apply_desired(state.desired)
+
+    def apply_desired(self, desired):
+        """Applies desired active state and settings of sensor and reports the result
 
+        Args:
+            desired (dict): desired state
+        """
         result = {"error": None}
         if 'active' in desired.keys():
             if desired['active'] != self.local_state['active']:
                 result = self.change_sensor_running(desired['active'])
 
         if 'settings' in desired.keys():
-            if desired['settings'] != self.local_state['settings']:
-                result = self.get_or_update_sensor_settings(
-                    desired['settings'])
+            # Compared by canonical hash, so key order/casing or 1 vs 1.0 don't cause a request
+            result = self.get_or_update_sensor_settings(desired['settings'])
 
         if result['error']:
             logging.error(f"Error: {result['error']} ")
 
-        self.update_state()
+        self.update_state(priority=ACK)
         return
 
     def change_sensor_running(self, active: bool):
@@ -326,14 +917,9 @@ class SensorShadowHandler(ShadowHandler):
         print(
             f"{self.shadow_request['shadow_name']}:Sending start/stop to sensor")
 
-        url = f"http://{self.device_endpoint}/api/devices/{self.sensor_name}"
-        method = "POST"  # default
+        url = self.api.url(f"/api/devices/{self.sensor_name}")
         try:
-            resp = request(method=method, url=url, params={
-                "active": active})
-            resp.raise_for_status()
-            result = resp.json()
-
+            self.api.operate_device(self.sensor_name, active)
             self.set_state("active", active)
             result = {
                 "status": "Success",
@@ -349,30 +935,60 @@ class SensorShadowHandler(ShadowHandler):
             }
         return result
 
+    def fetch_settings(self):
+        """Fetches current settings of the sensor and stores them in local state
+
+        Returns:
+            dict: current settings
+        """
+        settings = self.api.get_settings(self.sensor_name)
+        self.set_state("settings", settings)
+        return settings
+
     def get_or_update_sensor_settings(self, settings=None):
-        """Calls snsr/api/settings endpoint. Used for both updating and fetching device settings
+        """Calls snsr/api/settings endpoint. Used for both updating and fetching device settings.
+        Desired settings are merged into the cached settings of the sensor and only sent if
+        that changes their hash
 
         Args:
             settings (dict, optional): JSON object for settings. If defined, request will update settings, 
-            otherwise request will fetch current settings. Defaults to None.
+            otherwise request will fetch current settings. May only contain the fields to change. Defaults to None.
 
         Returns:
             dict: Response object contianing success or error messages
         """
-        print(
-            f"{self.shadow_request['shadow_name']}:Invoking function get_settings")
-
-        method = "GET"  # default
-        body = None
-        url = f"http://{self.device_endpoint}/api/settings/{self.sensor_name}"
+        name = self.shadow_request['shadow_name']
         if settings:
-            method = "PUT"
-            body = settings
-
+            try:
+                # Without cached settings the current ones are fetched to merge into
+                plan = self.settings_cache.plan(self.sensor_name, settings, fetch=self.fetch_settings)
+            except Exception as e:
+                logging.error(f"{name}:Fetching current settings failed")
+                logging.error(e)
+                SETTINGS_REQUESTS.inc(result="failed")
+                return {
+                    "status": "Failed",
+                    "error": "Settings request failed"
+                }
+            if plan is None:
+                print(f"{name}:Settings unchanged ({self.settings_cache.hash(self.sensor_name)}), skipping update")
+                SETTINGS_REQUESTS.inc(result="unchanged")
+                return {
+                    "status": "Success",
+                    "error": None
+                }
+            settings, changed = plan
+            print(f"{name}:Updating settings {', '.join(changed)}")
+        else:
+            print(f"{name}:Invoking function get_settings")
+
+        url = self.api.url(f"/api/settings/{self.sensor_name}")
         try:
-            resp = request(method=method, url=url, json=body)
-            resp.raise_for_status()
-            result = resp.json()
+            if settings:
+                result = self.api.update_settings(self.sensor_name, settings)
+                SETTINGS_REQUESTS.inc(result="applied")
+            else:
+                result = self.api.get_settings(self.sensor_name)
 
             self.set_state("settings", result)
             result = {
@@ -382,14 +998,11 @@ class SensorShadowHandler(ShadowHandler):
         except Exception as e:
             logging.error(f"Request to {url} failed")
             print("Error: ", e)
+            if settings:
+                SETTINGS_REQUESTS.inc(result="failed")
             result = {
                 "status": "Failed",
                 "error": "Settings request failed"
             }
 
         return result
-
-
-if __name__ == "__main__":
-
-    shadow = GlobalShadowHandler("client", "shadow", 'thing')
@@ -0,0 +1,109 @@
+import logging
+import json
+import time
+import os
+
+from OutputFiles import OUTPUT_DATA_DIR
+
+# Keep shadows on shutdown and reconcile them with the cloud on startup instead of deleting
+# and recreating them
+WARM_RESTART = os.environ.get("SHADOW_WARM_RESTART", "false").lower() == "true"
+# Local snapshot of shadow handler state written on shutdown when WARM_RESTART is set
+SHADOW_SNAPSHOT_PATH = os.environ.get(
+    "SHADOW_SNAPSHOT_PATH", os.path.join(OUTPUT_DATA_DIR, ".iot_shadows.json"))
+
+
+def updated_since(desired, metadata, since):
+    """Parts of a desired state document updated since a time, going by the per field
+    timestamps the shadow service keeps in the document's metadata. Objects are filtered
+    key by key, arrays keep each whole element that has any field updated (so e.g. a sensor
+    entry keeps its sensor_id)
+
+    Args:
+        desired (dict): desired state of shadow
+        metadata (dict): desired metadata of shadow, same layout with {"timestamp": epoch} leaves
+        since (float): epoch seconds
+
+    Returns:
+        desired state updated after since, or None if nothing was
+    """
+    if isinstance(desired, dict) and isinstance(metadata, dict):
+        result = {}
+        for key, value in desired.items():
+            updated = updated_since(value, metadata.get(key), since)
+            if updated is not None:
+                result[key] = updated
+        return result or None
+    if isinstance(desired, list) and isinstance(metadata, list):
+        items = [value for value, meta in zip(desired, metadata)
+                 if updated_since(value, meta, since) is not None]
+        return items or None
+    if isinstance(metadata, dict) and "timestamp" in metadata:
+        # Timestamps are whole seconds, a change in the second of the snapshot counts as newer
+        return desired if metadata["timestamp"] >= int(since) else None
+    return None
+
+
+class ShadowSnapshot:
+    """Local state, shadow version and settings hash of each shadow handler, saved on
+    shutdown so the next start only reconciles differences with the cloud shadows
+    """
+
+    def __init__(self, thing, path=SHADOW_SNAPSHOT_PATH) -> None:
+        self.thing = thing
+        self.path = path
+        self.saved_at = None
+        self.shadows = {}  # shadow name -> {"local_state", "version"}
+
+    def load(self):
+        """Reads snapshot of the last shutdown. A missing or unreadable snapshot, or one of
+        another thing, gives no entries so shadows are recreated in full
+
+        Returns:
+            dict: shadow name -> snapshot entry
+        """
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error(f"Reading shadow snapshot {self.path} failed")
+            logging.error(e)
+            return {}
+        if snapshot.get("thing") != self.thing:
+            return {}
+        self.saved_at = snapshot.get("saved_at", 0)
+        self.shadows = snapshot.get("shadows", {})
+        print(f"Loaded snapshot of {len(self.shadows)} shadows saved at "
+              f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.saved_at))}")
+        return self.shadows
+
+    def get(self, shadow_name):
+        """
+        Returns:
+            dict: snapshot entry of shadow, or None
+        """
+        return self.shadows.get(shadow_name)
+
+    def save(self, handlers):
+        """Writes snapshot of shadow handlers, atomically
+
+        Args:
+            handlers (list): ShadowHandler objects
+        """
+        snapshot = {
+            "thing": self.thing,
+            "saved_at": time.time(),
+            "shadows": {h.shadow_request['shadow_name']: h.snapshot() for h in handlers}
+        }
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, self.path)
+            print(f"Saved snapshot of {len(handlers)} shadows")
+        except Exception as e:
+            logging.error(f"Writing shadow snapshot {self.path} failed")
+            logging.error(e)
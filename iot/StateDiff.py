@@ -0,0 +1,34 @@
+"""Helpers for computing structural differences between shadow state documents.
+Follows AWS shadow update semantics: nested objects are merged key by key, a key set to
+None (null) is deleted, and arrays are always replaced in full
+"""
+
+
+def diff_state(old, new):
+    """Computes the partial document needed to turn old into new
+
+    Args:
+        old (dict): last reported state
+        new (dict): current state
+
+    Returns:
+        dict: changed keys only. Removed keys are set to None. Empty if nothing changed
+    """
+    diff = {}
+    for key, value in new.items():
+        if key not in old:
+            diff[key] = value
+            continue
+
+        previous = old[key]
+        if isinstance(value, dict) and isinstance(previous, dict):
+            nested = diff_state(previous, value)
+            if nested:
+                diff[key] = nested
+        elif value != previous or type(value) != type(previous):
+            diff[key] = value
+
+    for key in old.keys() - new.keys():
+        diff[key] = None
+
+    return diff
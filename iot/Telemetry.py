@@ -0,0 +1,245 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+import logging
+import struct
+import zlib
+import os
+
+from awscrt import mqtt
+
+from OutputFiles import OutputFile, get_setting
+from Reader import read_samples
+
+# Stream finished output files as binary vibration frames over MQTT
+STREAM_TELEMETRY = os.environ.get("STREAM_TELEMETRY", "false").lower() == "true"
+# Seconds of samples per frame
+STREAM_FRAME_SECONDS = float(os.environ.get("STREAM_FRAME_SECONDS", 1))
+# Sample encoding: float32 or int16 (scaled per axis and frame)
+STREAM_ENCODING = os.environ.get("STREAM_ENCODING", "int16")
+# Delta encode samples before compression
+STREAM_DELTA = os.environ.get("STREAM_DELTA", "true").lower() == "true"
+# Frame compression: none, zlib or lz4
+STREAM_COMPRESSION = os.environ.get("STREAM_COMPRESSION", "zlib")
+
+MAGIC = b"SV"
+VERSION = 1
+# magic, version, flags, axes, reserved, sequence, base time (epoch us), interval (ns), samples
+HEADER = struct.Struct("<2sBBBxIqII")
+
+# Flags
+FLAG_INT16 = 0x01
+FLAG_DELTA = 0x02
+COMPRESSION_SHIFT = 2
+COMPRESSIONS = ("none", "zlib", "lz4")
+
+Frame = namedtuple("Frame", ["sequence", "base_time_us", "interval_ns", "axes"])
+
+
+def vibration_topic(thing, sensor_id):
+    return f"snsrpi/{thing}/vibration/{sensor_id}"
+
+
+def compress(data, compression):
+    if compression == "zlib":
+        return zlib.compress(data, 6)
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.compress(data)
+    return data
+
+
+def decompress(data, compression):
+    if compression == "zlib":
+        return zlib.decompress(data)
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    return data
+
+
+def encode_frame(axes, base_time_us, interval_ns, sequence=0, encoding=STREAM_ENCODING,
+                 delta=STREAM_DELTA, compression=STREAM_COMPRESSION):
+    """Packs a block of samples into a binary frame. Samples are stored axis by axis, either
+    as float32 or as int16 scaled to each axis' peak in the frame. Delta encoding works on the
+    integer representation of the samples so it is lossless and wraps around on overflow
+
+    Args:
+        axes (numpy.ndarray): samples, shape (axes, samples)
+        base_time_us (int): time of first sample in epoch microseconds
+        interval_ns (int): nanoseconds between samples
+        sequence (int, optional): Frame sequence number, to detect lost frames. Defaults to 0.
+        encoding (str, optional): float32 or int16. Defaults to STREAM_ENCODING.
+        delta (bool, optional): Delta encode samples. Defaults to STREAM_DELTA.
+        compression (str, optional): none, zlib or lz4. Defaults to STREAM_COMPRESSION.
+
+    Raises:
+        ValueError: on unknown encoding or compression
+
+    Returns:
+        bytes: frame
+    """
+    import numpy as np
+
+    if encoding not in ("float32", "int16"):
+        raise ValueError(f"Unknown encoding {encoding}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}")
+
+    axes = np.asarray(axes, dtype=np.float64)
+    if axes.ndim == 1:
+        axes = axes[np.newaxis, :]
+    flags = COMPRESSIONS.index(compression) << COMPRESSION_SHIFT
+    scales = b""
+
+    if encoding == "int16":
+        flags |= FLAG_INT16
+        peak = np.max(np.abs(axes), axis=1) if axes.shape[1] else np.zeros(len(axes))
+        scale = np.where(peak > 0, peak / 32767, 1.0).astype(np.float32)
+        values = np.round(axes / scale[:, np.newaxis]).clip(-32767, 32767).astype("<i2")
+        scales = scale.astype("<f4").tobytes()
+    else:
+        # Delta encode the bit pattern, not the float value, so decoding is exact
+        values = axes.astype("<f4").view("<u4")
+
+    if delta and values.shape[1] > 1:
+        flags |= FLAG_DELTA
+        values = np.concatenate([values[:, :1], np.diff(values, axis=1)], axis=1)
+
+    header = HEADER.pack(MAGIC, VERSION, flags, len(axes), sequence & 0xFFFFFFFF,
+                         int(base_time_us), int(interval_ns), axes.shape[1])
+    return header + scales + compress(np.ascontiguousarray(values).tobytes(), compression)
+
+
+def decode_frame(data):
+    """Unpacks frame created by encode_frame
+
+    Raises:
+        ValueError: if frame is not a vibration frame or has an unsupported version
+
+    Returns:
+        Frame: sequence, base_time_us, interval_ns and float32 samples of shape (axes, samples)
+    """
+    import numpy as np
+
+    magic, version, flags, n_axes, sequence, base_time_us, interval_ns, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a vibration frame")
+    if version != VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+
+    offset = HEADER.size
+    if flags & FLAG_INT16:
+        scales = np.frombuffer(data, dtype="<f4", count=n_axes, offset=offset)
+        offset += 4 * n_axes
+        dtype = "<i2"
+    else:
+        dtype = "<u4"
+    compression = COMPRESSIONS[(flags >> COMPRESSION_SHIFT) & 0x03]
+    body = decompress(bytes(data[offset:]), compression)
+    values = np.frombuffer(body, dtype=dtype).reshape(n_axes, count)
+
+    if flags & FLAG_DELTA:
+        values = np.cumsum(values, axis=1, dtype=values.dtype)
+
+    if flags & FLAG_INT16:
+        axes = values.astype(np.float32) * scales[:, np.newaxis]
+    else:
+        axes = values.view("<f4")
+    return Frame(sequence, base_time_us, interval_ns, axes)
+
+
+def frame_times(frame: Frame):
+    """
+    Returns:
+        numpy.ndarray: epoch microseconds of each sample in frame
+    """
+    import numpy as np
+    return frame.base_time_us + (np.arange(frame.axes.shape[1], dtype=np.int64) * frame.interval_ns) // 1000
+
+
+class TelemetryStreamer:
+    """Publishes each finished output file as a sequence of binary vibration frames, so data
+    can be followed in near real time over a low bandwidth link. Frames are only sent while
+    online, files are uploaded in full anyway
+    """
+
+    def __init__(self, thing, get_settings, mqtt_connection=None, outbox=None,
+                 frame_seconds=STREAM_FRAME_SECONDS, encoding=STREAM_ENCODING, delta=STREAM_DELTA,
+                 compression=STREAM_COMPRESSION, extensions=("csv", "feather")) -> None:
+        """
+        Args:
+            thing (str): thing name, used in the vibration topic
+            get_settings (callable): returns dict of sensor_id -> current sensor settings
+            mqtt_connection (mqtt.Connection, optional): connection to publish on. Can be set later. Defaults to None.
+            outbox (OfflineQueue, optional): used to check connection state. Defaults to None.
+            frame_seconds (float, optional): Seconds of samples per frame. Defaults to STREAM_FRAME_SECONDS.
+            encoding (str, optional): float32 or int16. Defaults to STREAM_ENCODING.
+            delta (bool, optional): Delta encode samples. Defaults to STREAM_DELTA.
+            compression (str, optional): none, zlib or lz4. Defaults to STREAM_COMPRESSION.
+            extensions (tuple, optional): File types to stream. Defaults to ("csv", "feather").
+        """
+        self.thing = thing
+        self.get_settings = get_settings
+        self.mqtt = mqtt_connection
+        self.outbox = outbox
+        self.frame_seconds = frame_seconds
+        self.encoding = encoding
+        self.delta = delta
+        self.compression = compression
+        self.extensions = extensions
+        self.sequence = {}  # sensor_id -> next frame sequence number
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="telemetry")
+
+        # Stats
+        self.frames = 0
+        self.samples = 0
+        self.bytes = 0
+
+    def on_file(self, output_file: OutputFile):
+        """File watcher listener. Queues file for streaming
+        """
+        if output_file.ext in self.extensions:
+            self.executor.submit(self.process, output_file)
+
+    def frames_for(self, sensor_id, times, axes, sample_rate):
+        """Splits samples into encoded frames
+
+        Returns:
+            list: frames (bytes)
+        """
+        size = max(1, int(self.frame_seconds * sample_rate))
+        interval_ns = int(round(1e9 / sample_rate))
+        frames = []
+        for start in range(0, axes.shape[1], size):
+            sequence = self.sequence.get(sensor_id, 0)
+            self.sequence[sensor_id] = sequence + 1
+            frames.append(encode_frame(
+                axes[:, start:start + size], times[start], interval_ns, sequence,
+                self.encoding, self.delta, self.compression))
+        return frames
+
+    def process(self, output_file: OutputFile):
+        sensor_id = output_file.sensor_id
+        if self.mqtt is None or (self.outbox is not None and not self.outbox.online):
+            return
+        settings = self.get_settings().get(sensor_id) or {}
+        sample_rate = get_setting(settings, "Sample_rate")
+        if not sample_rate:
+            logging.error(f"{sensor_id}:Unknown sample rate, not streaming {output_file.name}")
+            return
+        try:
+            times, axes = read_samples(output_file.path)
+            if not len(times):
+                return
+            topic = vibration_topic(self.thing, sensor_id)
+            for frame in self.frames_for(sensor_id, times, axes, sample_rate):
+                self.mqtt.publish(topic=topic, payload=frame, qos=mqtt.QoS.AT_MOST_ONCE)
+                self.frames += 1
+                self.bytes += len(frame)
+            self.samples += axes.shape[1]
+        except Exception as e:
+            logging.error(f"{sensor_id}:Streaming {output_file.name} failed")
+            logging.error(e)
+
+    def stop(self, wait=False):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,491 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+import calendar
+import logging
+import bisect
+import json
+import os
+
+from awscrt import mqtt
+
+from OutputFiles import OutputFile
+from FileLedger import FileLedger
+from Reader import AXES, CSV_TIME_WIDTH, parse_timestamps, time_to_us, open_feather
+from Metrics import REGISTRY
+
+# Answer time range queries received on snsrpi/THING_NAME/query/request
+RANGE_QUERIES = os.environ.get("RANGE_QUERIES", "false").lower() == "true"
+# Rows between checkpoints of the per file index
+TIME_INDEX_STRIDE = int(os.environ.get("TIME_INDEX_STRIDE", 1024))
+# Rows per query response message
+QUERY_CHUNK_ROWS = int(os.environ.get("QUERY_CHUNK_ROWS", 1000))
+# Max rows returned by a single query
+QUERY_MAX_ROWS = int(os.environ.get("QUERY_MAX_ROWS", 200000))
+
+QUERIES = REGISTRY.counter(
+    "range_queries_total", "Time range queries answered", ("result",))
+QUERY_ROWS = REGISTRY.counter(
+    "range_query_rows_total", "Rows returned by time range queries")
+QUERY_SECONDS = REGISTRY.histogram(
+    "range_query_seconds", "Time to answer a time range query")
+
+# Feather preferred over csv if both exist for the same start time (transcoding with keep_csv)
+EXT_PREFERENCE = ("feather", "csv")
+
+
+def query_request_topic(thing):
+    return f"snsrpi/{thing}/query/request"
+
+
+def query_response_topic(thing):
+    return f"snsrpi/{thing}/query/response"
+
+
+def to_epoch_us(value):
+    """Converts query time into the epoch microseconds used in output files. Files hold wall
+    clock times of the device, so naive ISO 8601 times are taken as device time and epoch
+    seconds and times with a timezone are converted to device local time
+
+    Args:
+        value (str|float|int): ISO 8601 time or epoch seconds
+
+    Raises:
+        ValueError: if value isn't a valid time
+
+    Returns:
+        int: epoch microseconds
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid time {value}")
+    if isinstance(value, (int, float)):
+        dt = datetime.fromtimestamp(value)
+    elif isinstance(value, str):
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is not None:
+            dt = dt.astimezone().replace(tzinfo=None)
+    else:
+        raise ValueError(f"Invalid time {value}")
+    return calendar.timegm(dt.timetuple()) * 1_000_000 + dt.microsecond
+
+
+def to_epoch(output_file: OutputFile):
+    return calendar.timegm(output_file.start.timetuple()) * 1_000_000
+
+
+class FileIndex:
+    """Index of a single output file: the time of every stride-th row and where that row
+    starts (byte offset for csv, row number for feather), so reading a time range only reads
+    the rows between the checkpoints either side of it
+    """
+
+    def __init__(self, output_file: OutputFile) -> None:
+        self.path = str(output_file.path)
+        self.ext = output_file.ext
+        self.start_us = to_epoch(output_file)
+        self.end_us = None
+        self.rows = None
+        self.times = None  # checkpoint times, epoch us
+        self.offsets = None  # checkpoint byte offsets (csv) or row numbers (feather)
+        self.batch_starts = None  # first row of each record batch (feather)
+        self.data_end = None  # byte offset after the last complete row (csv)
+
+    @property
+    def built(self):
+        return self.times is not None
+
+    def build(self, stride=TIME_INDEX_STRIDE):
+        if self.ext == "csv":
+            self.build_csv(stride)
+        else:
+            self.build_feather(stride)
+
+    def build_csv(self, stride):
+        """Finds line starts with a vectorised search for newlines over the memory mapped file
+        and parses the timestamps of the checkpoint rows only
+        """
+        import numpy as np
+
+        if os.path.getsize(self.path) == 0:
+            self.set_checkpoints(np.zeros(0, np.int64), np.zeros(0, np.int64), 0, None)
+            return
+        data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        newlines = np.flatnonzero(data == ord("\n"))
+        # First line is the header, each row starts after a newline and ends at the next one.
+        # A last line without a newline is a partial row still being written and is skipped
+        starts = newlines[:-1] + 1
+        if len(starts) == 0:
+            self.set_checkpoints(np.zeros(0, np.int64), np.zeros(0, np.int64), 0, None)
+            return
+        self.data_end = int(newlines[-1]) + 1
+        offsets = starts[::stride]
+        checkpoints = np.concatenate([offsets, starts[-1:]])
+        # Clamped so a row shorter than a timestamp can't index past the end of the file
+        positions = np.minimum(checkpoints[:, np.newaxis] + np.arange(CSV_TIME_WIDTH), len(data) - 1)
+        raw = data[positions]
+        times = parse_timestamps(np.ascontiguousarray(raw).view(f"S{CSV_TIME_WIDTH}").ravel())
+        self.set_checkpoints(times[:-1], offsets.astype(np.int64), len(starts), int(times[-1]))
+
+    def build_feather(self, stride):
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        import numpy as np
+
+        reader = open_feather(self.path)
+        if reader is not None:
+            columns = [reader.get_batch(i).column("time") for i in range(reader.num_record_batches)]
+            sizes = [len(c) for c in columns]
+            self.batch_starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64) \
+                if sizes else np.zeros(0, np.int64)
+            column = pa.chunked_array(columns, type=columns[0].type if columns else pa.int64())
+        else:
+            column = feather.read_table(self.path, columns=["time"], memory_map=True).column("time")
+        times = time_to_us(column)
+        rows = np.arange(0, len(times), stride, dtype=np.int64)
+        self.set_checkpoints(times[rows], rows, len(times), int(times[-1]) if len(times) else None)
+
+    def set_checkpoints(self, times, offsets, rows, end_us):
+        self.times = times
+        self.offsets = offsets
+        self.rows = rows
+        self.end_us = end_us
+
+    def span(self, start_us, end_us):
+        """Binary searches checkpoints for the part of the file that may hold rows in range
+
+        Returns:
+            tuple: (first, last) checkpoint offsets to read between. last is None for end of file
+        """
+        import numpy as np
+
+        first = max(int(np.searchsorted(self.times, start_us, side="right")) - 1, 0)
+        last = int(np.searchsorted(self.times, end_us, side="right"))
+        return int(self.offsets[first]), int(self.offsets[last]) if last < len(self.offsets) else None
+
+    def read(self, start_us, end_us):
+        """Reads rows of file with start_us <= time <= end_us
+
+        Returns:
+            tuple: (int64 epoch microseconds, float64 samples of shape (axes, samples))
+        """
+        import numpy as np
+
+        if not self.rows or start_us > self.end_us or end_us < self.times[0]:
+            return np.zeros(0, np.int64), np.zeros((len(AXES), 0))
+        first, last = self.span(start_us, end_us)
+        table = self.read_csv(first, last) if self.ext == "csv" else self.read_feather(first, last)
+        times = time_to_us(table.column("time"))
+        mask = (times >= start_us) & (times <= end_us)
+        axes = np.stack([table.column(a).to_numpy()[mask] for a in AXES])
+        return times[mask], axes
+
+    def read_csv(self, first, last):
+        import pyarrow as pa
+        import pyarrow.csv as csv
+
+        with open(self.path, "rb") as f:
+            header = f.readline().decode().strip().split(",")
+            f.seek(first)
+            data = f.read((self.data_end if last is None else last) - first)
+        return csv.read_csv(pa.py_buffer(data), read_options=csv.ReadOptions(column_names=header),
+                            convert_options=csv.ConvertOptions(
+                                include_columns=["time", *AXES], column_types={"time": pa.binary()}))
+
+    def read_feather(self, first, last):
+        import pyarrow as pa
+        import pyarrow.feather as feather
+
+        last = self.rows if last is None else last
+        reader = open_feather(self.path) if self.batch_starts is not None else None
+        if reader is None:
+            table = feather.read_table(self.path, columns=["time", *AXES], memory_map=True)
+            return table.slice(first, last - first)
+
+        # Only decompress the record batches overlapping the rows
+        batches = []
+        for i, batch_start in enumerate(self.batch_starts):
+            batch_end = self.batch_starts[i + 1] if i + 1 < len(self.batch_starts) else self.rows
+            if batch_end <= first or batch_start >= last:
+                continue
+            batch = reader.get_batch(i).select(["time", *AXES])
+            lo = max(first, batch_start)
+            batches.append(batch.slice(lo - batch_start, min(last, batch_end) - lo))
+        return pa.Table.from_batches(batches)
+
+
+class TimeIndex:
+    """Per sensor index of output files sorted by start time, kept up to date from the file
+    watcher and the ledger. Time range lookups binary search the file start times, then the
+    checkpoints within each file. File indexes are built in the background as files complete,
+    or on first use for files recorded before the agent started
+    """
+
+    def __init__(self, ledger: FileLedger, stride=TIME_INDEX_STRIDE, extensions=("csv", "feather")) -> None:
+        """
+        Args:
+            ledger (FileLedger): ledger of output files
+            stride (int, optional): Rows between checkpoints. Defaults to TIME_INDEX_STRIDE.
+            extensions (tuple, optional): File types to index. Defaults to ("csv", "feather").
+        """
+        self.ledger = ledger
+        self.stride = stride
+        self.extensions = extensions
+        self.lock = threading.Lock()
+        self.starts = {}  # sensor_id -> sorted list of file start times (epoch us)
+        self.entries = {}  # sensor_id -> list of dict ext -> FileIndex, parallel to starts
+        self.paths = {}  # path -> (sensor_id, FileIndex)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="time-index")
+        self.ledger.add_listener(self.on_remove)
+
+    def load(self):
+        """Indexes files already recorded in the ledger, e.g. on startup. Only start times are
+        known until a file is first queried
+        """
+        for output_file, _ in self.ledger.files():
+            self.add(output_file)
+
+    def add(self, output_file: OutputFile):
+        """
+        Returns:
+            FileIndex: index of file, or None if file type isn't indexed
+        """
+        if output_file.ext not in self.extensions:
+            return None
+        entry = FileIndex(output_file)
+        sensor_id = output_file.sensor_id
+        with self.lock:
+            starts = self.starts.setdefault(sensor_id, [])
+            entries = self.entries.setdefault(sensor_id, [])
+            i = bisect.bisect_left(starts, entry.start_us)
+            if i == len(starts) or starts[i] != entry.start_us:
+                starts.insert(i, entry.start_us)
+                entries.insert(i, {})
+            entries[i][entry.ext] = entry
+            self.paths[entry.path] = (sensor_id, entry)
+        return entry
+
+    def on_file(self, output_file: OutputFile):
+        """File watcher listener. Adds file and builds its index in the background
+        """
+        entry = self.add(output_file)
+        if entry is not None:
+            self.executor.submit(self.build, entry)
+
+    def on_remove(self, path):
+        """Ledger listener. Drops deleted file
+        """
+        with self.lock:
+            sensor_id, entry = self.paths.pop(path, (None, None))
+            if entry is None:
+                return
+            starts = self.starts[sensor_id]
+            i = bisect.bisect_left(starts, entry.start_us)
+            if i < len(starts) and starts[i] == entry.start_us:
+                self.entries[sensor_id][i].pop(entry.ext, None)
+                if not self.entries[sensor_id][i]:
+                    del starts[i]
+                    del self.entries[sensor_id][i]
+
+    def build(self, entry: FileIndex):
+        if entry.built:
+            return True
+        try:
+            entry.build(self.stride)
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.error(f"Indexing {os.path.basename(entry.path)} failed")
+            logging.error(e)
+            return False
+
+    def sensors(self):
+        with self.lock:
+            return [s for s, starts in self.starts.items() if starts]
+
+    def files_for(self, sensor_id, start_us, end_us):
+        """Files of sensor that may hold rows in range: the last file starting at or before the
+        range start, up to the last file starting at or before the range end
+
+        Returns:
+            list: FileIndex, oldest first
+        """
+        with self.lock:
+            starts = self.starts.get(sensor_id, [])
+            first = max(bisect.bisect_right(starts, start_us) - 1, 0)
+            last = bisect.bisect_right(starts, end_us)
+            found = []
+            for entries in self.entries.get(sensor_id, [])[first:last]:
+                ext = next(e for e in EXT_PREFERENCE if e in entries)
+                found.append(entries[ext])
+        return found
+
+    def query(self, sensor_id, start_us, end_us, max_rows=QUERY_MAX_ROWS):
+        """Reads rows of sensor in range, file by file
+
+        Yields:
+            tuple: (int64 epoch microseconds, float64 samples of shape (axes, samples))
+        """
+        remaining = max_rows
+        for entry in self.files_for(sensor_id, start_us, end_us):
+            if remaining <= 0:
+                return
+            if not self.build(entry):
+                continue
+            try:
+                times, axes = entry.read(start_us, end_us)
+            except FileNotFoundError:
+                continue
+            if len(times):
+                yield times[:remaining], axes[:, :remaining]
+                remaining -= len(times)
+
+    def stop(self, wait=False):
+        self.executor.shutdown(wait=wait)
+
+
+class RangeQueryService:
+    """Answers time range requests over MQTT. A request on the query/request topic, e.g.
+    {"request_id": "abc", "sensor_id": "CX1_1901", "start": "2021-09-01T14:02:00",
+    "end": "2021-09-01T14:07:00"}, is answered with a series of messages on the query/response
+    topic (or the request's response_topic) holding the matching rows, the last with done true.
+    start and end are ISO 8601 device times or epoch seconds. Requests with a resolution
+    (seconds) or max_points are answered with min/max/mean buckets from the preview pyramids
+    """
+
+    def __init__(self, thing, index: TimeIndex, mqtt_connection=None, outbox=None,
+                 chunk_rows=QUERY_CHUNK_ROWS, max_rows=QUERY_MAX_ROWS, pyramids=None) -> None:
+        """
+        Args:
+            thing (str): thing name, used in the query topics
+            index (TimeIndex): index of output files
+            mqtt_connection (mqtt.Connection, optional): connection to use. Can be set later. Defaults to None.
+            outbox (OfflineQueue, optional): used to check connection state. Defaults to None.
+            chunk_rows (int, optional): Rows per response message. Defaults to QUERY_CHUNK_ROWS.
+            max_rows (int, optional): Max rows per query. Defaults to QUERY_MAX_ROWS.
+            pyramids (PyramidBuilder, optional): answers preview requests. Defaults to None.
+        """
+        self.thing = thing
+        self.index = index
+        self.mqtt = mqtt_connection
+        self.outbox = outbox
+        self.chunk_rows = chunk_rows
+        self.max_rows = max_rows
+        self.pyramids = pyramids
+        self.sequence = 0  # sequence number of next response message
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="range-query")
+
+    def subscribe(self, timeout=10):
+        """Subscribes to the request topic. Requests are answered on a worker thread, not the
+        MQTT event-loop thread. A failed subscribe is logged rather than raised, so it doesn't
+        stop the agent starting
+
+        Args:
+            timeout (float, optional): Max seconds to wait for the subscription. Defaults to 10.
+
+        Returns:
+            bool: True if subscribed
+        """
+        topic = query_request_topic(self.thing)
+        print(f"Subscribing to {topic}")
+        try:
+            future, _ = self.mqtt.subscribe(
+                topic=topic, qos=mqtt.QoS.AT_LEAST_ONCE, callback=self.on_request)
+            future.result(timeout)
+            return True
+        except Exception as e:
+            logging.error(f"Subscribing to {topic} failed, range queries unavailable")
+            logging.error(e)
+            return False
+
+    def on_request(self, topic, payload, **kwargs):
+        self.executor.submit(self.handle, payload)
+
+    def publish(self, topic, message):
+        self.mqtt.publish(topic=topic, payload=json.dumps(message, separators=(",", ":")),
+                          qos=mqtt.QoS.AT_LEAST_ONCE)
+
+    def handle(self, payload):
+        """Parses request and streams matching rows or preview buckets back
+
+        Returns:
+            int: rows sent, or None if the request was invalid or couldn't be answered
+        """
+        try:
+            request = json.loads(payload)
+            request_id = request.get("request_id")
+            sensor_id = request["sensor_id"]
+            start_us = to_epoch_us(request["start"])
+            end_us = to_epoch_us(request["end"])
+            max_rows = min(int(request.get("max_rows", self.max_rows)), self.max_rows)
+            resolution = request.get("resolution")
+            resolution = float(resolution) if resolution is not None else None
+            max_points = int(request["max_points"]) if request.get("max_points") else None
+            topic = request.get("response_topic") or query_response_topic(self.thing)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            QUERIES.inc(result="invalid")
+            logging.error(f"Invalid range query: {e}")
+            return None
+        if self.mqtt is None or (self.outbox is not None and not self.outbox.online):
+            QUERIES.inc(result="offline")
+            return None
+
+        header = {"request_id": request_id, "sensor_id": sensor_id}
+        preview = resolution is not None or max_points is not None
+        self.sequence = 0
+        try:
+            with QUERY_SECONDS.time():
+                if preview:
+                    rows = self.send_preview(topic, header, sensor_id, start_us, end_us, resolution, max_points)
+                else:
+                    rows = self.send_rows(topic, header, sensor_id, start_us, end_us, max_rows)
+        except Exception as e:
+            QUERIES.inc(result="failed")
+            logging.error(f"{sensor_id}:Range query {request_id} failed")
+            logging.error(e)
+            self.publish(topic, {**header, "sequence": self.sequence, "done": True, "error": str(e)})
+            return None
+
+        QUERIES.inc(result="ok")
+        QUERY_ROWS.inc(rows)
+        print(f"{sensor_id}:Answered range query {request_id} with {rows} "
+              f"{'buckets' if preview else 'rows'} in {self.sequence} messages")
+        return rows
+
+    def send_chunks(self, topic, header, columns, rows):
+        for i in range(0, len(rows), self.chunk_rows):
+            self.publish(topic, {**header, "sequence": self.sequence, "done": False,
+                                 "columns": columns, "rows": rows[i:i + self.chunk_rows]})
+            self.sequence += 1
+
+    def send_rows(self, topic, header, sensor_id, start_us, end_us, max_rows):
+        rows = 0
+        available = 0
+        # One row more than max_rows is read to tell whether the result was cut short
+        for times, axes in self.index.query(sensor_id, start_us, end_us, max_rows + 1):
+            available += len(times)
+            keep = min(len(times), max_rows - rows)
+            self.send_chunks(topic, header, ["time_us", *AXES],
+                             [[int(t), *map(float, v)] for t, v in zip(times[:keep], axes[:, :keep].T)])
+            rows += keep
+        self.publish(topic, {**header, "sequence": self.sequence, "done": True,
+                             "rows_total": rows, "truncated": available > max_rows})
+        return rows
+
+    def send_preview(self, topic, header, sensor_id, start_us, end_us, resolution, max_points):
+        if self.pyramids is None:
+            raise ValueError("Previews are not enabled (PYRAMID_ENABLED)")
+        seconds = self.pyramids.choose_level(start_us, end_us, resolution, max_points)
+        paths = [f.path for f in self.index.files_for(sensor_id, start_us, end_us)]
+        level = self.pyramids.query(paths, start_us, end_us, seconds)
+        columns = ["time_us", "count", *(f"{stat}_{a}" for stat in ("min", "max", "mean") for a in AXES)]
+        stats = [level.min, level.max, level.mean]
+        rows = [[int(t), int(c), *(float(v) for s in stats for v in s[:, i])]
+                for i, (t, c) in enumerate(zip(level.times, level.counts))]
+        self.send_chunks(topic, header, columns, rows)
+        self.publish(topic, {**header, "sequence": self.sequence, "done": True,
+                             "resolution": seconds, "rows_total": len(rows)})
+        return len(rows)
+
+    def stop(self, wait=False):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,205 @@
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import logging
+import time
+import os
+
+from OutputFiles import OutputFile
+from FileLedger import FileLedger, DONE, FAILED
+from Reader import parse_timestamps
+
+# Convert finished csv files to compressed feather (Arrow IPC) files
+TRANSCODE_CSV = os.environ.get("TRANSCODE_CSV", "false").lower() == "true"
+# Compression codec for transcoded files: zstd or lz4
+TRANSCODE_COMPRESSION = os.environ.get("TRANSCODE_COMPRESSION", "zstd")
+# Number of worker processes
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", 1))
+# Name of transcode stage in file ledger
+TRANSCODE_STAGE = "transcode"
+
+def count_rows(path, chunk_size=1 << 20):
+    """Counts data rows in csv file (lines excluding the header) without parsing it
+
+    Returns:
+        int: number of rows
+    """
+    lines = 0
+    last = b"\n"
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    if last != b"\n":
+        lines += 1
+    return max(lines - 1, 0)
+
+
+def transcode_csv(path, compression=TRANSCODE_COMPRESSION):
+    """Converts a logger csv file into a compressed feather file next to it. The csv is read
+    and written batch by batch so memory use doesn't grow with file size. The output is
+    written to a temporary file, checked against the csv row count and then moved into place.
+    Runs in a worker process
+
+    Args:
+        path (str): csv file path
+        compression (str, optional): zstd or lz4. Defaults to TRANSCODE_COMPRESSION.
+
+    Raises:
+        ValueError: if row counts don't match
+
+    Returns:
+        dict: output path, rows, input/output bytes and elapsed seconds
+    """
+    import pyarrow as pa
+    import pyarrow.csv as csv
+    import pyarrow.ipc as ipc
+
+    start = time.monotonic()
+    output = os.path.splitext(path)[0] + ".feather"
+    tmp = output + ".tmp"
+
+    schema = pa.schema([
+        pa.field("time", pa.int64(), metadata={"unit": "us"}),
+        pa.field("accel_x", pa.float64()),
+        pa.field("accel_y", pa.float64()),
+        pa.field("accel_z", pa.float64())
+    ])
+    reader = csv.open_csv(path, convert_options=csv.ConvertOptions(
+        column_types={"time": pa.binary(), "accel_x": pa.float64(),
+                      "accel_y": pa.float64(), "accel_z": pa.float64()},
+        include_columns=["time", "accel_x", "accel_y", "accel_z"]))
+
+    rows = 0
+    options = ipc.IpcWriteOptions(compression=compression)
+    try:
+        with ipc.new_file(tmp, schema, options=options) as writer:
+            for batch in reader:
+                times = parse_timestamps(
+                    batch.column("time").to_numpy(zero_copy_only=False))
+                writer.write_batch(pa.record_batch(
+                    [pa.array(times, pa.int64()), batch.column("accel_x"),
+                     batch.column("accel_y"), batch.column("accel_z")],
+                    schema=schema))
+                rows += batch.num_rows
+
+        with pa.memory_map(tmp) as source:
+            written = ipc.open_file(source).read_all().num_rows
+        expected = count_rows(path)
+        if not rows == written == expected:
+            raise ValueError(
+                f"Row count mismatch for {path}: csv={expected} read={rows} written={written}")
+
+        os.replace(tmp, output)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    return {
+        "output": output,
+        "rows": rows,
+        "input_bytes": os.path.getsize(path),
+        "output_bytes": os.path.getsize(output),
+        "seconds": time.monotonic() - start
+    }
+
+
+class Transcoder:
+    """Pipeline stage converting finished csv files into compressed feather files on a
+    process pool. Once the feather file is in place the csv is removed. The file watcher picks
+    up the new feather file, so downstream stages (e.g. upload) see the compressed file
+    """
+
+    def __init__(self, ledger: FileLedger, max_workers=TRANSCODE_WORKERS,
+                 compression=TRANSCODE_COMPRESSION, keep_csv=False) -> None:
+        self.ledger = ledger
+        self.compression = compression
+        self.keep_csv = keep_csv
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.in_progress = set()
+
+        # Stats
+        self.files = 0
+        self.failed = 0
+        self.rows = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.seconds = 0.0
+
+    def on_file(self, output_file: OutputFile):
+        """File watcher listener. Queues csv files for transcoding
+        """
+        if output_file.ext == "csv":
+            self.submit(output_file)
+
+    def submit(self, output_file: OutputFile):
+        key = str(output_file.path)
+        with self.lock:
+            if key in self.in_progress:
+                return None
+            self.in_progress.add(key)
+
+        future = self.executor.submit(transcode_csv, key, self.compression)
+        future.add_done_callback(
+            lambda f: self.on_done(output_file, f))
+        return future
+
+    def on_done(self, output_file: OutputFile, future):
+        key = str(output_file.path)
+        try:
+            result = future.result()
+        except FileNotFoundError:
+            self.ledger.remove(key)
+            return
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            self.ledger.mark(key, TRANSCODE_STAGE, FAILED)
+            logging.error(f"{output_file.sensor_id}:Transcoding {output_file.name} failed")
+            logging.error(e)
+            return
+        finally:
+            with self.lock:
+                self.in_progress.discard(key)
+
+        ratio = result["input_bytes"] / max(result["output_bytes"], 1)
+        throughput = result["input_bytes"] / max(result["seconds"], 1e-9) / 1e6
+        with self.lock:
+            self.files += 1
+            self.rows += result["rows"]
+            self.input_bytes += result["input_bytes"]
+            self.output_bytes += result["output_bytes"]
+            self.seconds += result["seconds"]
+        print(f"{output_file.sensor_id}:Transcoded {output_file.name} "
+              f"({result['rows']} rows, ratio {ratio:.1f}x, {throughput:.1f}MB/s)")
+
+        if self.keep_csv:
+            self.ledger.mark(key, TRANSCODE_STAGE, DONE)
+        else:
+            os.remove(key)
+            self.ledger.remove(key)
+
+    def retry_pending(self):
+        """Queues csv files recorded in the ledger that haven't been transcoded yet
+        """
+        for f in self.ledger.pending(TRANSCODE_STAGE, max_attempts=3):
+            if f.ext == "csv":
+                self.submit(f)
+
+    def stats(self):
+        """
+        Returns:
+            dict: totals plus overall compression ratio and throughput (MB/s of csv input)
+        """
+        with self.lock:
+            return {
+                "files": self.files,
+                "failed": self.failed,
+                "rows": self.rows,
+                "compression_ratio": self.input_bytes / self.output_bytes if self.output_bytes else 0.0,
+                "throughput_mb_s": self.input_bytes / self.seconds / 1e6 if self.seconds else 0.0
+            }
+
+    def stop(self, wait=False):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,325 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import threading
+import logging
+import time
+import os
+
+import requests
+
+from OutputFiles import OutputFile, get_setting
+from FileLedger import FileLedger, DONE, FAILED
+
+# Size of each uploaded chunk/multipart part. S3 requires parts of at least 5MiB
+CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+# Number of files uploaded in parallel
+MAX_UPLOADS = int(os.environ.get("UPLOAD_MAX_WORKERS", 2))
+# Failed uploads of a file are retried until it has failed this many times
+MAX_ATTEMPTS = int(os.environ.get("UPLOAD_MAX_ATTEMPTS", 5))
+# Optional S3 endpoint override, e.g. for a local S3-compatible server
+S3_ENDPOINT_URL = os.environ.get("UPLOAD_S3_ENDPOINT_URL")
+# Name of upload stage in file ledger
+UPLOAD_STAGE = "upload"
+
+
+class HttpUploadTarget:
+    """Uploads files to a plain HTTP endpoint in chunks. Each chunk is sent as a PUT to
+    {endpoint}/{key} with a Content-Range header. Before uploading, a HEAD request to the same
+    url is used to find out how many bytes the server already has (Upload-Offset header, or
+    Content-Length of the partial file) so interrupted uploads resume where they stopped
+    """
+
+    def __init__(self, endpoint, chunk_size=CHUNK_SIZE, timeout=(3.05, 30)) -> None:
+        self.endpoint = endpoint.rstrip("/")
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def uploaded_bytes(self, url):
+        """
+        Returns:
+            int: number of bytes of file already on the server
+        """
+        resp = self.session.head(url, timeout=self.timeout)
+        if resp.status_code == 404:
+            return 0
+        resp.raise_for_status()
+        offset = resp.headers.get("Upload-Offset", resp.headers.get("Content-Length", 0))
+        return int(offset)
+
+    def upload(self, path, key):
+        """Uploads file, resuming from any previous partial upload
+
+        Args:
+            path (str): local file path
+            key (str): remote path relative to endpoint
+        """
+        url = f"{self.endpoint}/{key}"
+        size = os.path.getsize(path)
+        offset = self.uploaded_bytes(url)
+        if offset >= size:
+            return
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while offset < size:
+                chunk = f.read(self.chunk_size)
+                end = offset + len(chunk) - 1
+                resp = self.session.put(url, data=chunk, timeout=self.timeout, headers={
+                    "Content-Range": f"bytes {offset}-{end}/{size}",
+                    "Content-Type": "application/octet-stream"
+                })
+                resp.raise_for_status()
+                offset = end + 1
+
+
+class S3UploadTarget:
+    """Uploads files to an S3 bucket (endpoint s3://bucket/prefix) using multipart uploads.
+    Parts already uploaded by an unfinished multipart upload for the same key are kept, so
+    interrupted uploads resume instead of restarting
+    """
+
+    def __init__(self, endpoint, chunk_size=CHUNK_SIZE, endpoint_url=S3_ENDPOINT_URL) -> None:
+        import boto3
+        from botocore.exceptions import ClientError
+
+        parsed = urlparse(endpoint)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/")
+        self.chunk_size = max(chunk_size, 5 * 1024 * 1024)
+        self.s3 = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client_error = ClientError
+
+    def find_upload(self, key):
+        """
+        Returns:
+            str: upload id of unfinished multipart upload for key, or None
+        """
+        resp = self.s3.list_multipart_uploads(Bucket=self.bucket, Prefix=key)
+        for upload in resp.get("Uploads", []):
+            if upload["Key"] == key:
+                return upload["UploadId"]
+        return None
+
+    def is_uploaded(self, key, size):
+        try:
+            head = self.s3.head_object(Bucket=self.bucket, Key=key)
+            return head["ContentLength"] == size
+        except self.client_error:
+            return False
+
+    def upload(self, path, key):
+        """Uploads file, resuming from any previous partial multipart upload
+
+        Args:
+            path (str): local file path
+            key (str): object key relative to prefix
+        """
+        key = f"{self.prefix}/{key}" if self.prefix else key
+        size = os.path.getsize(path)
+        if self.is_uploaded(key, size):
+            return
+
+        if size <= self.chunk_size:
+            with open(path, "rb") as f:
+                self.s3.put_object(Bucket=self.bucket, Key=key, Body=f)
+            return
+
+        upload_id = self.find_upload(key)
+        done = {}
+        if upload_id:
+            paginator = self.s3.get_paginator("list_parts")
+            for page in paginator.paginate(Bucket=self.bucket, Key=key, UploadId=upload_id):
+                for part in page.get("Parts", []):
+                    done[part["PartNumber"]] = part
+        else:
+            upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=key)["UploadId"]
+
+        parts = []
+        with open(path, "rb") as f:
+            part_number = 1
+            offset = 0
+            while offset < size:
+                length = min(self.chunk_size, size - offset)
+                existing = done.get(part_number)
+                if existing and existing["Size"] == length:
+                    etag = existing["ETag"]
+                else:
+                    f.seek(offset)
+                    etag = self.s3.upload_part(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id,
+                        PartNumber=part_number, Body=f.read(length))["ETag"]
+                parts.append({"PartNumber": part_number, "ETag": etag})
+                offset += length
+                part_number += 1
+
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={"Parts": parts})
+
+
+def create_upload_target(endpoint):
+    """Creates upload target for File_upload endpoint
+
+    Args:
+        endpoint (str): s3://bucket/prefix or http(s)://host/path
+
+    Returns:
+        HttpUploadTarget|S3UploadTarget: target, or None if endpoint isn't supported
+    """
+    scheme = urlparse(endpoint or "").scheme
+    if scheme == "s3":
+        return S3UploadTarget(endpoint)
+    if scheme in ("http", "https"):
+        return HttpUploadTarget(endpoint)
+    return None
+
+
+class FileUploader:
+    """Uploads completed logger output files for each sensor with File_upload active to the
+    sensor's configured endpoint. Files are uploaded in parallel (bounded by max_workers) and
+    streamed in chunks, so large files are never held in memory. New files arrive from the
+    file watcher, upload state is kept in the file ledger and failed uploads are retried
+    periodically
+    """
+
+    def __init__(self, get_settings, ledger: FileLedger, max_workers=MAX_UPLOADS,
+                 retry_interval=60, extensions=("csv", "feather"), max_attempts=MAX_ATTEMPTS) -> None:
+        """
+        Args:
+            get_settings (callable): returns dict of sensor_id -> current sensor settings
+            ledger (FileLedger): ledger of completed files
+            max_workers (int, optional): Max parallel uploads. Defaults to MAX_UPLOADS.
+            retry_interval (int, optional): Seconds between retries of files not yet uploaded. Defaults to 60.
+            extensions (tuple, optional): File types to upload. Defaults to ("csv", "feather").
+            max_attempts (int, optional): Failed uploads of a file retried until it failed this many times. Defaults to MAX_ATTEMPTS.
+        """
+        self.get_settings = get_settings
+        self.extensions = extensions
+        self.ledger = ledger
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="upload")
+
+        self.lock = threading.Lock()
+        self.targets = {}  # endpoint -> upload target
+        self.in_progress = set()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def target_for(self, sensor_id):
+        """
+        Returns:
+            upload target for sensor, or None if upload is not active
+        """
+        settings = self.get_settings().get(sensor_id)
+        if not settings or not get_setting(settings, "File_upload", "Active"):
+            return None
+
+        endpoint = get_setting(settings, "File_upload", "Endpoint")
+        with self.lock:
+            if endpoint not in self.targets:
+                self.targets[endpoint] = create_upload_target(endpoint)
+                if self.targets[endpoint] is None:
+                    logging.error(
+                        f"{sensor_id}:Unsupported file upload endpoint {endpoint}")
+            return self.targets[endpoint]
+
+    def on_file(self, output_file: OutputFile):
+        """File watcher listener. Queues newly completed file for upload
+        """
+        self.submit(output_file)
+
+    def submit(self, output_file: OutputFile):
+        """Queues file for upload if its sensor has upload active and it isn't already
+        uploaded or uploading
+
+        Args:
+            output_file (OutputFile): file to upload
+
+        Returns:
+            Future: upload future, or None if file wasn't queued
+        """
+        if output_file.ext not in self.extensions:
+            return None
+        key = str(output_file.path)
+        target = self.target_for(output_file.sensor_id)
+        if target is None:
+            return None
+
+        # Checked and claimed under one lock so two callers can't both queue the same file
+        with self.lock:
+            if key in self.in_progress or self.ledger.state(key, UPLOAD_STAGE) == DONE:
+                return None
+            self.in_progress.add(key)
+        try:
+            return self.executor.submit(self.upload, output_file, target)
+        except RuntimeError:
+            # Uploader was stopped
+            with self.lock:
+                self.in_progress.discard(key)
+            return None
+
+    def upload(self, output_file: OutputFile, target):
+        """Uploads a single file. Remote key is <sensor_id>/<file name>
+
+        Returns:
+            bool: True if uploaded
+        """
+        key = str(output_file.path)
+        start = time.monotonic()
+        try:
+            target.upload(key, f"{output_file.sensor_id}/{output_file.name}")
+            self.ledger.mark(key, UPLOAD_STAGE, DONE)
+            print(
+                f"{output_file.sensor_id}:Uploaded {output_file.name} in {time.monotonic() - start:.1f}s")
+            return True
+        except FileNotFoundError:
+            # File was removed before it could be uploaded
+            self.ledger.remove(key)
+            return False
+        except Exception as e:
+            self.ledger.mark(key, UPLOAD_STAGE, FAILED)
+            logging.error(f"{output_file.sensor_id}:Upload of {output_file.name} failed")
+            logging.error(e)
+            return False
+        finally:
+            with self.lock:
+                self.in_progress.discard(key)
+
+    def retry_pending(self):
+        """Queues all files in the ledger that haven't been uploaded yet, skipping files
+        that failed max_attempts times
+        """
+        for f in self.ledger.pending(UPLOAD_STAGE, max_attempts=self.max_attempts):
+            self.submit(f)
+
+    def run(self):
+        """Periodically retries pending uploads until stopped
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.retry_pending()
+            except Exception as e:
+                logging.error("Queueing pending uploads failed")
+                logging.error(e)
+            self.stop_event.wait(self.retry_interval)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="uploader", daemon=True)
+        self.thread.start()
+
+    def stop(self, wait=False):
+        """Stops uploading. Queued uploads are cancelled unless wait is True, they resume on
+        next start. Uploads already running always finish, so the ledger can be closed
+        once this returns
+
+        Args:
+            wait (bool, optional): Wait for queued uploads too. Defaults to False.
+        """
+        self.stop_event.set()
+        self.executor.shutdown(wait=True, cancel_futures=not wait)
@@ -11,11 +11,15 @@ import signal
 import threading
 import json
 import time
+import logging
 from datetime import datetime, timedelta
 from uuid import uuid4
 from Device import Device
+from Gateway import Gateway, GATEWAY_DEVICES, GATEWAY_NAME, parse_devices
 
 AWS_IOT_ENDPOINT = os.environ["AWS_IOT_ENDPOINT"]
+# Max seconds to wait for the snsrpi API to respond on startup
+API_READY_TIMEOUT = float(os.environ.get("DEVICE_API_READY_TIMEOUT", 120))
 
 # io.init_logging()
 
@@ -33,6 +37,7 @@ def on_connection_interrupted(connection, error, **kwargs):
         error ([type]): [description]
     """
     print("Connection interrupted. error: {}".format(error))
+    agent.set_online(False)
 
 
 # Callback when an interrupted connection is re-established.
@@ -47,6 +52,10 @@ def on_connection_resumed(connection, return_code, session_present, **kwargs):
     print("Connection resumed. return_code: {} session_present: {}".format(
         return_code, session_present))
 
+    if return_code == mqtt.ConnectReturnCode.ACCEPTED:
+        # Drain anything queued while offline
+        agent.set_online(True)
+
     if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
         print("Session did not persist. Resubscribing to existing topics...")
         resubscribe_future, _ = connection.resubscribe_existing_topics()
@@ -79,12 +88,170 @@ def signal_handler(signal, frame):
     stop_recording_event.set()
 
 
+def start_device(device, mqtt_connection, shadow_client, connect=True):
+    """Connects to MQTT, initialises global and sensor shadows from the snsrpi API and starts
+    the heartbeat and file pipeline. Shared with the fleet benchmark so it measures the
+    same startup path
+
+    Args:
+        device (Device): device object
+        mqtt_connection (mqtt.Connection): connection, not yet connected
+        shadow_client (IotShadowClient): shadow client on mqtt_connection
+        connect (bool, optional): If False, mqtt_connection is already connected (gateway mode). Defaults to True.
+
+    Returns:
+        float: startup time in seconds
+    """
+    startup = time.monotonic()
+    connect_future = mqtt_connection.connect() if connect else None
+
+    # Probe the snsrpi API while the MQTT connection is being established rather than waiting
+    # a fixed time for it to spin up
+    phase = time.monotonic()
+    try:
+        health = device.api.wait_until_ready(timeout=API_READY_TIMEOUT)
+    except TimeoutError as e:
+        logging.error(e)
+        health = None
+    print(f"Startup: device API ready in {time.monotonic() - phase:.2f}s")
+
+    if connect_future:
+        connect_future.result() #Wait for connection result
+        print("Connected!")
+        device.set_online(True)
+        print(f"Startup: MQTT connected in {time.monotonic() - startup:.2f}s")
+
+    # Use initial healthcheck to intialise global state/shadow
+    phase = time.monotonic()
+    warm = device.load_snapshot()
+    device.set_global_shadow(shadow_client)
+    if health:
+        device.global_shadow.set_state(health, update_index=True)
+    else:
+        device.get_healthcheck()
+        device.global_shadow.set_state(device.global_shadow.local_state, update_index=True)
+    # Desired sensor states changed while down are applied once the sensor shadows exist
+    pending = device.sync_shadow(device.global_shadow, apply=False)
+    print(f"Startup: global shadow ready ({'warm' if warm else 'cold'}) in {time.monotonic() - phase:.2f}s")
+
+    # Create individual shadows/states for sensors in state. Subscriptions and settings requests
+    # run concurrently across sensors
+    device.create_sensor_shadows(shadow_client)
+    if pending:
+        device.global_shadow.apply_desired(pending)
+    print(f"Startup: ready in {time.monotonic() - startup:.2f}s")
+
+    # Enable periodic heartbest
+    device.enable_heartbeat()
+
+    # Answer time range queries over recorded files
+    if device.range_queries:
+        device.range_queries.subscribe()
+
+    # Watch for completed output files and upload them for sensors with file upload active
+    device.retention.load()
+    if device.time_index:
+        device.time_index.load()
+    device.uploader.start()
+    if device.transcoder:
+        device.transcoder.retry_pending()
+    device.file_watcher.start()
+    if device.metrics_server:
+        device.metrics_server.start()
+
+    return time.monotonic() - startup
+
+
+def stop_device(device, mqtt_connection, disconnect=True):
+    """Stops file pipeline and heartbeat, deletes shadows (or saves a snapshot of them for a
+    warm restart) and disconnects
+
+    Args:
+        device (Device): device object
+        mqtt_connection (mqtt.Connection): connected connection
+        disconnect (bool, optional): If False, the dispatcher, outbound publisher and connection are left running as they are shared, and the offline queue open until they are stopped (gateway mode). Defaults to True.
+    """
+    # Disconnect
+    print("Gracefully exitting")
+    if device.metrics_server:
+        device.metrics_server.stop()
+    device.file_watcher.stop()
+    device.uploader.stop()
+    if device.transcoder:
+        device.transcoder.stop()
+    if device.analytics:
+        device.analytics.stop()
+    if device.streamer:
+        device.streamer.stop()
+    if device.range_queries:
+        device.range_queries.stop()
+    if device.pyramids:
+        device.pyramids.stop()
+    if device.time_index:
+        device.time_index.stop()
+    device.file_ledger.close()
+    if device.snapshot:
+        device.save_shadows()
+    else:
+        device.delete_shadows()
+    if not disconnect:
+        device.api.close()
+        return
+    device.dispatcher.shutdown()
+    device.outbound.stop()
+    # Closed last, publishes that fail or are dropped while stopping are still stored
+    device.outbox.close()
+
+    print("Disconnecting...")
+    disconnect_future = mqtt_connection.disconnect()
+    disconnect_future.result()
+    print("Disconnected!")
+    device.api.close()
+
+
+def start_gateway(gateway, mqtt_connection, shadow_client):
+    """Connects to MQTT once and starts all devices of the gateway concurrently, each with
+    its own snsrpi API readiness wait
+
+    Args:
+        gateway (Gateway): gateway object
+        mqtt_connection (mqtt.Connection): connection, not yet connected
+        shadow_client (IotShadowClient): shadow client on mqtt_connection
+
+    Returns:
+        float: startup time in seconds
+    """
+    startup = time.monotonic()
+    mqtt_connection.connect().result()
+    print("Connected!")
+    gateway.set_online(True)
+
+    gateway.run_all(start_device, mqtt_connection, shadow_client, False)
+    gateway.scheduler.start()
+    if gateway.metrics_server:
+        gateway.metrics_server.start()
+    print(f"Startup: {len(gateway.devices)} devices ready in {time.monotonic() - startup:.2f}s")
+    return time.monotonic() - startup
+
+
+def stop_gateway(gateway, mqtt_connection):
+    """Stops all devices of the gateway, then the shared dispatcher, scheduler and outbound
+    publisher, and disconnects
+    """
+    gateway.run_all(stop_device, mqtt_connection, False)
+    gateway.stop()
+    for device in gateway.devices:
+        device.outbox.close()
+
+    print("Disconnecting...")
+    mqtt_connection.disconnect().result()
+    print("Disconnected!")
+
+
 if __name__ == '__main__':
 
     # Initialise
     AWS_IOT_ENDPOINT = os.environ["AWS_IOT_ENDPOINT"]
-    DEVICE_ENDPOINT = os.environ["DEVICE_ENDPOINT"]
-    DEVICE_NAME = os.environ["DEVICE_NAME"]
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -96,72 +263,53 @@ if __name__ == '__main__':
 
     proxy_options = None
 
-    # Initialise device object. This has most handler functions abstracted away
-    device = Device(DEVICE_NAME, DEVICE_ENDPOINT)
+    # Initialise device object. This has most handler functions abstracted away. In gateway
+    # mode one gateway object runs a device object per snsrpi host over the same connection
+    if GATEWAY_DEVICES:
+        agent = Gateway(parse_devices(GATEWAY_DEVICES))
+        client_id = GATEWAY_NAME
+        auth = agent.devices[0].auth
+    else:
+        DEVICE_ENDPOINT = os.environ["DEVICE_ENDPOINT"]
+        DEVICE_NAME = os.environ["DEVICE_NAME"]
+        agent = Device(DEVICE_NAME, DEVICE_ENDPOINT)
+        client_id = agent.name
+        auth = agent.auth
 
     # Initialise mqtt connection object. This does all the talking essentially
     mqtt_connection = mqtt_connection_builder.mtls_from_path(
         endpoint=AWS_IOT_ENDPOINT,
         port=443,
-        cert_filepath=device.auth.device_cert,
-        pri_key_filepath=device.auth.private_key,
+        cert_filepath=auth.device_cert,
+        pri_key_filepath=auth.private_key,
         client_bootstrap=client_bootstrap,
-        ca_filepath=device.auth.root_ca_cert,
+        ca_filepath=auth.root_ca_cert,
         on_connection_interrupted=on_connection_interrupted,
         on_connection_resumed=on_connection_resumed,
-        client_id=device.name,
+        client_id=client_id,
         clean_session=False,
         keep_alive_secs=30,
         http_proxy_options=proxy_options)
 
-    device.set_mqtt(mqtt_connection)
+    agent.set_mqtt(mqtt_connection)
 
     # Iot shadow service client
     shadow_client = iotshadow.IotShadowClient(mqtt_connection)
 
     print(
-        f"Connecting to {AWS_IOT_ENDPOINT} with client ID '{device.name}'...")
-
-    connect_future = mqtt_connection.connect()
-    connect_future.result() #Wait for connection result
-    print("Connected!")
-    time.sleep(30) #Wait for other service to spin up otherwise we risk hitting an empty endpoint
+        f"Connecting to {AWS_IOT_ENDPOINT} with client ID '{client_id}'...")
 
-    # Conduct initial healthcheck to intialise global state/shadow
-    device.set_global_shadow(shadow_client)
-    device.get_healthcheck()
-    device.global_shadow.set_state(device.global_shadow.local_state, update_index=True)
-    device.global_shadow.update_state(override_desired=True)
-
-    # Iterrate through sensors in state and create individual shadows/states 
-    sensors = device.global_shadow.local_state['sensors']
-    for s in sensors:
-        id = s['sensor_id']
-        shadow = SensorShadowHandler(
-            shadow_client, device.name, id, id, device.device_endpoint, device.get_healthcheck
-        )
-        shadow.set_state('active', s['active'])
-        result = shadow.get_or_update_sensor_settings()
-        if result['error']:
-            print(f'failed to get initial settings of sensor {id}')
-        # Need to call update state outside of call back functions otherwise we risk creating thread dead-lock
-        # and the program hangs
-        shadow.update_state(override_desired=True)
-        device.sensor_shadows.append(shadow)
-
-    # Enable periodic heartbest
-    device.enable_heartbeat()
+    if GATEWAY_DEVICES:
+        start_gateway(agent, mqtt_connection, shadow_client)
+    else:
+        start_device(agent, mqtt_connection, shadow_client)
 
     # Listen continuously/wait until stop signal received
     stop_recording_event.wait()
 
-    # Disconnect
-    print("Gracefully exitting")
-    device.delete_shadows()
+    if GATEWAY_DEVICES:
+        stop_gateway(agent, mqtt_connection)
+    else:
+        stop_device(agent, mqtt_connection)
 
-    print("Disconnecting...")
-    disconnect_future = mqtt_connection.disconnect()
-    disconnect_future.result()
-    print("Disconnected!")
-    
     exit()
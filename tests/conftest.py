@@ -0,0 +1,7 @@
+import sys
+import os
+
+# Agent modules import each other by module name, as when run from iot/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "iot"))
+# Provisioning script is run from the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
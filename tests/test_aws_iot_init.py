@@ -0,0 +1,136 @@
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("botocore")
+
+from botocore.exceptions import ClientError  # noqa: E402
+
+import aws_iot_init  # noqa: E402
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class FakeIot:
+    """In-memory IoT API. Creating a thing named in throttle is throttled once, and
+    creating a thing named in fail always fails
+    """
+
+    def __init__(self, throttle=(), fail=()):
+        self.lock = threading.Lock()
+        self.things = set()
+        self.certificates = {}
+        self.policies = set()
+        self.attached = set()
+        self.throttle = set(throttle)
+        self.fail = set(fail)
+        self.calls = []
+
+    def record(self, name):
+        with self.lock:
+            self.calls.append(name)
+
+    def describe_thing(self, thingName):
+        self.record("describe_thing")
+        if thingName not in self.things:
+            raise client_error("ResourceNotFoundException", "DescribeThing")
+        return {"thingName": thingName}
+
+    def create_thing(self, thingName):
+        self.record("create_thing")
+        with self.lock:
+            if thingName in self.throttle:
+                self.throttle.discard(thingName)
+                raise client_error("ThrottlingException", "CreateThing")
+        if thingName in self.fail:
+            raise client_error("InvalidRequestException", "CreateThing")
+        with self.lock:
+            self.things.add(thingName)
+        return {"thingName": thingName}
+
+    def add_thing_to_thing_group(self, thingName, thingGroupName):
+        self.record("add_thing_to_thing_group")
+
+    def describe_certificate(self, certificateId):
+        self.record("describe_certificate")
+        if certificateId not in self.certificates:
+            raise client_error("ResourceNotFoundException", "DescribeCertificate")
+        return {"certificateDescription": self.certificates[certificateId]}
+
+    def create_keys_and_certificate(self, setAsActive):
+        self.record("create_keys_and_certificate")
+        with self.lock:
+            cert_id = f"cert{len(self.certificates)}"
+            self.certificates[cert_id] = {"certificateId": cert_id}
+        return {
+            "certificateId": cert_id,
+            "certificateArn": f"arn:{cert_id}",
+            "certificatePem": "pem",
+            "keyPair": {"PrivateKey": "private", "PublicKey": "public"}
+        }
+
+    def create_policy(self, policyName, policyDocument):
+        self.record("create_policy")
+        with self.lock:
+            if policyName in self.policies:
+                raise client_error("ResourceAlreadyExistsException", "CreatePolicy")
+            self.policies.add(policyName)
+
+    def attach_policy(self, policyName, target):
+        with self.lock:
+            self.attached.add((policyName, target))
+
+    def attach_thing_principal(self, thingName, principal):
+        with self.lock:
+            self.attached.add((thingName, principal))
+
+
+def test_rerun_reuses_thing_certificate_and_policy(tmp_path):
+    iot = FakeIot()
+    things = [("dev1", "group"), ("dev2", None)]
+    first = aws_iot_init.provision_fleet(iot, things, tmp_path, workers=2, retries=0)
+    assert [r["thing_status"] for r in first] == ["created", "created"]
+
+    second = aws_iot_init.provision_fleet(iot, things, tmp_path, workers=2, retries=0)
+    for before, after in zip(first, second):
+        assert after["status"] == "ok"
+        assert after["thing_status"] == "existing"
+        assert after["certificate_status"] == "existing"
+        assert after["policy_status"] == "existing"
+        assert after["certificate_id"] == before["certificate_id"]
+    assert len(iot.certificates) == 2
+    assert iot.calls.count("create_thing") == 2
+    assert json.loads((tmp_path / "provisioning.json").read_text()) == second
+
+
+def test_throttled_call_is_retried(tmp_path):
+    iot = FakeIot(throttle=["dev1"])
+    [result] = aws_iot_init.provision_fleet(iot, [("dev1", None)], tmp_path, retries=1)
+    assert result["status"] == "ok"
+    assert iot.calls.count("create_thing") == 2
+
+
+def test_failing_thing_does_not_abort_others(tmp_path):
+    iot = FakeIot(fail=["bad"])
+    things = [("dev1", None), ("bad", None), ("dev2", None)]
+    results = aws_iot_init.provision_fleet(iot, things, tmp_path, workers=1, retries=0)
+    assert [r["status"] for r in results] == ["ok", "failed", "ok"]
+    assert "InvalidRequestException" in results[1]["error"]
+    assert iot.things == {"dev1", "dev2"}
+
+
+def test_limit_exceeded_is_not_retried(tmp_path):
+    iot = FakeIot()
+    calls = []
+
+    def create_keys_and_certificate(setAsActive):
+        calls.append(setAsActive)
+        raise client_error("LimitExceededException", "CreateKeysAndCertificate")
+
+    iot.create_keys_and_certificate = create_keys_and_certificate
+    [result] = aws_iot_init.provision_fleet(iot, [("dev1", None)], tmp_path, retries=3)
+    assert result["status"] == "failed"
+    assert len(calls) == 1
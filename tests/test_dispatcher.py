@@ -0,0 +1,89 @@
+import threading
+
+from Dispatcher import Dispatcher
+
+
+def test_callbacks_of_a_key_run_in_order():
+    dispatcher = Dispatcher(max_workers=4)
+    calls = []
+    for i in range(50):
+        assert dispatcher.submit("thing/a", calls.append, i)
+    dispatcher.shutdown()
+    assert calls == list(range(50))
+    assert dispatcher.stats()["processed"] == 50
+
+
+def test_group_is_limited_to_max_per_group_workers():
+    dispatcher = Dispatcher(max_workers=4, max_per_group=1)
+    release = threading.Event()
+    other_done = threading.Event()
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def work(key):
+        with lock:
+            running.append(key)
+            peak.append(len(running))
+        release.wait(5)
+        with lock:
+            running.remove(key)
+
+    for key in ("thing/a", "thing/b", "thing/c"):
+        dispatcher.submit(key, work, key)
+    # Another group still gets a worker while "thing" is busy
+    dispatcher.submit("other/a", other_done.set)
+    assert other_done.wait(5)
+    assert running == ["thing/a"]
+
+    release.set()
+    dispatcher.shutdown()
+    assert max(peak) == 1
+    assert dispatcher.stats()["processed"] == 4
+
+
+def test_parked_keys_of_a_group_take_turns():
+    dispatcher = Dispatcher(max_workers=4, max_per_group=1)
+    release = threading.Event()
+    calls = []
+    dispatcher.submit("thing/a", release.wait, 5)
+    for i in range(2):
+        dispatcher.submit("thing/a", calls.append, ("a", i))
+        dispatcher.submit("thing/b", calls.append, ("b", i))
+    release.set()
+    dispatcher.shutdown()
+    assert calls == [("b", 0), ("a", 0), ("b", 1), ("a", 1)]
+
+
+def test_message_is_dropped_when_queue_is_full():
+    dispatcher = Dispatcher(max_workers=1, max_pending=1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    assert dispatcher.submit("thing/a", block)
+    assert started.wait(5)
+    assert dispatcher.submit("thing/a", lambda: None)
+    assert not dispatcher.submit("thing/b", lambda: None)
+    release.set()
+    dispatcher.shutdown()
+    assert dispatcher.stats()["dropped"] == 1
+
+
+def test_submit_after_shutdown_is_rejected():
+    dispatcher = Dispatcher()
+    dispatcher.shutdown()
+    assert not dispatcher.submit("thing/a", lambda: None)
+    assert dispatcher.stats()["pending"] == 0
+
+
+def test_failing_callback_does_not_stop_the_key():
+    dispatcher = Dispatcher()
+    calls = []
+    dispatcher.submit("thing/a", lambda: 1 / 0)
+    dispatcher.submit("thing/a", calls.append, 1)
+    dispatcher.shutdown()
+    assert calls == [1]
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from HealthCache import HealthCache
+
+
+class Fetch:
+    """Health fetch that blocks until released, counting calls"""
+
+    def __init__(self, block=False):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+        self.error = None
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return {"call": self.calls}
+
+
+def test_fresh_snapshot_is_reused_within_ttl():
+    fetch = Fetch()
+    cache = HealthCache(fetch, ttl=60)
+    assert cache.get() == ({"call": 1}, 1)
+    assert cache.get() == ({"call": 1}, 1)
+    assert fetch.calls == 1
+    assert cache.hits == 1
+
+
+def test_expired_snapshot_is_fetched_with_new_version():
+    fetch = Fetch()
+    cache = HealthCache(fetch, ttl=0)
+    cache.get()
+    assert cache.get() == ({"call": 2}, 2)
+
+
+def test_max_age_overrides_ttl():
+    fetch = Fetch()
+    cache = HealthCache(fetch, ttl=60)
+    cache.get()
+    assert cache.get(max_age=0) == ({"call": 2}, 2)
+
+
+def test_invalidate_expires_snapshot_and_notifies_listeners():
+    fetch = Fetch()
+    cache = HealthCache(fetch, ttl=60)
+    invalidated = []
+    cache.add_listener(lambda: invalidated.append(True))
+    cache.get()
+    cache.invalidate()
+    assert invalidated == [True]
+    assert cache.get() == ({"call": 2}, 2)
+
+
+def test_concurrent_callers_share_one_fetch():
+    fetch = Fetch(block=True)
+    cache = HealthCache(fetch, ttl=60)
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get()))
+    leader.start()
+    assert fetch.started.wait(5)
+    waiters = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(4)]
+    for t in waiters:
+        t.start()
+    fetch.release.set()
+    for t in [leader, *waiters]:
+        t.join(5)
+    assert fetch.calls == 1
+    assert cache.fetches == 1
+    assert results == [({"call": 1}, 1)] * 5
+
+
+def test_fetch_error_is_raised_and_not_cached():
+    fetch = Fetch()
+    fetch.error = ConnectionError("unreachable")
+    cache = HealthCache(fetch, ttl=60)
+    with pytest.raises(ConnectionError):
+        cache.get()
+    assert cache.version == 0
+
+    fetch.error = None
+    assert cache.get() == ({"call": 2}, 1)
@@ -0,0 +1,123 @@
+from concurrent.futures import Future
+
+from OfflineQueue import OfflineQueue, collapse, merge_state, sent_prefix, SHADOW, TELEMETRY
+
+
+def shadow(key, reported, desired=None):
+    return {"kind": SHADOW, "key": key, "body": {"shadow_name": key, "reported": reported, "desired": desired}}
+
+
+def telemetry(topic, payload):
+    return {"kind": TELEMETRY, "key": topic, "body": {"topic": topic, "payload": payload}}
+
+
+def test_merge_state_merges_nested_objects():
+    assert merge_state({"a": 1, "s": {"x": 1, "y": 2}}, {"s": {"y": 3}, "b": 2}) == \
+        {"a": 1, "s": {"x": 1, "y": 3}, "b": 2}
+
+
+def test_merge_state_none_and_arrays_replace():
+    merged = merge_state({"a": {"x": 1}, "l": [1, 2, 3]}, {"a": None, "l": [4]})
+    assert merged == {"a": None, "l": [4]}
+
+
+def test_merge_state_non_dict_replaces():
+    assert merge_state(None, {"a": 1}) == {"a": 1}
+    assert merge_state({"a": 1}, None) is None
+
+
+def test_collapse_merges_updates_of_a_shadow_at_latest_position():
+    records = [
+        shadow("global", {"cpu": 1, "storage": {"free": 10}}),
+        telemetry("t", "1"),
+        shadow("s1", {"active": True}),
+        shadow("global", {"storage": {"used": 5}}),
+        telemetry("t", "2"),
+    ]
+    result = collapse(records)
+    assert [(r["kind"], r["key"], r["position"]) for r in result] == [
+        (TELEMETRY, "t", 1), (SHADOW, "s1", 2), (SHADOW, "global", 3), (TELEMETRY, "t", 4)]
+    assert result[2]["body"]["reported"] == {"cpu": 1, "storage": {"free": 10, "used": 5}}
+
+
+def test_collapse_keeps_telemetry_in_order():
+    records = [telemetry("t", str(i)) for i in range(5)]
+    assert [r["body"]["payload"] for r in collapse(records)] == ["0", "1", "2", "3", "4"]
+
+
+def test_sent_prefix_stops_at_shadow_not_yet_sent():
+    records = [telemetry("t", "1"), shadow("a", {}), telemetry("t", "2"), shadow("a", {}), telemetry("t", "3")]
+    # Collapsed messages are sent at positions 0, 2, 3, 4
+    assert sent_prefix(records, 0) == 0
+    assert sent_prefix(records, 2) == 1
+    assert sent_prefix(records, 3) == 1
+    assert sent_prefix(records, 4) == 4
+    assert sent_prefix(records, 5) == 5
+
+
+def make_queue(tmp_path, fail=()):
+    queue = OfflineQueue(str(tmp_path / "outbox"), drain_rate=0)
+    sent = []
+
+    def publish(body):
+        future = Future()
+        name = body.get("payload") or body.get("shadow_name")
+        if name in fail:
+            future.set_exception(RuntimeError("publish failed"))
+        else:
+            sent.append(name)
+            future.set_result(None)
+        return future
+
+    queue.register(SHADOW, publish)
+    queue.register(TELEMETRY, publish)
+    return queue, sent
+
+
+def test_queue_is_not_created_until_used(tmp_path):
+    queue = OfflineQueue(str(tmp_path / "outbox"))
+    assert not (tmp_path / "outbox").exists()
+    assert queue.size() == 0
+    queue.close()
+
+
+def test_drain_sends_in_order_and_empties_queue(tmp_path):
+    queue, sent = make_queue(tmp_path)
+    for i in range(3):
+        queue.append(TELEMETRY, "t", {"topic": "t", "payload": str(i)})
+    queue.online = True
+    assert queue.drain() == 3
+    assert sent == ["0", "1", "2"]
+    assert queue.is_empty()
+    queue.close()
+
+
+def test_drain_failure_commits_messages_already_sent(tmp_path):
+    queue, sent = make_queue(tmp_path, fail={"3"})
+    queue.append(TELEMETRY, "t", {"topic": "t", "payload": "1"})
+    queue.append(SHADOW, "a", {"shadow_name": "a", "reported": {"x": 1}, "desired": None})
+    queue.append(TELEMETRY, "t", {"topic": "t", "payload": "2"})
+    queue.append(SHADOW, "a", {"shadow_name": "a", "reported": {"y": 2}, "desired": None})
+    queue.append(TELEMETRY, "t", {"topic": "t", "payload": "3"})
+    queue.online = True
+    assert queue.drain() == 3
+    assert sent == ["1", "2", "a"]
+
+    # Only the failed message is left after a restart
+    queue.close()
+    queue, sent = make_queue(tmp_path)
+    queue.online = True
+    assert queue.drain() == 1
+    assert sent == ["3"]
+    queue.close()
+
+
+def test_queue_survives_reopen(tmp_path):
+    queue, _ = make_queue(tmp_path)
+    queue.append(SHADOW, "a", {"shadow_name": "a", "reported": {"x": 1}, "desired": None})
+    queue.close()
+    queue, sent = make_queue(tmp_path)
+    queue.online = True
+    assert queue.drain() == 1
+    assert sent == ["a"]
+    queue.close()
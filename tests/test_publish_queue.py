@@ -0,0 +1,206 @@
+from concurrent.futures import Future
+import threading
+
+import pytest
+
+from PublishQueue import CoalescingPublisher, OutboundPublisher, TokenBucket, ACK, STATE, HEARTBEAT, TELEMETRY
+
+
+class Publish:
+    """Publish callable whose futures complete as told by the test"""
+
+    def __init__(self, result=True):
+        self.result = result
+        self.calls = []
+        self.futures = []
+        self.sent = threading.Event()
+
+    def __call__(self, override_desired, full, priority):
+        self.calls.append((override_desired, full, priority))
+        future = Future() if self.result else None
+        if future is not None:
+            self.futures.append(future)
+        self.sent.set()
+        return future
+
+
+def make_publisher(publish, **kwargs):
+    # Long debounce so only flush publishes, unless a test asks otherwise
+    kwargs.setdefault("debounce", 60)
+    return CoalescingPublisher("s1", publish, **kwargs)
+
+
+def test_requests_within_debounce_are_merged_into_one_publish():
+    publish = Publish()
+    publisher = make_publisher(publish)
+    publisher.request(priority=TELEMETRY)
+    publisher.request(full=True)
+    publisher.request(override_desired=True, priority=ACK)
+    assert publish.calls == []
+
+    publisher.flush(timeout=0)
+    assert publish.calls == [(True, True, ACK)]
+    assert publisher.stats()["requested"] == 3
+
+
+def test_requests_while_in_flight_are_sent_as_one_update_after_it_completes():
+    publish = Publish()
+    publisher = make_publisher(publish)
+    publisher.request()
+    publisher.flush(timeout=0)
+    publisher.request()
+    publisher.request(full=True)
+    assert not publisher.flush(timeout=0)
+    assert len(publish.calls) == 1
+
+    publish.futures[0].set_result(None)
+    publisher.flush(timeout=0)
+    assert publish.calls == [(False, False, STATE), (False, True, STATE)]
+    publish.futures[1].set_result(None)
+    assert publisher.flush(timeout=0)
+    assert publisher.stats() == {"requested": 3, "published": 2, "inflight": 0, "pending": False}
+
+
+def test_failed_publish_releases_in_flight_slot():
+    publish = Publish()
+    publisher = make_publisher(publish)
+    publisher.request()
+    publisher.flush(timeout=0)
+    publish.futures[0].set_exception(RuntimeError("timeout"))
+    assert publisher.flush(timeout=0)
+    publisher.request()
+    publisher.flush(timeout=0)
+    assert len(publish.calls) == 2
+
+
+def test_nothing_sent_is_not_counted_as_published():
+    publish = Publish(result=False)
+    publisher = make_publisher(publish)
+    publisher.request()
+    assert publisher.flush(timeout=0)
+    assert publisher.stats()["published"] == 0
+
+
+def test_unacknowledged_publish_stops_holding_back_after_timeout():
+    publish = Publish()
+    publisher = make_publisher(publish, inflight_timeout=0)
+    publisher.request()
+    publisher.flush(timeout=0)
+    publisher.request()
+    publisher.flush(timeout=0)
+    assert len(publish.calls) == 2
+
+
+def test_debounce_timer_publishes_without_flush():
+    publish = Publish()
+    publisher = make_publisher(publish, debounce=0)
+    publisher.request()
+    assert publish.sent.wait(5)
+    publish.futures[0].set_result(None)
+    assert publisher.flush(timeout=5)
+    assert publish.calls == [(False, False, STATE)]
+
+
+def test_cancel_drops_pending_update():
+    publish = Publish()
+    publisher = make_publisher(publish)
+    publisher.request(full=True)
+    publisher.cancel()
+    assert publisher.flush(timeout=0)
+    assert publish.calls == []
+
+
+def test_token_bucket_allows_burst_then_refills_at_rate():
+    bucket = TokenBucket(rate=10, burst=2)
+    bucket.updated = 0.0
+    for _ in range(2):
+        assert bucket.delay(0.0) == 0
+        bucket.take()
+    assert bucket.delay(0.0) == pytest.approx(0.1)
+    assert bucket.delay(0.05) == pytest.approx(0.05)
+    assert bucket.delay(0.1) == 0
+    # Tokens don't build up beyond burst while idle
+    assert bucket.delay(100.0) == 0
+    assert bucket.tokens == 2
+
+
+def test_token_bucket_without_rate_never_waits():
+    bucket = TokenBucket(rate=0, burst=1)
+    bucket.take()
+    bucket.take()
+    assert bucket.delay(0.0) == 0
+
+
+class Sender:
+    """Sends of the outbound publisher, holding the first one until released so the test
+    can queue publishes behind it
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def blocking(self):
+        self.started.set()
+        self.release.wait(5)
+
+    def send(self, name):
+        def send():
+            self.sent.append(name)
+        return send
+
+
+def make_outbound(sender, max_queue=100):
+    outbound = OutboundPublisher(rate=0, max_queue=max_queue)
+    outbound.submit(TELEMETRY, sender.blocking, name="blocking")
+    assert sender.started.wait(5)
+    return outbound
+
+
+def test_outbound_publishes_are_sent_highest_priority_first():
+    sender = Sender()
+    outbound = make_outbound(sender)
+    for priority, name in [(TELEMETRY, "t1"), (HEARTBEAT, "h"), (STATE, "s"), (TELEMETRY, "t2"), (ACK, "a")]:
+        outbound.submit(priority, sender.send(name), name=name)
+    sender.release.set()
+    outbound.stop()
+    assert sender.sent == ["a", "s", "h", "t1", "t2"]
+
+
+def test_full_queue_evicts_newest_lower_priority_publish():
+    sender = Sender()
+    outbound = make_outbound(sender, max_queue=2)
+    first = outbound.submit(TELEMETRY, sender.send("t1"), name="t1")
+    second = outbound.submit(TELEMETRY, sender.send("t2"), name="t2")
+    ack = outbound.submit(ACK, sender.send("a"), name="a")
+    with pytest.raises(RuntimeError):
+        second.result(timeout=0)
+    # Nothing lower than telemetry to evict, so the new publish is dropped
+    dropped = outbound.submit(TELEMETRY, sender.send("t3"), name="t3")
+    with pytest.raises(RuntimeError):
+        dropped.result(timeout=0)
+
+    sender.release.set()
+    first.result(timeout=5)
+    ack.result(timeout=5)
+    outbound.stop()
+    assert sender.sent == ["a", "t1"]
+
+
+def test_publish_future_resolves_once_acknowledged():
+    outbound = OutboundPublisher(rate=0)
+    acked = Future()
+    future = outbound.submit(STATE, lambda: acked, name="s")
+    assert not future.done()
+    acked.set_result("ok")
+    assert future.result(timeout=5) == "ok"
+    outbound.stop()
+
+
+def test_publishes_after_stop_are_dropped():
+    outbound = OutboundPublisher(rate=0)
+    outbound.stop()
+    future = outbound.submit(ACK, lambda: None)
+    with pytest.raises(RuntimeError):
+        future.result(timeout=0)
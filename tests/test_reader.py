@@ -0,0 +1,106 @@
+import calendar
+import warnings
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pytest
+
+from Reader import (parse_timestamps, time_to_us, read_samples, iter_samples,
+                    CSV_TIME_FORMAT, FEATHER_TIME_FORMAT, AXES)
+
+# The logger writes Feather V1 files, which pyarrow warns about
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning", "ignore::FutureWarning")
+
+TIMES = [
+    datetime(2021, 9, 1, 14, 0, 0, 0),
+    datetime(2021, 9, 1, 14, 0, 0, 500),
+    datetime(2021, 12, 31, 23, 59, 59, 999999),
+    datetime(2024, 2, 29, 0, 0, 1, 123456),
+    datetime(1999, 1, 1, 0, 0, 0, 1),
+]
+
+
+def epoch_us(t):
+    # Logger times are wall clock times, parsed without a timezone
+    return calendar.timegm(t.timetuple()) * 1_000_000 + t.microsecond
+
+
+def expected_us(times=TIMES):
+    return np.array([epoch_us(t) for t in times], dtype=np.int64)
+
+
+@pytest.mark.parametrize("fmt", [CSV_TIME_FORMAT, FEATHER_TIME_FORMAT])
+def test_parse_timestamps_matches_strptime(fmt):
+    values = [t.strftime(fmt) for t in TIMES]
+    assert [datetime.strptime(v, fmt) for v in values] == TIMES
+    np.testing.assert_array_equal(parse_timestamps(values), expected_us())
+
+
+def test_parse_timestamps_accepts_bytes():
+    values = [t.strftime(CSV_TIME_FORMAT).encode() for t in TIMES]
+    np.testing.assert_array_equal(parse_timestamps(values), expected_us())
+
+
+def test_time_to_us_keeps_integer_times():
+    column = pa.chunked_array([pa.array([1, 2], pa.int64()), pa.array([3], pa.int64())])
+    np.testing.assert_array_equal(time_to_us(column), [1, 2, 3])
+
+
+def test_time_to_us_of_empty_column():
+    assert len(time_to_us(pa.chunked_array([], pa.string()))) == 0
+
+
+def samples(rows):
+    return np.arange(rows * len(AXES), dtype=np.float64).reshape(len(AXES), rows) / 8
+
+
+def write_csv(path, times, axes):
+    with open(path, "w", newline="") as f:
+        f.write("time," + ",".join(AXES) + "\r\n")
+        for i, t in enumerate(times):
+            f.write(t.strftime(CSV_TIME_FORMAT) + "," + ",".join(repr(float(a[i])) for a in axes) + "\r\n")
+
+
+def write_feather(path, time_column, axes, version=2):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        feather.write_feather(pa.table({"time": time_column, **dict(zip(AXES, axes))}), str(path),
+                              version=version)
+
+
+@pytest.fixture(params=["csv", "feather_v1", "feather_transcoded"])
+def output_file(request, tmp_path):
+    axes = samples(len(TIMES))
+    if request.param == "csv":
+        path = tmp_path / "CX1_1901_2021-09-01_14-00-00.csv"
+        write_csv(path, TIMES, axes)
+    elif request.param == "feather_v1":
+        path = tmp_path / "CX1_1902_2021-09-01_14-00-00.feather"
+        write_feather(path, [t.strftime(FEATHER_TIME_FORMAT) for t in TIMES], axes, version=1)
+    else:
+        path = tmp_path / "CX1_1903_2021-09-01_14-00-00.feather"
+        write_feather(path, pa.array(expected_us(), pa.int64()), axes)
+    return str(path), axes
+
+
+def test_read_samples(output_file):
+    path, axes = output_file
+    times, values = read_samples(path)
+    np.testing.assert_array_equal(times, expected_us())
+    np.testing.assert_array_equal(values, axes)
+
+
+def test_iter_samples_matches_read_samples(output_file):
+    path, axes = output_file
+    chunks = list(iter_samples(path, chunk_rows=2))
+    assert len(chunks) > 1 or path.endswith(".csv")
+    np.testing.assert_array_equal(np.concatenate([t for t, _ in chunks]), expected_us())
+    np.testing.assert_array_equal(np.concatenate([v for _, v in chunks], axis=1), axes)
+
+
+def test_read_selected_columns(output_file):
+    path, axes = output_file
+    _, values = read_samples(path, columns=("accel_z",))
+    np.testing.assert_array_equal(values, axes[2:])
@@ -0,0 +1,84 @@
+import random
+import threading
+import time
+
+from Scheduler import PeriodicTask, Scheduler
+
+
+def make_task(**kwargs):
+    kwargs.setdefault("jitter", 0)
+    return PeriodicTask("task", lambda: False, 10, rng=random.Random(1), **kwargs)
+
+
+def test_interval_backs_off_while_nothing_changes():
+    task = make_task(max_interval=40, backoff=2)
+    assert [task.next_delay(False, 0) for _ in range(4)] == [20, 40, 40, 40]
+
+
+def test_change_resets_interval():
+    task = make_task(max_interval=40, backoff=2)
+    task.next_delay(False, 0)
+    assert task.next_delay(True, 0) == 10
+    assert task.next_delay(False, 0) == 20
+
+
+def test_fixed_interval_without_backoff():
+    task = make_task()
+    assert [task.next_delay(False, 0) for _ in range(3)] == [10, 10, 10]
+
+
+def test_boost_runs_at_fast_interval_until_it_expires():
+    task = make_task(max_interval=40, backoff=2, fast_interval=1)
+    task.next_run = 100
+    task.boost(30, now=50)
+    assert task.next_run == 51
+    assert task.next_delay(False, 60) == 1
+    assert task.next_delay(False, 80) == 40
+
+
+def test_jitter_stays_within_fraction_and_is_reproducible_with_seed():
+    delays = [make_task(jitter=0.1).next_delay(False, 0) for _ in range(2)]
+    assert delays[0] == delays[1]
+
+    task = make_task(jitter=0.1)
+    for _ in range(100):
+        assert 9 <= task.next_delay(False, 0) <= 11
+
+
+def test_first_run_is_spread_over_one_interval():
+    now = time.monotonic()
+    task = PeriodicTask("task", lambda: False, 10, rng=random.Random(1))
+    assert now <= task.next_run <= time.monotonic() + 10
+
+
+def test_tasks_of_schedulers_with_same_seed_use_same_jitter():
+    delays = []
+    for _ in range(2):
+        task = Scheduler(seed="device").add("task", lambda: False, 10)
+        delays.append([task.next_delay(False, 0) for _ in range(3)])
+    assert delays[0] == delays[1]
+
+
+def test_run_task_schedules_next_run_and_counts_errors():
+    scheduler = Scheduler(seed="device")
+    task = scheduler.add("task", lambda: 1 / 0, 10, jitter=0)
+    task.next_run = float("inf")
+    before = time.monotonic()
+    scheduler.run_task(task)
+    assert task.runs == 1
+    assert task.errors == 1
+    assert before + 10 <= task.next_run <= time.monotonic() + 10
+
+
+def test_boost_wakes_scheduler_to_run_task():
+    ran = threading.Event()
+    scheduler = Scheduler(seed="device")
+    task = scheduler.add("task", ran.set, 3600, fast_interval=0.01)
+    task.next_run = time.monotonic() + 3600
+    scheduler.start()
+    try:
+        scheduler.boost("task")
+        assert ran.wait(5)
+    finally:
+        scheduler.stop(timeout=5)
+    assert not scheduler.thread.is_alive()
@@ -0,0 +1,84 @@
+from SettingsCache import SettingsCache, merge_settings, normalize_settings, settings_hash
+
+SETTINGS = {
+    "Sample_rate": 1000,
+    "Gain": 2.5,
+    "Offline_mode": False,
+    "File_upload": {"Active": True, "Endpoint": "https://example.com/upload"}
+}
+
+
+def test_normalize_lower_cases_keys_and_integral_floats():
+    assert normalize_settings({"Sample_Rate": 1000.0, "Nested": {"A": [1.0, 1.5]}, "On": True}) == \
+        {"sample_rate": 1000, "nested": {"a": [1, 1.5]}, "on": True}
+
+
+def test_hash_ignores_key_case_order_and_integral_floats():
+    variant = {
+        "file_upload": {"endpoint": "https://example.com/upload", "active": True},
+        "offline_mode": False, "gain": 2.5, "sample_rate": 1000.0
+    }
+    assert settings_hash(variant) == settings_hash(SETTINGS)
+    assert settings_hash({**SETTINGS, "Gain": 3}) != settings_hash(SETTINGS)
+    assert settings_hash(None) is None
+
+
+def test_hash_keeps_booleans_distinct_from_numbers():
+    assert settings_hash({"a": True}) != settings_hash({"a": 1})
+
+
+def test_merge_keeps_api_casing_and_lists_changed_paths():
+    merged, changed = merge_settings(SETTINGS, {"sample_rate": 2000, "file_upload": {"active": False}})
+    assert merged["Sample_rate"] == 2000
+    assert merged["File_upload"] == {"Active": False, "Endpoint": "https://example.com/upload"}
+    assert "sample_rate" not in merged
+    assert sorted(changed) == ["File_upload.Active", "Sample_rate"]
+
+
+def test_merge_without_changes():
+    merged, changed = merge_settings(SETTINGS, {"SAMPLE_RATE": 1000.0, "File_upload": {"Active": True}})
+    assert changed == []
+    assert merged == SETTINGS
+
+
+def test_merge_adds_new_keys():
+    merged, changed = merge_settings(SETTINGS, {"Channels": 3})
+    assert merged["Channels"] == 3
+    assert changed == ["Channels"]
+
+
+def test_plan_without_cached_settings_merges_into_fetched_settings():
+    cache = SettingsCache()
+    fetched = []
+
+    def fetch():
+        fetched.append("s1")
+        return SETTINGS
+
+    assert cache.plan("s1", {"Gain": 1}, fetch=fetch) == ({**SETTINGS, "Gain": 1}, ["Gain"])
+    assert cache.plan("s1", {"gain": 2.5}, fetch=fetch) is None
+    assert fetched == ["s1", "s1"]
+
+
+def test_plan_without_cached_settings_or_fetch_sends_desired():
+    cache = SettingsCache()
+    assert cache.plan("s1", {"Gain": 1}) == ({"Gain": 1}, ["*"])
+
+
+def test_plan_skips_settings_already_applied():
+    cache = SettingsCache()
+    cache.set("s1", SETTINGS)
+    assert cache.plan("s1", {"gain": 2.5}) is None
+    assert cache.plan("s1", {k.upper(): v for k, v in SETTINGS.items()}) is None
+
+
+def test_plan_merges_partial_settings():
+    cache = SettingsCache()
+    digest = cache.set("s1", SETTINGS)
+    settings, changed = cache.plan("s1", {"Gain": 4})
+    assert settings == {**SETTINGS, "Gain": 4}
+    assert changed == ["Gain"]
+    # Planning doesn't change the cache until the new settings are stored
+    assert cache.hash("s1") == digest
+    assert cache.set("s1", settings) != digest
+    assert cache.get("s1") == settings
@@ -0,0 +1,219 @@
+from concurrent.futures import Future
+
+from Dispatcher import Dispatcher
+from ShadowHandler import GlobalShadowHandler, SensorShadowHandler, ShadowHandler
+
+
+class Handler(ShadowHandler):
+    def subscribe_to_shadow_topics(self):
+        pass
+
+
+def make_handler(dedupe_size=256):
+    return Handler(None, "thing", "s1", None, dedupe_size=dedupe_size)
+
+
+def test_new_messages_are_accepted_in_version_order():
+    handler = make_handler()
+    assert handler.accept_message("a", 1)
+    assert handler.accept_message("b", 2)
+    assert handler.applied_version == 2
+
+
+def test_redelivered_message_is_dropped():
+    handler = make_handler()
+    assert handler.accept_message("a", 5)
+    assert not handler.accept_message("a", 5)
+
+
+def test_older_version_is_dropped():
+    handler = make_handler()
+    assert handler.accept_message("a", 5)
+    assert not handler.accept_message("b", 4)
+    assert not handler.accept_message("c", 5)
+    assert handler.applied_version == 5
+
+
+def test_own_updates_are_dropped_and_advance_version():
+    handler = make_handler()
+    assert not handler.accept_message(handler.token, 3)
+    assert handler.applied_version == 3
+    assert not handler.accept_message("a", 2)
+    assert handler.accept_message("a", 4)
+
+
+def test_own_older_update_does_not_move_version_back():
+    handler = make_handler()
+    assert handler.accept_message("a", 5)
+    assert not handler.accept_message(handler.token, 3)
+    assert handler.applied_version == 5
+
+
+def test_messages_without_version_are_deduped_by_token():
+    handler = make_handler()
+    assert handler.accept_message("a", None)
+    assert not handler.accept_message("a", None)
+    assert handler.accept_message("b", None)
+    assert handler.applied_version is None
+
+
+def test_applied_messages_are_kept_in_lru_of_dedupe_size():
+    handler = make_handler(dedupe_size=2)
+    for token in ("a", "b", "c"):
+        assert handler.accept_message(token, None)
+    assert list(handler.applied) == [("b", None), ("c", None)]
+    # A duplicate refreshes its entry, so the oldest other entry is evicted next
+    assert not handler.accept_message("b", None)
+    assert handler.accept_message("d", None)
+    assert list(handler.applied) == [("b", None), ("d", None)]
+    assert handler.accept_message("a", None)
+
+
+
+class Client:
+    """Shadow client whose update publishes complete as told by the test"""
+
+    def __init__(self):
+        self.futures = []
+
+    def publish_update_named_shadow(self, request, qos):
+        future = Future()
+        self.futures.append((request, future))
+        return future
+
+
+class Outbox:
+    online = False
+
+    def __init__(self):
+        self.records = []
+
+    def append(self, kind, key, body):
+        self.records.append((kind, key, body))
+
+
+def make_publishing_handler():
+    handler = Handler(Client(), "thing", "s1", None, outbox=Outbox(), debounce=0)
+    handler.local_state = {"active": True}
+    return handler
+
+
+def test_failed_publish_is_queued_offline():
+    handler = make_publishing_handler()
+    handler.outbox.online = True
+    future = handler.publish_state()
+    handler.outbox.online = False
+    handler.client.futures[0][1].set_exception(RuntimeError("timeout"))
+    assert future.done()
+    assert [key for _, key, _ in handler.outbox.records] == ["s1"]
+
+
+def test_failed_publish_superseded_by_acked_publish_is_not_queued():
+    handler = make_publishing_handler()
+    handler.outbox.online = True
+    handler.publish_state(full=True)
+    handler.local_state = {"active": False}
+    handler.publish_state(full=True)
+    (_, first), (_, second) = handler.client.futures
+    second.set_result(None)
+    first.set_exception(RuntimeError("timeout"))
+    assert handler.outbox.records == []
+    assert handler.last_reported == {"active": False}
+
+
+def test_resync_publishes_full_state():
+    handler = make_publishing_handler()
+    handler.outbox.online = True
+    handler.client.publish_update_named_shadow = lambda request, qos: done(request)
+    published = []
+
+    def done(request):
+        published.append(request.state.reported)
+        future = Future()
+        future.set_result(None)
+        return future
+
+    handler.last_reported = {"active": True}
+    assert handler.resync(timeout=5)
+    assert published == [{"active": True}]
+
+
+class Sensor(SensorShadowHandler):
+    """Sensor handler recording commands instead of calling the device API"""
+
+    def __init__(self, name, dispatcher, calls):
+        self.calls = calls
+        super().__init__(None, "thing", name, name, None, None, dispatcher=dispatcher)
+
+    def subscribe_to_shadow_topics(self):
+        pass
+
+    def change_sensor_running(self, active):
+        self.calls.append((self.sensor_name, "active"))
+        return {"status": "Success", "error": None}
+
+    def get_or_update_sensor_settings(self, settings=None):
+        self.calls.append((self.sensor_name, "settings"))
+        return {"status": "Success", "error": None}
+
+    def update_state(self, override_desired=False, full=False, priority=None):
+        self.calls.append((self.sensor_name, "update"))
+
+
+class Global(GlobalShadowHandler):
+    def subscribe_to_shadow_topics(self):
+        pass
+
+    def update_state(self, override_desired=False, full=False, priority=None):
+        self.updates.append([s["active"] for s in self.local_state["sensors"]])
+
+
+def test_global_delta_runs_each_sensor_in_order_on_its_dispatcher_key():
+    dispatcher = Dispatcher(max_workers=2, max_per_group=1)
+    calls = []
+    handler = Global(None, "thing", "global", None, None, dispatcher=dispatcher)
+    handler.updates = []
+    handler.set_state({"sensors": [{"sensor_id": f"s{i}", "active": True} for i in range(3)]},
+                      update_index=True)
+    for i in range(3):
+        handler.register_sensor(Sensor(f"s{i}", dispatcher, calls))
+
+    # Delta is applied on the global shadow's key, as when it arrives from MQTT
+    assert handler.dispatch(handler.apply_desired, {"sensors": [
+        {"sensor_id": f"s{i}", "active": False, "settings": {"rate": i}} for i in range(3)]})
+    dispatcher.shutdown()
+
+    for i in range(3):
+        assert [kind for name, kind in calls if name == f"s{i}"] == ["active", "settings", "update"]
+    assert handler.updates == [[False, False, False]]
+
+
+class SettingsApi:
+    def __init__(self, settings):
+        self.settings = settings
+        self.requests = []
+
+    def url(self, path):
+        return path
+
+    def get_settings(self, sensor_id):
+        self.requests.append(("GET", sensor_id))
+        return self.settings
+
+    def update_settings(self, sensor_id, settings):
+        self.requests.append(("PUT", settings))
+        self.settings = settings
+        return settings
+
+
+class SettingsSensor(SensorShadowHandler):
+    def subscribe_to_shadow_topics(self):
+        pass
+
+
+def test_partial_settings_without_cache_are_merged_into_current_settings():
+    api = SettingsApi({"Gain": 2, "Sample_rate": 1000})
+    handler = SettingsSensor(None, "thing", "s1", "s1", api, None)
+    assert handler.get_or_update_sensor_settings({"gain": 4})["error"] is None
+    assert api.requests == [("GET", "s1"), ("PUT", {"Gain": 4, "Sample_rate": 1000})]
+    assert handler.local_state["settings"] == {"Gain": 4, "Sample_rate": 1000}
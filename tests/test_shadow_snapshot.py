@@ -0,0 +1,65 @@
+import json
+
+from ShadowSnapshot import ShadowSnapshot, updated_since
+
+
+def stamp(t):
+    return {"timestamp": t}
+
+
+def test_updated_since_filters_object_fields():
+    desired = {"active": False, "settings": {"Gain": 2, "Sample_rate": 1000}}
+    metadata = {"active": stamp(100), "settings": {"Gain": stamp(200), "Sample_rate": stamp(50)}}
+    assert updated_since(desired, metadata, 150) == {"settings": {"Gain": 2}}
+    assert updated_since(desired, metadata, 90) == {"active": False, "settings": {"Gain": 2}}
+    assert updated_since(desired, metadata, 300) is None
+
+
+def test_updated_since_keeps_whole_array_elements():
+    desired = {"sensors": [{"sensor_id": "s1", "active": True}, {"sensor_id": "s2", "active": False}]}
+    metadata = {"sensors": [
+        {"sensor_id": stamp(10), "active": stamp(10)},
+        {"sensor_id": stamp(10), "active": stamp(200)}]}
+    assert updated_since(desired, metadata, 100) == {"sensors": [{"sensor_id": "s2", "active": False}]}
+
+
+def test_updated_since_counts_same_second_as_newer():
+    # Shadow timestamps are whole seconds, snapshot times are not
+    assert updated_since({"a": 1}, {"a": stamp(100)}, 100.7) == {"a": 1}
+    assert updated_since({"a": 1}, {"a": stamp(99)}, 100.7) is None
+
+
+def test_updated_since_without_metadata():
+    assert updated_since({"a": 1}, {}, 0) is None
+    assert updated_since({"a": 1}, None, 0) is None
+
+
+class Handler:
+    def __init__(self, name, state, version):
+        self.shadow_request = {"shadow_name": name}
+        self.state = state
+        self.version = version
+
+    def snapshot(self):
+        return {"local_state": self.state, "version": self.version}
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "state" / "shadows.json")
+    ShadowSnapshot("thing", path).save([Handler("global", {"a": 1}, 3), Handler("s1", {"active": True}, 7)])
+
+    snapshot = ShadowSnapshot("thing", path)
+    shadows = snapshot.load()
+    assert set(shadows) == {"global", "s1"}
+    assert snapshot.get("s1") == {"local_state": {"active": True}, "version": 7}
+    assert snapshot.get("s2") is None
+    assert snapshot.saved_at > 0
+
+
+def test_load_ignores_missing_corrupt_or_other_thing(tmp_path):
+    path = tmp_path / "shadows.json"
+    assert ShadowSnapshot("thing", str(path)).load() == {}
+    path.write_text("{not json")
+    assert ShadowSnapshot("thing", str(path)).load() == {}
+    path.write_text(json.dumps({"thing": "other", "saved_at": 1, "shadows": {"global": {}}}))
+    assert ShadowSnapshot("thing", str(path)).load() == {}
@@ -0,0 +1,58 @@
+from StateDiff import diff_state
+
+
+def apply(state, diff):
+    """Applies a partial document the way the shadow service does"""
+    result = dict(state)
+    for key, value in diff.items():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = apply(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+def test_unchanged_state_gives_empty_diff():
+    state = {"active": True, "settings": {"Sample_rate": 1000}}
+    assert diff_state(state, dict(state)) == {}
+
+
+def test_only_changed_keys_are_included():
+    old = {"active": True, "cpu": 10, "settings": {"Sample_rate": 1000, "Gain": 1}}
+    new = {"active": True, "cpu": 12, "settings": {"Sample_rate": 1000, "Gain": 2}}
+    assert diff_state(old, new) == {"cpu": 12, "settings": {"Gain": 2}}
+
+
+def test_removed_keys_are_set_to_none():
+    old = {"active": True, "settings": {"Sample_rate": 1000, "Gain": 1}}
+    new = {"settings": {"Sample_rate": 1000}}
+    assert diff_state(old, new) == {"active": None, "settings": {"Gain": None}}
+
+
+def test_added_keys_are_included():
+    assert diff_state({"a": 1}, {"a": 1, "b": {"c": 2}}) == {"b": {"c": 2}}
+
+
+def test_arrays_are_replaced_in_full():
+    old = {"sensors": [{"sensor_id": "s1", "active": True}, {"sensor_id": "s2", "active": True}]}
+    new = {"sensors": [{"sensor_id": "s1", "active": True}, {"sensor_id": "s2", "active": False}]}
+    assert diff_state(old, new) == {"sensors": new["sensors"]}
+
+
+def test_type_change_counts_as_change():
+    # 1 == 1.0 == True in Python, but they are different values in the shadow document
+    assert diff_state({"a": 1}, {"a": 1.0}) == {"a": 1.0}
+    assert diff_state({"a": 1}, {"a": True}) == {"a": True}
+
+
+def test_object_replaced_by_scalar_and_back():
+    assert diff_state({"a": {"b": 1}}, {"a": 2}) == {"a": 2}
+    assert diff_state({"a": 2}, {"a": {"b": 1}}) == {"a": {"b": 1}}
+
+
+def test_applying_diff_gives_new_state():
+    old = {"active": True, "storage": {"free_bytes": 10, "quota_bytes": None}, "sensors": [1, 2], "gone": 1}
+    new = {"active": False, "storage": {"free_bytes": 5}, "sensors": [1], "added": {"x": 1}}
+    assert apply(old, diff_state(old, new)) == new
@@ -0,0 +1,76 @@
+import importlib.util
+
+import numpy as np
+import pytest
+
+from Telemetry import encode_frame, decode_frame, frame_times, COMPRESSIONS
+
+# lz4 is optional
+AVAILABLE = [c for c in COMPRESSIONS if c != "lz4" or importlib.util.find_spec("lz4")]
+
+
+def signal(samples=1000, axes=3):
+    t = np.arange(samples) / 1000
+    return np.stack([np.sin(2 * np.pi * (5 + i) * t) * (i + 1) + 0.01 * i for i in range(axes)])
+
+
+@pytest.mark.parametrize("compression", AVAILABLE)
+@pytest.mark.parametrize("delta", [False, True])
+def test_float32_round_trip_is_exact(compression, delta):
+    axes = signal()
+    frame = decode_frame(encode_frame(axes, 1_600_000_000_000_000, 1_000_000, sequence=7,
+                                      encoding="float32", delta=delta, compression=compression))
+    assert frame.sequence == 7
+    assert frame.base_time_us == 1_600_000_000_000_000
+    assert frame.interval_ns == 1_000_000
+    np.testing.assert_array_equal(frame.axes, axes.astype(np.float32))
+
+
+@pytest.mark.parametrize("compression", AVAILABLE)
+@pytest.mark.parametrize("delta", [False, True])
+def test_int16_round_trip_within_one_step(compression, delta):
+    axes = signal()
+    frame = decode_frame(encode_frame(axes, 0, 1_000_000, encoding="int16", delta=delta,
+                                      compression=compression))
+    peak = np.max(np.abs(axes), axis=1)
+    error = np.max(np.abs(frame.axes - axes), axis=1)
+    assert frame.axes.shape == axes.shape
+    assert np.all(error <= peak / 32767)
+
+
+def test_delta_wraps_around_on_large_steps():
+    # Alternating full scale values overflow int16 deltas, decoding must still be exact
+    axes = np.tile([1.0, -1.0], 50)[np.newaxis, :]
+    frame = decode_frame(encode_frame(axes, 0, 1000, encoding="int16", delta=True, compression="none"))
+    np.testing.assert_allclose(frame.axes, axes, atol=1 / 32767)
+
+
+def test_single_axis_and_silent_axis():
+    frame = decode_frame(encode_frame(np.zeros(10), 0, 1000, encoding="int16", compression="none"))
+    assert frame.axes.shape == (1, 10)
+    assert not frame.axes.any()
+
+
+def test_empty_frame():
+    frame = decode_frame(encode_frame(np.zeros((3, 0)), 5, 1000, compression="zlib"))
+    assert frame.axes.shape == (3, 0)
+    assert frame.base_time_us == 5
+
+
+def test_sequence_wraps_to_32_bits():
+    frame = decode_frame(encode_frame(np.zeros((1, 2)), 0, 1000, sequence=2 ** 32 + 3))
+    assert frame.sequence == 3
+
+
+def test_frame_times_from_interval():
+    frame = decode_frame(encode_frame(np.zeros((1, 4)), 1_000_000, 500_000, compression="none"))
+    np.testing.assert_array_equal(frame_times(frame), [1_000_000, 1_000_500, 1_001_000, 1_001_500])
+
+
+def test_invalid_frames_and_options_are_rejected():
+    with pytest.raises(ValueError):
+        decode_frame(b"XX" + bytes(30))
+    with pytest.raises(ValueError):
+        encode_frame(np.zeros((1, 2)), 0, 1000, encoding="int8")
+    with pytest.raises(ValueError):
+        encode_frame(np.zeros((1, 2)), 0, 1000, compression="gzip")
@@ -0,0 +1,50 @@
+import calendar
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from OutputFiles import OutputFile
+from Reader import CSV_TIME_FORMAT, AXES
+from TimeIndex import FileIndex
+
+START = datetime(2021, 9, 1, 14, 0, 0)
+TIMES = [START + timedelta(milliseconds=i) for i in range(5)]
+
+
+def epoch_us(t):
+    return calendar.timegm(t.timetuple()) * 1_000_000 + t.microsecond
+
+
+def csv_text(times):
+    lines = ["time," + ",".join(AXES)]
+    lines += [t.strftime(CSV_TIME_FORMAT) + "," + ",".join(str(float(i)) for _ in AXES)
+              for i, t in enumerate(times)]
+    return "\n".join(lines)
+
+
+def build(tmp_path, text, stride=2):
+    path = tmp_path / "CX1_1901_2021-09-01_14-00-00.csv"
+    path.write_text(text)
+    index = FileIndex(OutputFile(path, "CX1_1901", START, "csv"))
+    index.build(stride)
+    return index
+
+
+@pytest.mark.parametrize("tail", ["\n", "", "\n2021-09-01 14:00:00:0", "\n2021-09-01 14:00:00:005000,1.0"])
+def test_csv_index_covers_complete_rows_only(tmp_path, tail):
+    index = build(tmp_path, csv_text(TIMES) + tail)
+    complete = TIMES if tail.startswith("\n") else TIMES[:-1]
+    assert index.rows == len(complete)
+    assert index.end_us == epoch_us(complete[-1])
+    np.testing.assert_array_equal(index.times, [epoch_us(complete[i]) for i in range(0, len(complete), 2)])
+
+    times, axes = index.read(epoch_us(TIMES[0]), epoch_us(TIMES[-1]) + 1000)
+    np.testing.assert_array_equal(times, [epoch_us(t) for t in complete])
+    assert axes.shape == (len(AXES), len(complete))
+
+
+def test_csv_index_of_header_only_file(tmp_path):
+    index = build(tmp_path, csv_text([]) + "\n")
+    assert index.rows == 0
+    assert index.end_us is None